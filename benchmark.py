@@ -0,0 +1,201 @@
+"""
+Performance Benchmarks for AgroSmart
+Measures the hot paths of the backend with warmup and percentile reporting:
+- make_prediction single-row latency and batch prediction throughput
+- model load time
+- JSON line parsing in prediction_server and the serial bridge (the bridge
+  itself is not imported: its parse_serial_line() is reading_schema's parser)
+- sensor history append/query cost at different history sizes
+
+Results are written to a JSON file so runs can be compared across model
+versions and code changes:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import joblib
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+import prediction_server
+from reading_schema import schema as reading_schema
+
+FEATURE_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
+SAMPLE_READING = {
+    'N': 90, 'P': 42, 'K': 43, 'temperature': 20.8, 'humidity': 82.0,
+    'rainfall': 202.9, 'soil_moisture': 45
+}
+SAMPLE_LINE = json.dumps({
+    'temperature': 28.5, 'humidity': 65.0, 'soil_moisture': 45, 'soil_moisture_raw': 3300,
+    'N': 40, 'P': 30, 'K': 35, 'rainfall': 0, 'pump_command': 'PUMP_OFF'
+})
+
+
+def measure(fn, iterations, warmup=None):
+    """
+    Runs fn `warmup` times untimed, then `iterations` times timed.
+    Returns latency stats in microseconds and operations per second.
+    """
+    warmup = max(1, iterations // 10) if warmup is None else warmup
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(p / 100 * len(timings)))]
+
+    mean = sum(timings) / len(timings)
+    return {
+        'iterations': iterations,
+        'mean_us': round(mean, 2),
+        'p50_us': round(percentile(50), 2),
+        'p90_us': round(percentile(90), 2),
+        'p99_us': round(percentile(99), 2),
+        'min_us': round(timings[0], 2),
+        'max_us': round(timings[-1], 2),
+        'ops_per_sec': round(1e6 / mean, 1) if mean else None
+    }
+
+
+def bench_model(scale):
+    """Model load time, single-row prediction and batch throughput"""
+    results = {}
+    model_file = prediction_server.MODEL_FILENAME
+
+    results['model_load'] = measure(lambda: joblib.load(model_file), max(3, 5 * scale), warmup=1)
+    results['make_prediction_single'] = measure(
+        lambda: prediction_server.make_prediction(SAMPLE_READING), 200 * scale)
+
+    model = prediction_server.model
+    for rows in (100, 1000, 10000):
+        batch = pd.DataFrame([SAMPLE_READING] * rows, columns=FEATURE_COLUMNS)
+        stats = measure(lambda: model.predict(batch), max(3, 10 * scale))
+        stats['rows_per_sec'] = round(rows * stats['ops_per_sec'], 1)
+        results[f'batch_predict_{rows}'] = stats
+    return results
+
+
+def bench_parsing(scale):
+    """JSON line parse rate in the server and the serial bridge"""
+    return {
+        'parse_line_server': measure(lambda: prediction_server.parse_sensor_line(SAMPLE_LINE), 20000 * scale),
+        'parse_line_bridge': measure(lambda: reading_schema.parse_line(SAMPLE_LINE, 'bridge'), 20000 * scale)
+    }
+
+
+def bench_history(scale, sizes=(100, 1000, 10000)):
+    """History append and /api/sensors/history query cost at different sizes"""
+    results = {}
+    client = prediction_server.app.test_client()
+    original_state = prediction_server.sensor_state
+    original_archive = prediction_server.sensor_archive
+    reading = prediction_server.parse_sensor_line(SAMPLE_LINE)
+
+    # Benchmark readings must not end up in a configured archive
+    prediction_server.sensor_archive = None
+    try:
+        for size in sizes:
+            state = prediction_server.VersionedStore(reading, history_limit=size)
+            state.reset(reading, [dict(reading) for _ in range(size)])
+            prediction_server.sensor_state = state
+
+            results[f'history_append_{size}'] = measure(
+                lambda: prediction_server.publish_reading(dict(reading)), 2000 * scale)
+            results[f'history_query_{size}'] = measure(
+                lambda: client.get(f'/api/sensors/history?limit={size}'), max(5, 50 * scale // max(1, size // 1000)))
+    finally:
+        prediction_server.sensor_state = original_state
+        prediction_server.sensor_archive = original_archive
+    return results
+
+
+def environment_info():
+    """Versions and model details, so results can be compared meaningfully"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import sklearn
+    model = prediction_server.model
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sklearn': sklearn.__version__,
+        'pandas': pd.__version__,
+        'model_type': type(model).__name__,
+        'model_trees': len(getattr(model, 'estimators_', [])) or None,
+        'model_size_kb': round(os.path.getsize(prediction_server.MODEL_FILENAME) / 1024, 1)
+    }
+
+
+def compare_results(current, baseline_file):
+    """Prints the p50 change of every benchmark against a previous run"""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    print(f"\nComparison with {baseline_file} (commit {baseline['environment'].get('git_commit')}):")
+    print(f"{'Benchmark':<28} {'Before p50 µs':>14} {'After p50 µs':>14} {'Change':>9}")
+    for name, stats in current['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if not before:
+            continue
+        change = (stats['p50_us'] - before['p50_us']) / before['p50_us'] * 100 if before['p50_us'] else 0
+        print(f"{name:<28} {before['p50_us']:>14.2f} {stats['p50_us']:>14.2f} {change:>+8.1f}%")
+
+
+def print_results(benchmarks):
+    print(f"\n{'Benchmark':<28} {'p50 µs':>10} {'p90 µs':>10} {'p99 µs':>10} {'ops/sec':>12}")
+    print("-" * 74)
+    for name, stats in benchmarks.items():
+        print(f"{name:<28} {stats['p50_us']:>10.2f} {stats['p90_us']:>10.2f} "
+              f"{stats['p99_us']:>10.2f} {stats['ops_per_sec']:>12.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark AgroSmart inference and ingestion paths.")
+    parser.add_argument('--output', default=os.path.join(BASE_DIR, 'benchmark_results.json'),
+                        help="Results file (default: %(default)s)")
+    parser.add_argument('--compare', help="Previous results file to compare against")
+    parser.add_argument('--scale', type=int, default=1, help="Multiply iteration counts (default: %(default)s)")
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+    # The server's model and data files are relative to the repository
+    os.chdir(BASE_DIR)
+
+    # The server loads its model lazily; load it up front so it is not timed
+    prediction_server.warm_up()
+
+    benchmarks = {}
+    for suite in (bench_model, bench_parsing, bench_history):
+        print(f"Running {suite.__doc__}...")
+        benchmarks.update(suite(args.scale))
+
+    results = {'environment': environment_info(), 'benchmarks': benchmarks}
+    print_results(benchmarks)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to '{args.output}'")
+
+    if args.compare:
+        compare_results(results, args.compare)
@@ -0,0 +1,127 @@
+"""
+Crop Prediction Explanations for AgroSmart
+Per-prediction feature contributions for the random forest, computed from the
+trees themselves (decision-path attribution): walking from a tree's root to a
+leaf, each split moves the class probabilities from the parent's distribution
+to the child's, and that change is credited to the feature the parent split on.
+For every prediction
+
+    probability(class) = bias(class) + sum over features of contribution(feature, class)
+
+where bias is the forest's average root distribution (the training prior).
+
+All of it is precomputed once per model: every leaf stores the summed
+contributions of its path, so explaining a reading is one leaf lookup per tree,
+the same work as predicting it. The probabilities come out of the same pass,
+so the explanation replaces model.predict() rather than adding to it.
+"""
+
+import weakref
+
+import numpy as np
+
+FEATURE_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
+
+
+class ForestExplainer:
+    """
+    Leaf-level path contributions of a fitted random forest
+    """
+
+    def __init__(self, model):
+        self.classes = np.asarray(model.classes_)
+        names = list(getattr(model, 'feature_names_in_', FEATURE_COLUMNS))
+        self.features = [str(name) for name in names]
+        self.trees = []
+        bias = np.zeros(len(self.classes))
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            values = tree.value[:, 0, :]
+            probabilities = values / values.sum(axis=1, keepdims=True)
+            path = np.zeros((tree.node_count, len(self.features), len(self.classes)))
+            # Node ids are in depth-first order, so a parent is always visited before its children
+            for node in range(tree.node_count):
+                for child in (tree.children_left[node], tree.children_right[node]):
+                    if child != -1:
+                        path[child] = path[node]
+                        path[child, tree.feature[node]] += probabilities[child] - probabilities[node]
+
+            leaves = np.flatnonzero(tree.children_left == -1)
+            leaf_rows = np.full(tree.node_count, -1, dtype=np.intp)
+            leaf_rows[leaves] = np.arange(len(leaves))
+            self.trees.append((tree, leaf_rows, path[leaves]))
+            bias += probabilities[0]
+
+        self.bias = bias / len(self.trees)
+
+    @property
+    def nbytes(self):
+        """Memory taken by the precomputed tables"""
+        return sum(leaf_rows.nbytes + leaf_paths.nbytes for _, leaf_rows, leaf_paths in self.trees)
+
+    def explain(self, X):
+        """
+        X: (n, features) array in the model's feature order.
+        Returns (probabilities (n, classes), contributions (n, features, classes)).
+        """
+        X = np.asarray(X, dtype=np.float32)
+        contributions = np.zeros((len(X), len(self.features), len(self.classes)))
+        for tree, leaf_rows, leaf_paths in self.trees:
+            contributions += leaf_paths[leaf_rows[tree.apply(X)]]
+        contributions /= len(self.trees)
+        return self.bias + contributions.sum(axis=1), contributions
+
+
+def supports(model):
+    return hasattr(model, 'estimators_') and all(hasattr(estimator, 'tree_') for estimator in model.estimators_)
+
+
+# model -> ForestExplainer or None; an entry goes away with its model, so
+# several models (e.g. one per region, see model_pool.py) can be in use at once
+_compiled = weakref.WeakKeyDictionary()
+
+
+def compile_model(model):
+    """
+    ForestExplainer for `model` (None if it is not a tree ensemble), built once per model
+    """
+    try:
+        return _compiled[model]
+    except KeyError:
+        explainer = _compiled[model] = ForestExplainer(model) if supports(model) else None
+        return explainer
+
+
+def explain_rows(model, rows):
+    """
+    rows: list of feature lists in FEATURE_COLUMNS order.
+    Returns [(crop, explanation)], where explanation is
+    {'confidence': p, 'bias': prior of the crop, 'contributions': {feature: change in p}},
+    or None if the model cannot be explained this way.
+    """
+    explainer = compile_model(model)
+    if explainer is None:
+        return None
+    order = [FEATURE_COLUMNS.index(feature) for feature in explainer.features]
+    probabilities, contributions = explainer.explain(np.asarray(rows, dtype=np.float64)[:, order])
+
+    results = []
+    for row_probabilities, row_contributions in zip(probabilities, contributions):
+        best = int(np.argmax(row_probabilities))
+        results.append((explainer.classes[best], {
+            'confidence': round(float(row_probabilities[best]), 4),
+            'bias': round(float(explainer.bias[best]), 4),
+            'contributions': {feature: round(float(value), 4)
+                              for feature, value in zip(explainer.features, row_contributions[:, best])}
+        }))
+    return results
+
+
+def top_factors(explanation, count=3):
+    """
+    'rainfall (+0.31), humidity (+0.22), K (-0.05)': the largest contributions to the recommended crop
+    """
+    contributions = (explanation or {}).get('contributions') or {}
+    ranked = sorted(contributions.items(), key=lambda item: abs(item[1]), reverse=True)[:count]
+    return ", ".join(f"{feature} ({value:+.2f})" for feature, value in ranked)
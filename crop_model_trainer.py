@@ -1,20 +1,34 @@
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import train_test_split, ParameterGrid
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier, HistGradientBoostingClassifier
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.naive_bayes import GaussianNB
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import accuracy_score
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import pickle
+import time
+from dataset_cache import load_dataset
+from forest_export import DEFAULT_SIZE_BUDGET, export_forest, verify_header
 import joblib
 import os # Import the os module to check for file existence
 
 # --- 1. Data Loading and Preparation ---
 
-# The full, absolute path to the local dataset file you downloaded.
-# Using a raw string (r"...") is the best practice for Windows paths.
-DATASET_FILENAME = r"C:\Users\Jason Dsouza\Desktop\crop_project\Crop_recommendation.csv"
+# Default dataset: the CSV shipped next to this script (override with --dataset)
+DATASET_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Crop_recommendation.csv')
+MODEL_FILENAME = 'crop_recommendation_model.joblib'
 
-def load_and_prepare_data(filename):
+def load_and_prepare_data(filename, field_data=None, verbose=False):
     """
-    Loads the dataset from a local CSV file, removes the 'ph' column,
-    and separates features (X) from the target variable (y).
+    Loads the dataset (plus optional labeled field data) through the binary
+    dataset cache and separates features (X) from the target variable (y).
+    Only the model's feature columns are kept, so the 'ph' column is dropped.
     """
     print(f"Loading dataset from '{filename}'...")
 
@@ -24,28 +38,23 @@ def load_and_prepare_data(filename):
         print("Please download the dataset and place it in the same directory as this script.")
         return None, None
 
+    filenames = [filename]
+    if field_data and os.path.exists(field_data):
+        filenames.append(field_data)
+
     try:
-        df = pd.read_csv(filename)
-        print("Dataset loaded successfully.")
+        # X holds the features as float32, y the crop name of each row
+        X, y = load_dataset(*filenames)
+        print(f"Dataset loaded successfully ({len(X)} rows).")
     except Exception as e:
         print(f"Error loading dataset: {e}")
         return None, None
 
-    # As requested, remove the 'ph' column from the dataset
-    print("Dropping the 'ph' column...")
-    df = df.drop('ph', axis=1)
-
-    # Separate the features (inputs) from the target (output)
-    # X contains all columns except 'label'
-    # y contains only the 'label' column (the crop name)
-    X = df.drop('label', axis=1)
-    y = df['label']
-
-    print("Data preparation complete.")
-    print("\nFeatures (X) sample:")
-    print(X.head())
-    print("\nTarget (y) sample:")
-    print(y.head())
+    if verbose:
+        print("\nFeatures (X) sample:")
+        print(X.head())
+        print("\nTarget (y) sample:")
+        print(y.head())
 
     return X, y
 
@@ -85,6 +94,203 @@ def train_and_evaluate_model(X, y):
 
     return model
 
+# --- 2b. Hyperparameter Search with Speed/Accuracy Benchmarking ---
+
+# Candidate model families and the parameter grid searched for each.
+# Every candidate is trained single-threaded; candidates run in parallel processes.
+SEARCH_SPACE = {
+    'random_forest': (RandomForestClassifier, {
+        'n_estimators': [25, 50, 100, 200],
+        'max_depth': [None, 8, 12],
+        'min_samples_leaf': [1, 2, 4],
+        'random_state': [42]
+    }),
+    'extra_trees': (ExtraTreesClassifier, {
+        'n_estimators': [50, 100],
+        'max_depth': [None, 12],
+        'min_samples_leaf': [1, 2],
+        'random_state': [42]
+    }),
+    'decision_tree': (DecisionTreeClassifier, {
+        'max_depth': [None, 8, 12],
+        'min_samples_leaf': [1, 2],
+        'random_state': [42]
+    }),
+    'hist_gradient_boosting': (HistGradientBoostingClassifier, {
+        'max_iter': [50],
+        'max_depth': [None, 6],
+        'random_state': [42]
+    }),
+    'gaussian_nb': (GaussianNB, {}),
+    'knn': (KNeighborsClassifier, {
+        'n_neighbors': [3, 5]
+    }),
+    'logistic_regression': (LogisticRegression, {
+        'C': [1.0, 10.0],
+        'max_iter': [2000]
+    })
+}
+
+# Distance-based and linear models need scaled features
+SCALED_FAMILIES = {'knn', 'logistic_regression'}
+# Families forest_export can turn into a C header (tree ensembles)
+EXPORTABLE_FAMILIES = ('random_forest', 'extra_trees')
+
+
+def build_candidates(families=None):
+    """
+    Expands SEARCH_SPACE into a list of (family, params) candidates.
+    """
+    candidates = []
+    for family, (_, grid) in SEARCH_SPACE.items():
+        if families and family not in families:
+            continue
+        for params in ParameterGrid(grid):
+            candidates.append((family, params))
+    return candidates
+
+
+def build_model(family, params):
+    """
+    Creates an untrained model for one candidate.
+    """
+    estimator_class, _ = SEARCH_SPACE[family]
+    estimator = estimator_class(**params)
+    if 'n_jobs' in estimator.get_params():
+        estimator.set_params(n_jobs=1)  # Parallelism comes from running candidates side by side
+    if family in SCALED_FAMILIES:
+        return make_pipeline(StandardScaler(), estimator)
+    return estimator
+
+
+def fit_candidate(family, params, X_train, y_train, X_test, y_test):
+    """
+    Trains and scores one candidate (runs in a worker process).
+    Returns the result row and the pickled model, so the parent process can
+    benchmark every candidate under the same conditions.
+    """
+    model = build_model(family, params)
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+
+    accuracy = accuracy_score(y_test, model.predict(X_test))
+    model_bytes = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+    result = {
+        'family': family,
+        'params': {k: v for k, v in params.items() if k != 'random_state'},
+        'accuracy': round(accuracy, 4),
+        'fit_time_s': round(fit_time, 3),
+        'size_kb': round(len(model_bytes) / 1024, 1)
+    }
+    return result, model_bytes
+
+
+def measure_latency(model, X_test, single_row_runs=50, batch_runs=5):
+    """
+    Measures inference latency the way the server calls the model:
+    a one-row DataFrame per reading, and the whole test set as one batch.
+    Returns median single-row latency (ms) and batch cost per row (µs).
+    """
+    single_row = X_test.iloc[[0]]
+    model.predict(single_row)  # Warmup
+
+    timings = []
+    for _ in range(single_row_runs):
+        start = time.perf_counter()
+        model.predict(single_row)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    single_row_ms = timings[len(timings) // 2] * 1000
+
+    batch_timings = []
+    for _ in range(batch_runs):
+        start = time.perf_counter()
+        model.predict(X_test)
+        batch_timings.append(time.perf_counter() - start)
+    batch_timings.sort()
+    batch_us_per_row = batch_timings[len(batch_timings) // 2] / len(X_test) * 1e6
+
+    return round(single_row_ms, 3), round(batch_us_per_row, 2)
+
+
+def pareto_frontier(results):
+    """
+    Returns the candidates not dominated on (accuracy, single-row latency):
+    no other candidate is at least as accurate and at least as fast.
+    """
+    frontier = []
+    for r in results:
+        dominated = any(
+            o['accuracy'] >= r['accuracy'] and o['single_row_ms'] <= r['single_row_ms'] and
+            (o['accuracy'] > r['accuracy'] or o['single_row_ms'] < r['single_row_ms'])
+            for o in results
+        )
+        if not dominated:
+            frontier.append(r)
+    return sorted(frontier, key=lambda r: r['single_row_ms'])
+
+
+def select_from_frontier(frontier, max_accuracy_drop):
+    """
+    Picks the fastest frontier model within max_accuracy_drop of the best accuracy.
+    """
+    best_accuracy = max(r['accuracy'] for r in frontier)
+    eligible = [r for r in frontier if r['accuracy'] >= best_accuracy - max_accuracy_drop]
+    return min(eligible, key=lambda r: r['single_row_ms'])
+
+
+def search_models(X, y, families=None, jobs=None, max_accuracy_drop=0.005):
+    """
+    Trains every candidate in parallel processes, benchmarks each one, and
+    selects a model from the latency/accuracy frontier.
+    Returns (selected_model, selected_result, all_results, frontier).
+    """
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=0.2, random_state=42
+    )
+    candidates = build_candidates(families)
+    print(f"\nSearching {len(candidates)} candidates using {jobs or os.cpu_count()} processes...")
+
+    results = []
+    models = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(fit_candidate, family, params, X_train, y_train, X_test, y_test)
+            for family, params in candidates
+        ]
+        for future in as_completed(futures):
+            result, model_bytes = future.result()
+            result['id'] = len(results)
+            models[result['id']] = model_bytes
+            results.append(result)
+
+    # Benchmark sequentially so candidates do not compete for the CPU while timed
+    print("Benchmarking inference latency...")
+    for result in results:
+        model = pickle.loads(models[result['id']])
+        result['single_row_ms'], result['batch_us_per_row'] = measure_latency(model, X_test)
+
+    frontier = pareto_frontier(results)
+    selected = select_from_frontier(frontier, max_accuracy_drop)
+    return pickle.loads(models[selected['id']]), selected, results, frontier
+
+
+def print_search_report(results, frontier, selected):
+    """
+    Prints all candidates sorted by accuracy, marking the frontier and the selection.
+    """
+    frontier_ids = {r['id'] for r in frontier}
+    print(f"\n{'':2} {'Model':<24} {'Accuracy':>8} {'1-row ms':>9} {'Batch µs/row':>13} {'Size KB':>9}  Params")
+    print("-" * 100)
+    for r in sorted(results, key=lambda r: (-r['accuracy'], r['single_row_ms'])):
+        marker = '->' if r['id'] == selected['id'] else ('* ' if r['id'] in frontier_ids else '  ')
+        print(f"{marker} {r['family']:<24} {r['accuracy'] * 100:>7.2f}% {r['single_row_ms']:>9.3f} "
+              f"{r['batch_us_per_row']:>13.2f} {r['size_kb']:>9.1f}  {r['params']}")
+    print("\n* = on the latency/accuracy frontier, -> = selected")
+
+
 # --- 3. Save the Model and Demonstrate Prediction ---
 
 def save_model(model, filename):
@@ -123,18 +329,73 @@ def demonstrate_prediction(model, feature_columns):
     print("---------------------------------")
 
 
+def parse_args():
+    """
+    Command line options for the trainer.
+    """
+    parser = argparse.ArgumentParser(description="Train the AgroSmart crop recommendation model.")
+    parser.add_argument('--dataset', default=DATASET_FILENAME,
+                        help="Path to the crop recommendation CSV (default: %(default)s)")
+    parser.add_argument('--field-data', help="Also train on labeled field readings from this CSV")
+    parser.add_argument('--verbose', action='store_true', help="Print samples of the loaded data")
+    parser.add_argument('--output', default=MODEL_FILENAME,
+                        help="Where to save the trained model (default: %(default)s)")
+    parser.add_argument('--search', action='store_true',
+                        help="Search model families and hyperparameters instead of training the default forest")
+    parser.add_argument('--families', nargs='+', choices=sorted(SEARCH_SPACE),
+                        help="Only search these model families")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Worker processes for the search (default: all CPUs)")
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.005,
+                        help="Accuracy the selected model may give up for speed (default: %(default)s)")
+    parser.add_argument('--report', help="Write the search results to this JSON file")
+    parser.add_argument('--export-c', metavar='HEADER',
+                        help="Also export the forest as a C header for on-device inference (e.g. esp32_firmware/src/crop_model.h)")
+    parser.add_argument('--c-size-budget', type=int, default=DEFAULT_SIZE_BUDGET,
+                        help="Maximum bytes of node tables in the C header; larger forests are compacted (default: %(default)s)")
+    args = parser.parse_args()
+    if args.search and args.export_c:
+        # Only a forest can be exported, so only forests may be selected
+        families = [family for family in (args.families or SEARCH_SPACE) if family in EXPORTABLE_FAMILIES]
+        if not families:
+            parser.error(f"--export-c needs a forest; add one of {', '.join(EXPORTABLE_FAMILIES)} to --families")
+        args.families = families
+    return args
+
+
 # --- Main Execution ---
 if __name__ == "__main__":
+    args = parse_args()
+
     # Step 1: Load and prepare the data from the local file
-    X, y = load_and_prepare_data(DATASET_FILENAME)
+    X, y = load_and_prepare_data(args.dataset, args.field_data, args.verbose)
 
     if X is not None and y is not None:
         # Step 2: Train the model
-        trained_model = train_and_evaluate_model(X, y)
+        if args.search:
+            trained_model, selected, results, frontier = search_models(
+                X, y, families=args.families, jobs=args.jobs, max_accuracy_drop=args.max_accuracy_drop
+            )
+            print_search_report(results, frontier, selected)
+            if args.report:
+                with open(args.report, 'w') as f:
+                    json.dump({'selected': selected, 'frontier': frontier, 'results': results}, f, indent=2)
+                print(f"Search report written to '{args.report}'")
+        else:
+            trained_model = train_and_evaluate_model(X, y)
 
         # Step 3: Save the model for later use
-        MODEL_FILENAME = 'crop_recommendation_model.joblib'
-        save_model(trained_model, MODEL_FILENAME)
+        save_model(trained_model, args.output)
+
+        # Optional: export for on-device inference and check it matches the model
+        if args.export_c and not hasattr(trained_model, 'estimators_'):
+            print(f"\nNot exporting to '{args.export_c}': only tree ensembles can be exported to C, "
+                  f"not {type(trained_model).__name__}")
+        elif args.export_c:
+            summary = export_forest(trained_model, X, args.export_c, args.c_size_budget)
+            agreement, mismatches = verify_header(trained_model, args.export_c, X)
+            print(f"\nExported {summary['trees']} trees ({summary['table_bytes'] / 1024:.1f} KB) to '{args.export_c}'")
+            print(f"C header agrees with the model on {agreement * 100:.2f}% of rows ({mismatches} mismatches)")
 
         # Step 4: Demonstrate how to make a prediction
         # We pass X.columns to ensure the sample DataFrame has the correct feature names
@@ -0,0 +1,222 @@
+"""
+Fertilizer What-If Sweep for AgroSmart
+Answers "how much N/P/K would make crop X recommended here?" by classifying a
+whole N x P x K grid at fixed temperature, humidity and rainfall, then finding
+for every crop the grid point closest to the current nutrients that the model
+recommends it for, and the connected region of the grid around that point.
+
+Classifying ~35k grid points with model.predict() takes ~200 ms. The sweep
+exploits the grid's structure instead: within one tree, all N values that fall
+between the same two N thresholds take the same path (likewise P and K), so
+each tree is only evaluated on one representative point per threshold cell
+(a few hundred points) and the result is broadcast back onto the grid. With
+the temperature/humidity/rainfall fixed the answer is exactly the same as
+model.predict() on the full grid. Votes are counted per class; this equals the
+forest's probability average because fully grown trees have pure leaves (other
+models fall back to a single batched model.predict() over the grid).
+"""
+
+import weakref
+
+import numpy as np
+
+NUTRIENTS = ('N', 'P', 'K')
+CONDITIONS = ('temperature', 'humidity', 'rainfall')
+FEATURE_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
+# Default sweep: the nutrient ranges of the training data, 5 mg/kg apart
+DEFAULT_GRID = {'N': (0, 140, 5), 'P': (5, 145, 5), 'K': (5, 205, 5)}
+MAX_GRID_POINTS = 250000
+
+
+def grid_axis(start, stop, step):
+    """
+    Grid values from start to stop (inclusive), as the float32 values the trees compare
+    """
+    if step <= 0 or stop < start:
+        raise ValueError("Grid needs step > 0 and stop >= start")
+    values = np.arange(start, stop + step / 2, step)
+    return values.astype(np.float32).astype(np.float64)
+
+
+class CompiledForest:
+    """
+    Per-tree thresholds and leaf classes of a fitted random forest, extracted once per model
+    """
+
+    def __init__(self, model):
+        self.model = weakref.ref(model)  # not a strong reference: compile_model's cache is keyed by the model
+        self.classes = np.asarray(model.classes_)
+        names = list(getattr(model, 'feature_names_in_', FEATURE_COLUMNS))
+        self.columns = [names.index(column) for column in FEATURE_COLUMNS]
+        self.trees = []
+        self.exact = hasattr(model, 'estimators_') and all(hasattr(tree, 'tree_') for tree in model.estimators_)
+        if not self.exact:
+            return
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            values = tree.value[:, 0, :]
+            leaves = tree.children_left == -1
+            # Mixed leaves: votes would differ from the averaged probabilities
+            if np.any(values[leaves].max(axis=1) < values[leaves].sum(axis=1) * (1 - 1e-9)):
+                self.exact = False
+                self.trees = []
+                return
+            # The tree's classes are indices into model.classes_
+            leaf_classes = np.argmax(values, axis=1).astype(np.int16)
+            thresholds = [np.unique(tree.threshold[tree.feature == self.columns[axis]]) for axis in range(3)]
+            self.trees.append((tree, leaf_classes, thresholds))
+
+    def classify_grid(self, axes, conditions):
+        """
+        Class index of every grid point, shape (len(N axis), len(P axis), len(K axis))
+        """
+        shape = tuple(len(axis) for axis in axes)
+        if not self.exact:
+            return self._predict_grid(axes, conditions, shape)
+
+        points = int(np.prod(shape))
+        votes = np.zeros(points * len(self.classes), dtype=np.uint8 if len(self.trees) < 256 else np.uint16)
+        offsets = np.arange(points, dtype=np.intp) * len(self.classes)
+        for tree, leaf_classes, thresholds in self.trees:
+            # Per axis: one representative value per threshold cell, and which cell each grid value is in
+            representatives, cells = [], []
+            for axis, values in enumerate(axes):
+                cell = np.searchsorted(thresholds[axis], values, side='left')  # x <= threshold goes left
+                first = np.empty(len(cell), dtype=bool)
+                first[0] = True
+                np.not_equal(cell[1:], cell[:-1], out=first[1:])
+                representatives.append(values[first])
+                cells.append(np.cumsum(first) - 1)
+
+            sizes = tuple(len(values) for values in representatives)
+            X = np.empty(sizes + (len(self.columns),), dtype=np.float32)
+            for axis in range(3):
+                index = [None, None, None]
+                index[axis] = slice(None)
+                X[..., self.columns[axis]] = representatives[axis][tuple(index)]
+            for offset, value in enumerate(conditions):
+                X[..., self.columns[3 + offset]] = value
+
+            classes = leaf_classes[tree.apply(X.reshape(-1, X.shape[-1]))].reshape(sizes)
+            classes = classes.take(cells[0], 0).take(cells[1], 1).take(cells[2], 2)
+            votes[offsets + classes.ravel()] += 1  # each point once per tree, so no index repeats
+
+        return votes.reshape(points, len(self.classes)).argmax(axis=1).reshape(shape)
+
+    def _predict_grid(self, axes, conditions, shape):
+        import pandas as pd
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        X = pd.DataFrame(np.column_stack([grid, np.tile(conditions, (len(grid), 1))]), columns=FEATURE_COLUMNS)
+        predicted = self.model().predict(X)
+        index = {crop: i for i, crop in enumerate(self.classes)}
+        return np.array([index[crop] for crop in predicted]).reshape(shape)
+
+
+_compiled = weakref.WeakKeyDictionary()  # model -> CompiledForest, dropped with the model
+
+
+def compile_model(model):
+    """
+    CompiledForest for `model`, reused for as long as the model is in use
+    """
+    try:
+        return _compiled[model]
+    except KeyError:
+        compiled = _compiled[model] = CompiledForest(model)
+        return compiled
+
+
+def connected_region(mask, seed):
+    """
+    The points of `mask` connected to `seed` through face neighbours. The
+    region is flooded along one axis at a time (every run of mask points it
+    touches joins it), until it stops growing; boxy regions like the trees'
+    take a few rounds.
+    """
+    # Only the bounding box of `mask` can hold the region
+    box = tuple(slice(nonzero[0], nonzero[-1] + 1) for nonzero in
+                (np.flatnonzero(mask.any(axis=tuple(j for j in range(mask.ndim) if j != i)))
+                 for i in range(mask.ndim)))
+    full, mask = mask, mask[box]
+    region = np.zeros_like(mask)
+    region[tuple(index - part.start for index, part in zip(seed, box))] = True
+    count = 1
+    while True:
+        for axis in range(mask.ndim):
+            runs = np.moveaxis(mask, axis, -1)
+            starts = runs.copy()
+            starts[..., 1:] &= ~runs[..., :-1]
+            # Run number of every mask point along this axis (0 outside the mask)
+            ids = np.cumsum(starts.ravel()) * runs.ravel()
+            touched = np.zeros(int(ids.max()) + 1, dtype=bool)
+            touched[ids[np.moveaxis(region, axis, -1).ravel()]] = True
+            touched[0] = False
+            region = np.moveaxis(touched[ids].reshape(runs.shape), -1, axis)
+        grown = int(np.count_nonzero(region))
+        if grown == count:
+            result = np.zeros_like(full)
+            result[box] = region
+            return result
+        count = grown
+
+
+def whatif(model, current, conditions, grid=None, crops=None):
+    """
+    current: {'N', 'P', 'K'} of the field; conditions: (temperature, humidity, rainfall);
+    grid: {'N': (start, stop, step), ...} overrides DEFAULT_GRID.
+    Returns the sweep result with, per reachable crop, the nearest grid point
+    (distance measured in fractions of each nutrient's grid range), the change
+    from the current nutrients, and the bounding box of the connected grid
+    region around that point.
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    axes = [grid_axis(*grid[nutrient]) for nutrient in NUTRIENTS]
+    points = int(np.prod([len(axis) for axis in axes]))
+    if points > MAX_GRID_POINTS:
+        raise ValueError(f"Grid has {points} points; the limit is {MAX_GRID_POINTS} (use larger steps)")
+
+    compiled = compile_model(model)
+    classes = compiled.classify_grid(axes, conditions)
+
+    # Squared distance of every grid point from the current nutrients, per unit of grid range
+    offsets = [(axis - float(current[nutrient])) / max(axis[-1] - axis[0], 1e-9)
+               for nutrient, axis in zip(NUTRIENTS, axes)]
+    distance = offsets[0][:, None, None] ** 2 + offsets[1][None, :, None] ** 2 + offsets[2][None, None, :] ** 2
+
+    results, unreachable = [], []
+    wanted = set(crops) if crops else None
+    for index, crop in enumerate(compiled.classes):
+        crop = str(crop)
+        if wanted is not None and crop not in wanted:
+            continue
+        mask = classes == index
+        if not mask.any():
+            unreachable.append(crop)
+            continue
+
+        nearest = np.unravel_index(np.argmin(np.where(mask, distance, np.inf)), mask.shape)
+        region = connected_region(mask, nearest)
+        bounds = [np.flatnonzero(region.any(axis=tuple(j for j in range(region.ndim) if j != i)))
+                  for i in range(region.ndim)]
+        target = {nutrient: round(float(axes[i][nearest[i]]), 2) for i, nutrient in enumerate(NUTRIENTS)}
+        results.append({
+            'crop': crop,
+            'nearest': target,
+            'change': {nutrient: round(target[nutrient] - float(current[nutrient]), 2) for nutrient in NUTRIENTS},
+            'distance': round(float(np.sqrt(distance[nearest])), 4),
+            'region': dict({nutrient: [round(float(axes[i][bounds[i][0]]), 2),
+                                       round(float(axes[i][bounds[i][-1]]), 2)]
+                            for i, nutrient in enumerate(NUTRIENTS)},
+                           points=int(np.count_nonzero(region))),
+            'grid_share': round(float(mask.mean()), 4)
+        })
+
+    results.sort(key=lambda result: result['distance'])
+    return {
+        'grid': {nutrient: list(grid[nutrient]) for nutrient in NUTRIENTS},
+        'grid_points': points,
+        'exact_fast_path': compiled.exact,
+        'crops': results,
+        'unreachable': unreachable
+    }
@@ -0,0 +1,137 @@
+"""
+Cached Dataset Loading for AgroSmart
+Converts training CSVs (Crop_recommendation.csv, field_data.csv) once into
+compact binary arrays and memory-maps them on later runs, so training and
+evaluation do not re-parse text every time.
+
+Each CSV gets its own cache entry under .dataset_cache/<content hash>/:
+    features.npy  float32 matrix, one column per FEATURE_COLUMNS entry
+    labels.npy    int16 crop codes
+    meta.json     column names and the crop name for each code
+A changed file has a different hash, so stale entries are never used.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+FEATURE_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
+LABEL_COLUMN = 'label'
+DATASET_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dataset_cache')
+CACHE_FORMAT_VERSION = 1
+
+
+def file_content_hash(filename):
+    """
+    BLAKE2 hash of the file contents (streamed, so large files are fine).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(CACHE_FORMAT_VERSION).encode())
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cached_hash(filename, cache_dir):
+    """
+    Returns the content hash, reusing the last computed one while the file's
+    size and modification time are unchanged.
+    """
+    stat = os.stat(filename)
+    index_file = os.path.join(cache_dir, 'index.json')
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    key = os.path.abspath(filename)
+    entry = index.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['hash']
+
+    content_hash = file_content_hash(filename)
+    index[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content_hash}
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_index = f"{index_file}.tmp-{os.getpid()}"
+    with open(temp_index, 'w') as f:
+        json.dump(index, f)
+    os.replace(temp_index, index_file)
+    return content_hash
+
+
+def convert_csv(filename, entry_dir):
+    """
+    Parses the CSV once and writes the binary cache entry.
+    Only the model's feature columns and the label are kept (e.g. 'ph' is dropped).
+    """
+    # Rows being appended while we read (field data) may be incomplete: skip them
+    df = pd.read_csv(filename, usecols=FEATURE_COLUMNS + [LABEL_COLUMN], on_bad_lines='skip')
+    df = df.dropna()
+
+    labels = pd.Categorical(df[LABEL_COLUMN].astype(str).str.strip().str.lower())
+    features = df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+
+    # Write into a temporary directory and rename it into place, so a
+    # concurrent reader never sees a half-written entry
+    temp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    os.makedirs(temp_dir, exist_ok=True)
+    np.save(os.path.join(temp_dir, 'features.npy'), features)
+    np.save(os.path.join(temp_dir, 'labels.npy'), labels.codes.astype(np.int16))
+    with open(os.path.join(temp_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'source': os.path.abspath(filename),
+            'columns': FEATURE_COLUMNS,
+            'classes': list(labels.categories),
+            'rows': len(features)
+        }, f)
+    try:
+        os.replace(temp_dir, entry_dir)
+    except OSError:
+        # Another process published the same entry first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_cached_csv(filename, cache_dir=DATASET_CACHE_DIR):
+    """
+    Returns (features, label_codes, classes) for one CSV, converting it on
+    first use. Arrays are memory-mapped read-only from the cache.
+    """
+    entry_dir = os.path.join(cache_dir, _cached_hash(filename, cache_dir))
+    if not os.path.exists(os.path.join(entry_dir, 'meta.json')):
+        convert_csv(filename, entry_dir)
+
+    with open(os.path.join(entry_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    features = np.load(os.path.join(entry_dir, 'features.npy'), mmap_mode='r')
+    label_codes = np.load(os.path.join(entry_dir, 'labels.npy'), mmap_mode='r')
+    return features, label_codes, meta['classes']
+
+
+def load_dataset(*filenames, cache_dir=DATASET_CACHE_DIR):
+    """
+    Loads one or more CSVs through the cache and stacks them.
+    Returns X (float32 DataFrame with FEATURE_COLUMNS) and y (categorical Series of crop names).
+    """
+    feature_parts = []
+    label_parts = []
+    for filename in filenames:
+        features, label_codes, classes = load_cached_csv(filename, cache_dir)
+        feature_parts.append(features)
+        label_parts.append(pd.Categorical.from_codes(label_codes, categories=classes))
+
+    if len(feature_parts) == 1:
+        features = feature_parts[0]
+        labels = label_parts[0]
+    else:
+        features = np.concatenate(feature_parts)
+        labels = pd.api.types.union_categoricals(label_parts, sort_categories=True)
+
+    X = pd.DataFrame(features, columns=FEATURE_COLUMNS, copy=False)
+    y = pd.Series(labels, name=LABEL_COLUMN)
+    return X, y
@@ -1,10 +1,47 @@
 """
 COM Port Detector for ESP32
 Helps you find which COM port your ESP32 is connected to
+
+detect_devices() probes all USB serial ports at once: each candidate port is
+opened on its own thread and read for at most PROBE_TIMEOUT seconds, and a
+port counts as an AgroSmart board by what it sends (a JSON sensor reading,
+the boot banner or the firmware's ACK/AUTO messages), not by the USB chip's
+description. The result is a device map ranked from most to least certain,
+used by prediction_server.find_esp32_port() and the serial-to-web bridge.
+
+Results are cached in PORT_CACHE_FILE by USB hardware ID (VID:PID and serial
+number), so a known board is found again without probing even if it comes
+back under a different port name, and ports that are known not to be
+AgroSmart boards are not reopened for NEGATIVE_CACHE_TTL seconds (a board
+that was still booting is probed again after that, or as soon as it is
+plugged in again: the connection supervisor calls forget_ports() for new ports).
 """
 
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
 import serial.tools.list_ports
 
+BAUD_RATE = 115200
+PROBE_TIMEOUT = float(os.getenv('AGROSMART_PROBE_TIMEOUT', '3'))
+PORT_CACHE_FILE = os.getenv('AGROSMART_PORT_CACHE',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), '.port_cache.json'))
+NEGATIVE_CACHE_TTL = 120  # seconds before a port that sent nothing recognizable is probed again
+
+# USB-to-serial chips used on ESP32 boards (VID, description keyword); only a ranking hint
+ESP32_USB_CHIPS = {0x10C4: 'CP210', 0x1A86: 'CH340', 0x0403: 'FTDI', 0x303A: 'ESP'}
+SENSOR_KEYS = ('temperature', 'humidity', 'soil_moisture')
+BANNER_MARKERS = ('ESP32 AgroSmart',)
+MESSAGE_PREFIXES = ('ACK: Pump', 'AUTO: Pump', 'DEBUG: Soil Moisture', 'INFO: Returning to automatic mode')
+# Signature -> confidence score (higher is more certain)
+SIGNATURE_SCORES = {'reading': 3, 'banner': 2, 'messages': 1}
+
+_cache_lock = threading.Lock()
+
 def list_com_ports():
     """
     List all available COM ports with details
@@ -43,6 +80,144 @@ def list_com_ports():
     else:
         return ports[0].device if ports else None
 
+def hardware_id(port):
+    """
+    Stable identity of a USB serial device: "VID:PID:serial number" (the port
+    name can change between plug-ins, this does not). None for non-USB ports.
+    """
+    if port.vid is None:
+        return None
+    return f"{port.vid:04X}:{port.pid:04X}:{port.serial_number or port.location or ''}"
+
+def classify_line(line):
+    """
+    Signature of one line from a serial port: 'reading', 'banner', 'messages' or None
+    """
+    if line.startswith('{'):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        return 'reading' if isinstance(data, dict) and all(key in data for key in SENSOR_KEYS) else None
+    if any(marker in line for marker in BANNER_MARKERS):
+        return 'banner'
+    if line.startswith(MESSAGE_PREFIXES):
+        return 'messages'
+    return None
+
+def probe_port(device, timeout=PROBE_TIMEOUT, baudrate=BAUD_RATE):
+    """
+    Listens on one port for up to `timeout` seconds and returns
+    {'signature', 'sample', 'error'}; stops as soon as a sensor reading or the
+    boot banner is seen (opening the port resets most ESP32 boards, so the
+    banner usually arrives within a second or two).
+    """
+    result = {'signature': None, 'sample': None, 'error': None}
+    try:
+        with serial.Serial(device, baudrate, timeout=0.2) as ser:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                line = ser.readline().decode('utf-8', errors='ignore').strip()
+                signature = classify_line(line) if line else None
+                if signature and SIGNATURE_SCORES[signature] > SIGNATURE_SCORES.get(result['signature'], 0):
+                    result.update(signature=signature, sample=line[:120])
+                    if SIGNATURE_SCORES[signature] >= SIGNATURE_SCORES['banner']:
+                        break
+    except (serial.SerialException, OSError) as e:
+        # Busy (e.g. already open in another program) or gone: unknown, not "not a board"
+        result['error'] = str(e)
+    return result
+
+def load_port_cache():
+    try:
+        with open(PORT_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_port_cache(cache):
+    try:
+        with open(PORT_CACHE_FILE + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(PORT_CACHE_FILE + '.tmp', PORT_CACHE_FILE)
+    except OSError:
+        pass  # the cache only saves probing time
+
+def detect_devices(timeout=PROBE_TIMEOUT, use_cache=True, include_non_usb=False):
+    """
+    Ranked device map of the serial ports, AgroSmart boards first:
+    [{'port', 'description', 'hardware_id', 'board', 'signature', 'score', 'known_chip', 'cached', 'sample', 'error'}]
+    Uncached ports are probed in parallel, so the whole scan takes about
+    `timeout` seconds however many ports there are.
+    """
+    ports = [port for port in serial.tools.list_ports.comports()
+             if include_non_usb or port.vid is not None]
+    with _cache_lock:
+        cache = load_port_cache() if use_cache else {}
+    now = time.time()
+
+    devices, to_probe = [], []
+    for port in ports:
+        hwid = hardware_id(port)
+        entry = cache.get(hwid) if hwid else None
+        if entry and (entry['signature'] or now - entry['checked_at'] < NEGATIVE_CACHE_TTL):
+            devices.append({'port': port.device, 'description': port.description, 'hardware_id': hwid,
+                            'signature': entry['signature'], 'sample': entry.get('sample'),
+                            'error': None, 'cached': True})
+        else:
+            to_probe.append(port)
+
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=len(to_probe)) as pool:
+            results = list(pool.map(lambda port: probe_port(port.device, timeout), to_probe))
+        for port, result in zip(to_probe, results):
+            hwid = hardware_id(port)
+            if hwid and result['error'] is None:
+                cache[hwid] = {'signature': result['signature'], 'sample': result['sample'],
+                               'port': port.device, 'checked_at': now}
+            devices.append(dict(result, port=port.device, description=port.description,
+                                hardware_id=hwid, cached=False))
+        with _cache_lock:
+            save_port_cache(dict(load_port_cache(), **cache))
+
+    vids = {port.device: port.vid for port in ports}
+    for device in devices:
+        device['score'] = SIGNATURE_SCORES.get(device['signature'], 0)
+        device['board'] = device['score'] > 0
+        device['known_chip'] = vids.get(device['port']) in ESP32_USB_CHIPS
+    devices.sort(key=lambda device: (device['score'], device['known_chip']), reverse=True)
+    return devices
+
+def find_agrosmart_port(timeout=PROBE_TIMEOUT, use_cache=True):
+    """
+    Port of the most certain AgroSmart board, or None
+    """
+    for device in detect_devices(timeout, use_cache):
+        if device['board']:
+            return device['port']
+    return None
+
+def forget_port(device):
+    """
+    Drops a port's cache entry (e.g. it was cached as a board but no longer
+    sends readings), so the next detect_devices() probes it again
+    """
+    forget_ports([device])
+
+def forget_ports(devices):
+    """
+    forget_port() for several ports (e.g. ones that were just plugged in)
+    """
+    devices = set(devices)
+    ids = {hardware_id(port) for port in serial.tools.list_ports.comports() if port.device in devices}
+    with _cache_lock:
+        cache = load_port_cache()
+        stale = [hwid for hwid, entry in cache.items() if hwid in ids or entry.get('port') in devices]
+        for hwid in stale:
+            del cache[hwid]
+        if stale:
+            save_port_cache(cache)
+
 def test_com_port(port):
     """
     Test if a COM port works with ESP32
@@ -68,9 +243,34 @@ def test_com_port(port):
         print(f"✗ Error testing {port}: {e}")
         return False
 
+def print_device_map(devices):
+    """
+    Prints the ranked device map from detect_devices()
+    """
+    print("\n" + "=" * 60)
+    print("Probed Serial Ports (most likely AgroSmart board first):")
+    print("=" * 60)
+    for device in devices:
+        verdict = f"AgroSmart board ({device['signature']})" if device['board'] else "not recognized"
+        if device['error']:
+            verdict = f"could not open: {device['error']}"
+        print(f"\n  {device['port']}: {verdict}{' [cached]' if device['cached'] else ''}")
+        print(f"   Description: {device['description']}")
+        if device['sample']:
+            print(f"   Sample: {device['sample']}")
+    print("\n" + "=" * 60)
+
 if __name__ == '__main__':
+    import sys
     print("ESP32 COM Port Detector")
-    recommended_port = list_com_ports()
+    if '--probe' in sys.argv:
+        # Probe all USB serial ports at once (add --refresh to ignore the cache)
+        devices = detect_devices(use_cache='--refresh' not in sys.argv)
+        print_device_map(devices)
+        boards = [device['port'] for device in devices if device['board']]
+        recommended_port = boards[0] if boards else None
+    else:
+        recommended_port = list_com_ports()
     
     if recommended_port:
         print(f"\n\nUpdate local_data_collector.py with:")
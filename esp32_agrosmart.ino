@@ -8,6 +8,7 @@ const char* ssid = "AB's Mob";
 const char* password = "Aryanb@05";
 
 // Replace with your PC's local IP address
+// For large fleets, point this at the ingest gateway port instead (AGROSMART_GATEWAY_PORT, e.g. :5001)
 const char* serverUrl = "http://192.168.84.30:5000/predict";
 
 // Sensor Pins
@@ -40,6 +41,9 @@ void setup() {
   Serial.println("\nWiFi connected!");
   Serial.print("IP address: ");
   Serial.println(WiFi.localIP());
+
+  // Keep the HTTP connection open between readings (HTTP keep-alive)
+  http.setReuse(true);
 }
 
 // --- Main Loop (runs repeatedly) ---
@@ -71,6 +75,7 @@ void loop() {
   jsonDoc["humidity"] = humidity;
   jsonDoc["rainfall"] = rainfall;
   jsonDoc["soil_moisture"] = soilMoisturePercent; // Send this for pump logic
+  jsonDoc["device_id"] = WiFi.macAddress(); // Identifies this node to the ingest gateway
 
   String jsonString;
   serializeJson(jsonDoc, jsonString);
@@ -97,7 +102,9 @@ void loop() {
     const char* pumpCommand = responseDoc["pump_command"];
 
     // 5. Control the Pump
-    if (strcmp(pumpCommand, "PUMP_ON") == 0) {
+    if (pumpCommand == nullptr) {
+      Serial.println("No pump command in response (server busy?), keeping pump state");
+    } else if (strcmp(pumpCommand, "PUMP_ON") == 0) {
       Serial.println("Turning pump ON");
       digitalWrite(PUMP_RELAY_PIN, HIGH);
     } else {
@@ -110,7 +117,7 @@ void loop() {
     Serial.println(httpResponseCode);
   }
 
-  http.end();
+  http.end(); // with setReuse(true) the connection stays open for the next reading
 
   // Wait for 30 seconds before sending data again
   delay(30000); 
@@ -1,48 +1,73 @@
-    """
+"""
 ESP32 Serial to Web Bridge
 Reads sensor data from ESP32 via USB serial and provides it to the web frontend
 Includes offline ML prediction using joblib model
 """
 import serial
-import serial.tools.list_ports
-import json
 import time
-import joblib
-import pandas as pd
 from flask import Flask, jsonify
 from flask_cors import CORS
-from threading import Thread
+from threading import Event, Lock, Thread
+from collections import deque
 import sys
 import os
+import logging
+
+# Shared helpers (metrics, logging) live in the project root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metrics import Counter, Gauge, Histogram, install_flask_metrics
+from log_config import setup_logging
+from state_store import VersionedStore
+import detect_com_port
+from sensor_bus import SensorBus
+from serial_supervisor import SerialSupervisor, open_serial_port
+from reading_schema import FEATURE_COLUMNS, ReadingError, feature_row, schema as reading_schema
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend access
 
+# Leveled, rate-limited logging for per-reading messages
+setup_logging()
+logger = logging.getLogger('agrosmart.bridge')
+
+# Prometheus-style metrics, served at GET /metrics (HTTP handler time per route is recorded automatically)
+install_flask_metrics(app)
+SERIAL_LINES = Counter('agrosmart_serial_lines_total', 'Lines read from the ESP32 serial port', ['result'])
+SERIAL_PARSE_SECONDS = Histogram('agrosmart_serial_parse_seconds', 'Time to parse one serial line')
+SERIAL_ERRORS = Counter('agrosmart_serial_errors_total', 'Serial port errors (the read loop retries after each)')
+INFERENCE_SECONDS = Histogram('agrosmart_inference_seconds', 'Crop model prediction time')
+PREDICTIONS = Counter('agrosmart_predictions_total', 'Crop predictions made', ['result'])
+SERIAL_CONNECTED = Gauge('agrosmart_serial_connected', '1 while the ESP32 is sending readings')
+SERIAL_CONNECTED.set_function(lambda: 1 if connection_status == "Connected" else 0)
+
 # Configuration
 ESP32_BAUD_RATE = 115200
 AUTO_DETECT_PORT = True  # Set to False to manually specify COM port
 MANUAL_COM_PORT = "COM5"  # Used if AUTO_DETECT_PORT is False
+# Where readings come from: 'serial' (this process opens the ESP32 and runs the
+# model) or 'bus' (mirror a prediction server started with AGROSMART_SENSOR_BUS=1
+# from shared memory, so both can run on the same board; see sensor_bus.py)
+BRIDGE_SOURCE = os.getenv('AGROSMART_BRIDGE_SOURCE', 'serial')
 
-# Load ML Model
+# ML Model (pandas and scikit-learn are slow to import, so the model is loaded
+# by warm_up() in the background while the API is already serving; set
+# AGROSMART_FAST_START=0 to load it before starting)
 MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'crop_recommendation_model.joblib')
-print("Loading ML model...")
-try:
-    ml_model = joblib.load(MODEL_PATH)
-    print("✓ ML Model loaded successfully")
-except FileNotFoundError:
-    print(f"❌ Model file not found at: {MODEL_PATH}")
-    ml_model = None
-except Exception as e:
-    print(f"❌ Error loading model: {e}")
-    ml_model = None
-
-# Global variables to store latest data
-latest_sensor_data = {
+FAST_START = os.getenv('AGROSMART_FAST_START', '1') == '1'
+ml_model = None
+warmup_status = {"state": "starting", "error": None, "steps_ms": {}, "warmup_seconds": None}
+BRIDGE_STARTED_AT = time.time()
+
+# Latest sensor data, published as immutable versioned snapshots so API
+# requests never see a reading the serial thread is still filling in
+sensor_state = VersionedStore({
     "temperature": 0,
     "humidity": 0,
     "soil_moisture": 0,
     "timestamp": ""
-}
+}, history_limit=0)
+
+# Global variables to store latest data (replaced, never modified in place)
 
 latest_prediction = {
     "crop": "Unknown",
@@ -52,63 +77,130 @@ latest_prediction = {
 
 pump_status = "OFF"
 connection_status = "Disconnected"
+serial_link = None  # SerialSupervisor owning the ESP32's port in 'serial' mode
+serial_write_lock = Lock()
+pending_serial_acks = deque(maxlen=32)  # (command, on_response or None), answered by the reader thread
+PUMP_ACK_TIMEOUT = 2  # seconds to wait for the ESP32's ACK to a pump command
+sensor_bus = None  # attached SensorBus in 'bus' mode
+
+
+def warm_up():
+    """Import pandas/joblib, load the ML model and run one prediction"""
+    global ml_model
+    warmup_status["state"] = "warming_up"
+    started = last = time.perf_counter()
+    
+    def lap(step):
+        nonlocal last
+        now = time.perf_counter()
+        warmup_status["steps_ms"][step] = round((now - last) * 1000, 1)
+        last = now
+    
+    print("Loading ML model...")
+    try:
+        import pandas as pd
+        lap("import_pandas")
+        import joblib
+        lap("import_joblib")
+        loaded_model = joblib.load(MODEL_PATH)
+        lap("load_model")
+        loaded_model.predict(pd.DataFrame([[50, 50, 50, 25.0, 70.0, 100]],
+                                          columns=['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']))
+        lap("first_prediction")
+        
+        ml_model = loaded_model
+        warmup_status["state"] = "ready"
+        print("✓ ML Model loaded successfully")
+    except FileNotFoundError:
+        warmup_status.update(state="failed", error=f"Model file not found at: {MODEL_PATH}")
+        print(f"❌ Model file not found at: {MODEL_PATH}")
+    except Exception as e:
+        warmup_status.update(state="failed", error=str(e))
+        print(f"❌ Error loading model: {e}")
+    warmup_status["warmup_seconds"] = round(time.perf_counter() - started, 2)
 
 
 def find_esp32_port():
-    """Automatically detect ESP32 COM port"""
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        # ESP32 usually shows as "USB Serial" or contains "CP210" or "CH340"
-        if any(x in port.description.upper() for x in ['USB', 'SERIAL', 'CP210', 'CH340', 'UART']):
-            print(f"✓ Found potential ESP32 on {port.device}: {port.description}")
-            return port.device
+    """Automatically detect ESP32 COM port (parallel signature probe, see detect_com_port.py)"""
+    devices = detect_com_port.detect_devices()
+    for device in devices:
+        if device['board']:
+            print(f"✓ Found ESP32 on {device['port']}: {device['description']} ({device['signature']})")
+            return device['port']
+    # Nothing identified itself within the probe timeout: fall back to the USB chip
+    for device in devices:
+        if device['known_chip'] and device['error'] is None:
+            print(f"✓ Found potential ESP32 on {device['port']}: {device['description']}")
+            return device['port']
     return None
 
 
-def read_esp32_serial(ser):
-    """Read and parse JSON data from ESP32"""
-    global latest_sensor_data, latest_prediction, connection_status
+def parse_serial_line(line):
+    """
+    Parse one line from the ESP32 with the shared reading schema (reading_schema.py).
+    Returns the sensor data dict, or None for non-JSON lines; raises
+    ReadingError for readings missing temperature, humidity or soil moisture
+    or with values out of range.
+    """
+    if not line:
+        return None
+    return reading_schema.parse_line(line, 'bridge')
+
+
+def read_esp32_serial():
+    """Read and parse JSON data from ESP32 (serial_link connects and reconnects the port)"""
+    global connection_status
     
     print("📡 Starting to read from ESP32...")
     
     while True:
+        ser = serial_link.wait_connected(timeout=1)
+        if ser is None:
+            connection_status = "Disconnected"
+            continue
         try:
-            if ser.in_waiting > 0:
-                line = ser.readline().decode('utf-8').strip()
-                
-                # Skip empty lines and non-JSON lines
-                if not line or not line.startswith('{'):
-                    if line and not line.startswith('='):  # Print ESP32 messages
-                        print(f"ESP32: {line}")
-                    continue
+            line = ser.readline().decode('utf-8').strip()
+            
+            # Skip empty lines and non-JSON lines
+            if not line or not line.startswith('{'):
+                if line.startswith(('ACK:', 'ERROR:')):
+                    serial_command_answered(line)
+                elif line:
+                    SERIAL_LINES.inc(result='other')
+                    if not line.startswith('='):  # Log ESP32 messages
+                        logger.info("ESP32: %s", line)
+                continue
+            
+            # Parse JSON data
+            try:
+                with SERIAL_PARSE_SECONDS.time():
+                    sensor_data = parse_serial_line(line)
                 
-                # Parse JSON data
-                try:
-                    sensor_data = json.loads(line)
-                    
-                    # Validate required fields
-                    if all(key in sensor_data for key in ['temperature', 'humidity', 'soil_moisture']):
-                        latest_sensor_data = sensor_data
-                        latest_sensor_data['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
-                        connection_status = "Connected"
-                        
-                        print(f"📊 Sensor Data: T={sensor_data['temperature']}°C, "
-                              f"H={sensor_data['humidity']}%, "
-                              f"SM={sensor_data['soil_moisture']}%")
-                        
-                        # Send to prediction server
-                        get_crop_prediction(sensor_data)
+                if sensor_data is not None:
+                    SERIAL_LINES.inc(result='reading')
+                    sensor_data['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                    sensor_state.publish(sensor_data, add_to_history=False)
+                    connection_status = "Connected"
                     
-                except json.JSONDecodeError as e:
-                    print(f"⚠️  JSON parse error: {e}")
+                    logger.info("📊 Sensor Data: T=%s°C, H=%s%%, SM=%s%%",
+                                sensor_data['temperature'], sensor_data['humidity'], sensor_data['soil_moisture'])
                     
+                    # Send to prediction server
+                    get_crop_prediction(sensor_data)
+                
+            except ReadingError as e:
+                SERIAL_LINES.inc(result='invalid_json' if 'reading' in e.errors else 'rejected')
+                logger.warning("⚠️  %s", e)
+                
         except serial.SerialException as e:
-            print(f"❌ Serial error: {e}")
+            SERIAL_ERRORS.inc()
+            logger.error("❌ Serial error: %s", e)
             connection_status = "Disconnected"
-            time.sleep(2)
+            # The supervisor reopens the port (with backoff) and hands it back via wait_connected()
+            serial_link.report_failure(ser, e)
             
         except Exception as e:
-            print(f"❌ Unexpected error: {e}")
+            logger.error("❌ Unexpected error: %s", e)
             time.sleep(1)
 
 
@@ -117,32 +209,27 @@ def get_crop_prediction(sensor_data):
     global latest_prediction
     
     if ml_model is None:
-        print("⚠️  ML Model not loaded")
+        warming_up = warmup_status["state"] in ("starting", "warming_up")
+        if not warming_up:
+            logger.warning("⚠️  ML Model not loaded")
         latest_prediction = {
-            "crop": "Model not loaded",
+            "crop": "Model warming up" if warming_up else "Model not loaded",
             "confidence": 0,
             "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
         }
         return
     
+    import pandas as pd
     try:
         # Prepare features for ML model
         # Model expects: ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
-        features = {
-            "N": 50,  # Default Nitrogen value (can be adjusted)
-            "P": 50,  # Default Phosphorus value
-            "K": 50,  # Default Potassium value
-            "temperature": sensor_data['temperature'],
-            "humidity": sensor_data['humidity'],
-            "rainfall": 100  # Default rainfall value
-        }
-        
-        # Create DataFrame with correct column order
-        feature_columns = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
-        df = pd.DataFrame([features], columns=feature_columns)
+        # (values the ESP32 did not send carry the schema's documented defaults)
+        df = pd.DataFrame([feature_row(sensor_data)], columns=FEATURE_COLUMNS)
         
         # Make prediction
-        crop_prediction = ml_model.predict(df)[0]
+        with INFERENCE_SECONDS.time():
+            crop_prediction = ml_model.predict(df)[0]
+        PREDICTIONS.inc(result='ok')
         
         # Update latest prediction
         latest_prediction = {
@@ -151,10 +238,11 @@ def get_crop_prediction(sensor_data):
             "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
         }
         
-        print(f"🌱 Predicted Crop: {crop_prediction}")
+        logger.debug("🌱 Predicted Crop: %s", crop_prediction)
         
     except Exception as e:
-        print(f"❌ Prediction error: {e}")
+        PREDICTIONS.inc(result='error')
+        logger.error("❌ Prediction error: %s", e)
         latest_prediction = {
             "crop": "Error",
             "confidence": 0,
@@ -162,11 +250,56 @@ def get_crop_prediction(sensor_data):
         }
 
 
+def follow_sensor_bus():
+    """Mirror the latest reading and prediction from the prediction server's sensor bus"""
+    global sensor_bus, latest_prediction, pump_status, connection_status
+    sequence = 0
+    
+    while True:
+        if sensor_bus is None or not sensor_bus.owner_alive():
+            # Not started yet, or the prediction server restarted with a new block
+            if sensor_bus is not None:
+                sensor_bus.close()
+                sensor_bus = None
+                connection_status = "Disconnected"
+            try:
+                sensor_bus = SensorBus.attach()
+                sequence = max(0, sensor_bus.sequence - 1)
+                logger.info("Attached to the sensor bus (%s readings published so far)", sensor_bus.sequence)
+            except (FileNotFoundError, ValueError):
+                time.sleep(2)
+                continue
+        
+        current = sensor_bus.wait_for(sequence, timeout=1)
+        if current == sequence:
+            continue
+        sequence = current
+        reading = sensor_bus.latest()
+        if reading is None:
+            continue
+        
+        sensor_state.publish({
+            "temperature": reading["temperature"],
+            "humidity": reading["humidity"],
+            "soil_moisture": reading["soil_moisture"],
+            "timestamp": reading["timestamp"]
+        }, add_to_history=False)
+        if reading["recommended_crop"]:
+            latest_prediction = {
+                "crop": reading["recommended_crop"],
+                "confidence": round(reading["confidence"] * 100) if reading["confidence"] is not None else 0,
+                "timestamp": reading["timestamp"]
+            }
+        if reading["pump_command"]:
+            pump_status = "ON" if reading["pump_command"] == "PUMP_ON" else "OFF"
+        connection_status = "Connected"
+
+
 # Flask API endpoints for frontend
 @app.route('/api/sensor-data', methods=['GET'])
 def get_sensor_data():
     """Get latest sensor data"""
-    return jsonify(latest_sensor_data)
+    return jsonify(sensor_state.snapshot.latest)
 
 
 @app.route('/api/prediction', methods=['GET'])
@@ -181,6 +314,7 @@ def get_status():
     return jsonify({
         "connection": connection_status,
         "pump": pump_status,
+        "serial": serial_link.status() if serial_link is not None else None,
         "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
     })
 
@@ -190,32 +324,45 @@ def control_pump(action):
     """Control water pump (ON/OFF)"""
     global pump_status
     
-    try:
-        if action.upper() in ['ON', 'OFF']:
-            command = f"PUMP_{action.upper()}\n"
-            ser.write(command.encode())
-            
-            # Wait for acknowledgment
-            time.sleep(0.5)
-            response = ser.readline().decode('utf-8').strip()
-            
-            if "ACK" in response:
-                pump_status = action.upper()
-                return jsonify({"success": True, "status": pump_status, "message": response})
-            else:
-                return jsonify({"success": False, "message": response}), 400
-        else:
-            return jsonify({"success": False, "message": "Invalid action. Use ON or OFF"}), 400
-            
-    except Exception as e:
-        return jsonify({"success": False, "message": str(e)}), 500
+    if BRIDGE_SOURCE == 'bus':
+        return jsonify({"success": False,
+                        "message": "The prediction server owns the serial port; use its /api/pump/control"}), 409
+    if action.upper() not in ['ON', 'OFF']:
+        return jsonify({"success": False, "message": "Invalid action. Use ON or OFF"}), 400
+    
+    # The reader thread owns the port's input and hands us the ESP32's reply
+    answered = Event()
+    reply = {}
+    
+    def on_response(line):
+        reply["line"] = line
+        answered.set()
+    
+    if not send_serial_command(f"PUMP_{action.upper()}", on_response):
+        return jsonify({"success": False, "message": "ESP32 not connected"}), 503
+    if not answered.wait(PUMP_ACK_TIMEOUT):
+        return jsonify({"success": False, "message": "No response from ESP32"}), 504
+    
+    response = reply["line"]
+    if response.startswith("ACK:"):
+        pump_status = action.upper()
+        return jsonify({"success": True, "status": pump_status, "message": response})
+    return jsonify({"success": False, "message": response}), 400
+
+
+@app.route('/api/ready', methods=['GET'])
+def get_readiness():
+    """Readiness probe: 200 once the ML model is loaded, 503 before (or if loading failed)"""
+    status = dict(warmup_status, ready=ml_model is not None or sensor_bus is not None,
+                  uptime_seconds=round(time.time() - BRIDGE_STARTED_AT, 1))
+    return jsonify(status), 200 if status["ready"] else 503
 
 
 @app.route('/api/all', methods=['GET'])
 def get_all_data():
     """Get all data in one request"""
     return jsonify({
-        "sensor_data": latest_sensor_data,
+        "sensor_data": sensor_state.snapshot.latest,
         "prediction": latest_prediction,
         "status": {
             "connection": connection_status,
@@ -224,42 +371,89 @@ def get_all_data():
     })
 
 
-def main():
-    """Main function"""
-    global ser
-    
-    print("=" * 50)
-    print("  ESP32 Serial to Web Bridge")
-    print("=" * 50)
+def open_esp32_port(port):
+    """Open the ESP32's port (called by the connection supervisor)"""
+    try:
+        return open_serial_port(port)
+    except serial.SerialException:
+        # Probe it again next time instead of trusting the cached result
+        detect_com_port.forget_port(port)
+        raise
+
+
+def send_serial_command(command, on_response=None):
+    """
+    Writes one command line to the ESP32; the reader thread calls
+    on_response(line) with its ACK:/ERROR: reply. Returns False if the ESP32
+    is not connected.
+    """
+    ser = serial_link.current() if serial_link is not None else None
+    if ser is None:
+        return False
+    with serial_write_lock:
+        try:
+            ser.write(f"{command}\n".encode())
+        except (serial.SerialException, OSError) as e:
+            serial_link.report_failure(ser, e)
+            return False
+        pending_serial_acks.append((command, on_response))
+    return True
+
+
+def serial_command_answered(line):
+    """Called by the reader thread for ACK:/ERROR: lines"""
+    try:
+        command, on_response = pending_serial_acks.popleft()
+    except IndexError:
+        return
+    logger.info("ESP32 response to %s: %s", command, line)
+    if on_response is not None:
+        on_response(line)
+
+
+def esp32_connected(port):
+    """Commands sent over the previous connection will never be answered"""
+    pending_serial_acks.clear()
+
+
+def start_serial_source():
+    """Loads the model, starts the ESP32 connection supervisor and the serial reading thread"""
+    global serial_link
     
-    # 1. Detect COM port
-    if AUTO_DETECT_PORT:
-        com_port = find_esp32_port()
-        if not com_port:
-            print("\n❌ Could not auto-detect ESP32.")
-            print("📝 Available ports:")
-            for port in serial.tools.list_ports.comports():
-                print(f"   - {port.device}: {port.description}")
-            print(f"\n💡 Set AUTO_DETECT_PORT=False and specify MANUAL_COM_PORT in the script")
-            return
+    # Load the ML model in the background (or now, without FAST_START)
+    if FAST_START:
+        Thread(target=warm_up, daemon=True).start()
     else:
-        com_port = MANUAL_COM_PORT
+        warm_up()
     
-    print(f"\n✓ Using COM port: {com_port}")
+    # 1. Detect COM port (probed again when the port list changes) or use the fixed one
+    find_port = find_esp32_port if AUTO_DETECT_PORT else (lambda: MANUAL_COM_PORT)
     
-    # 2. Connect to ESP32
-    try:
-        ser = serial.Serial(com_port, ESP32_BAUD_RATE, timeout=1)
-        print(f"✓ Connected to ESP32 at {ESP32_BAUD_RATE} baud")
-        time.sleep(2)  # Wait for ESP32 to reset
-    except serial.SerialException as e:
-        print(f"❌ Failed to connect to {com_port}: {e}")
-        return
+    # 2. Connect to ESP32 in the background; the supervisor reconnects with
+    # backoff whenever the port fails or is unplugged, and as soon as a board
+    # is plugged in (GET /api/status reports the connection)
+    serial_link = SerialSupervisor(find_port, open_esp32_port, on_connect=esp32_connected,
+                                   on_plugged=detect_com_port.forget_ports).start()
+    print("Connecting to ESP32 in the background (GET /api/status reports the connection)")
     
     # 3. Start serial reading thread
-    serial_thread = Thread(target=read_esp32_serial, args=(ser,), daemon=True)
+    serial_thread = Thread(target=read_esp32_serial, daemon=True)
     serial_thread.start()
     print("✓ Serial reading thread started")
+
+
+def main():
+    """Main function"""
+    print("=" * 50)
+    print("  ESP32 Serial to Web Bridge")
+    print("=" * 50)
+    
+    if BRIDGE_SOURCE == 'bus':
+        # Readings and predictions come from the prediction server's shared memory
+        Thread(target=follow_sensor_bus, daemon=True).start()
+        print("✓ Following the prediction server's sensor bus (no serial port or model needed)")
+    else:
+        start_serial_source()
     
     # 4. Start Flask API server
     print("\n" + "=" * 50)
@@ -270,6 +464,8 @@ def main():
     print("  Status:       http://localhost:3001/api/status")
     print("  All Data:     http://localhost:3001/api/all")
     print("  Pump Control: http://localhost:3001/api/pump/ON or /OFF")
+    print("  Metrics:      http://localhost:3001/metrics")
+    print("  Readiness:    http://localhost:3001/api/ready")
     print("=" * 50)
     print("\n✓ Frontend can now fetch data from these endpoints")
     print("✓ Press Ctrl+C to stop\n")
@@ -278,8 +474,9 @@ def main():
         app.run(host='0.0.0.0', port=3001, debug=False)
     except KeyboardInterrupt:
         print("\n\n🛑 Shutting down...")
-        ser.close()
-        print("✓ Serial port closed")
+        if serial_link is not None:
+            serial_link.close()
+            print("✓ Serial port closed")
 
 
 if __name__ == "__main__":
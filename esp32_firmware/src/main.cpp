@@ -1,6 +1,14 @@
 #include <ArduinoJson.h>
 #include <DHT.h>
 
+// On-device crop recommendation: generate the header with
+//   python forest_export.py
+// (writes src/crop_model.h). Without it the PC server does the prediction.
+#if __has_include("crop_model.h")
+#include "crop_model.h"
+#define HAS_CROP_MODEL 1
+#endif
+
 // --- Configuration ---
 // No WiFi needed - using USB serial communication
 
@@ -20,6 +28,16 @@ bool autoMode = false;  // Start in MANUAL mode for testing
 unsigned long manualModeTimeout = 0;
 const unsigned long MANUAL_TIMEOUT = 300000; // 5 minutes in milliseconds
 
+// Relay pin per irrigation zone (zone 1 is the main pump). The server's
+// irrigation controller addresses zone N with "PUMP_ON:N" / "PUMP_OFF:N";
+// plain "PUMP_ON" / "PUMP_OFF" switch zone 1.
+const int ZONE_RELAY_PINS[] = {PUMP_RELAY_PIN};
+const int ZONE_COUNT = sizeof(ZONE_RELAY_PINS) / sizeof(ZONE_RELAY_PINS[0]);
+
+// Reading sequence number, sent with the sample time (millis) so the PC can
+// trace each reading's latency from sensor to dashboard and spot dropped lines
+unsigned long readingSeq = 0;
+
 // --- Setup Function (runs once) ---
 void setup() {
   Serial.begin(115200);
@@ -31,8 +49,10 @@ void setup() {
   dht.begin();
   delay(2000); // Give DHT11 time to stabilize (important!)
   
-  pinMode(PUMP_RELAY_PIN, OUTPUT);
-  digitalWrite(PUMP_RELAY_PIN, LOW); // LOW = OFF (for ACTIVE-HIGH relay that needs HIGH to trigger)
+  for (int i = 0; i < ZONE_COUNT; i++) {
+    pinMode(ZONE_RELAY_PINS[i], OUTPUT);
+    digitalWrite(ZONE_RELAY_PINS[i], LOW); // LOW = OFF (for ACTIVE-HIGH relay that needs HIGH to trigger)
+  }
   
   Serial.println("DHT11 sensor initialized");
   Serial.println("Pump relay initialized (OFF)");
@@ -50,6 +70,60 @@ void setup() {
   Serial.println("Waiting for commands from PC...\n");
 }
 
+// --- Commands from the PC (one per line) ---
+void checkSerialCommands() {
+  if (Serial.available() <= 0) {
+    return;
+  }
+  String command = Serial.readStringUntil('\n');
+  command.trim();
+  
+  // Optional zone suffix: "PUMP_ON:2" switches zone 2
+  int zone = 1;
+  int separator = command.indexOf(':');
+  if (separator > 0) {
+    zone = command.substring(separator + 1).toInt();
+    command = command.substring(0, separator);
+  }
+  if (zone < 1 || zone > ZONE_COUNT) {
+    Serial.print("ERROR: Unknown zone: ");
+    Serial.println(zone);
+    return;
+  }
+  int relayPin = ZONE_RELAY_PINS[zone - 1];
+  
+  // Manual commands - ACTIVE-HIGH relay (HIGH=ON, LOW=OFF)
+  if (command == "PUMP_ON") {
+    autoMode = false;
+    manualModeTimeout = millis() + MANUAL_TIMEOUT;
+    digitalWrite(relayPin, HIGH);  // Turn pump ON (active-HIGH)
+    Serial.print("ACK: Pump turned ON (manual mode), zone ");
+    Serial.println(zone);
+  } 
+  else if (command == "PUMP_OFF") {
+    autoMode = false;
+    manualModeTimeout = millis() + MANUAL_TIMEOUT;
+    digitalWrite(relayPin, LOW);   // Turn pump OFF (active-HIGH)
+    Serial.print("ACK: Pump turned OFF (manual mode), zone ");
+    Serial.println(zone);
+  }
+  else if (command == "AUTO_MODE") {
+    autoMode = true;
+    manualModeTimeout = 0;  // Clear manual mode timeout
+    Serial.println("ACK: Switched to automatic mode");
+  }
+  else if (command == "STATUS") {
+    Serial.print("ACK: Pump is ");
+    Serial.print((digitalRead(PUMP_RELAY_PIN) == HIGH) ? "ON" : "OFF");
+    Serial.print(", Mode: ");
+    Serial.println(autoMode ? "AUTO" : "MANUAL");
+  }
+  else {
+    Serial.print("ERROR: Unknown command: ");
+    Serial.println(command);
+  }
+}
+
 // --- Main Loop (runs repeatedly) ---
 void loop() {
   // 1. Read Sensor Data
@@ -59,6 +133,7 @@ void loop() {
   float temperature = dht.readTemperature(); // in Celsius
   
   int soilMoistureRaw = analogRead(SOIL_PIN);
+  unsigned long sampledAt = millis();  // Device time of this sample
   
   // Convert raw soil moisture to percentage (0-100%)
   // FLIPPED LOGIC: Your sensor reads LOWER values (~2800-3000) in DRY conditions
@@ -101,7 +176,9 @@ void loop() {
   }
 
   // 2. Create JSON payload with sensor data
-  StaticJsonDocument<256> jsonDoc;
+  StaticJsonDocument<384> jsonDoc;
+  jsonDoc["seq"] = readingSeq++;
+  jsonDoc["uptime_ms"] = sampledAt;
   jsonDoc["temperature"] = temperature;
   jsonDoc["humidity"] = humidity;
   jsonDoc["soil_moisture"] = soilMoisturePercent;
@@ -110,10 +187,20 @@ void loop() {
   // NPK values - using reasonable defaults for now (NPK sensor is expensive)
   // In production, these would come from an NPK sensor
   // These represent moderate soil nutrient levels suitable for most crops
-  jsonDoc["N"] = 40;  // Nitrogen (mg/kg) - moderate level
-  jsonDoc["P"] = 30;  // Phosphorus (mg/kg) - moderate level
-  jsonDoc["K"] = 35;  // Potassium (mg/kg) - moderate level
-  jsonDoc["rainfall"] = 0;  // Rainfall (mm) - can be updated from weather API
+  const float nitrogen = 40;    // Nitrogen (mg/kg) - moderate level
+  const float phosphorus = 30;  // Phosphorus (mg/kg) - moderate level
+  const float potassium = 35;   // Potassium (mg/kg) - moderate level
+  const float rainfall = 0;     // Rainfall (mm) - can be updated from weather API
+  jsonDoc["N"] = nitrogen;
+  jsonDoc["P"] = phosphorus;
+  jsonDoc["K"] = potassium;
+  jsonDoc["rainfall"] = rainfall;
+
+#ifdef HAS_CROP_MODEL
+  // Same feature order as the Python model: N, P, K, temperature, humidity, rainfall
+  float cropFeatures[CROP_MODEL_N_FEATURES] = {nitrogen, phosphorus, potassium, temperature, humidity, rainfall};
+  jsonDoc["device_crop"] = crop_model_predict_name(cropFeatures);
+#endif
 
   // Print debug info for soil moisture calibration
   Serial.print("DEBUG: Soil Moisture Raw=");
@@ -159,40 +246,13 @@ void loop() {
   Serial.println(); // End of JSON line
 
   // 4. Check for commands from PC via Serial
-  if (Serial.available() > 0) {
-    String command = Serial.readStringUntil('\n');
-    command.trim();
-    
-    // Manual commands - ACTIVE-HIGH relay (HIGH=ON, LOW=OFF)
-    if (command == "PUMP_ON") {
-      autoMode = false;
-      manualModeTimeout = millis() + MANUAL_TIMEOUT;
-      digitalWrite(PUMP_RELAY_PIN, HIGH);  // Turn pump ON (active-HIGH)
-      Serial.println("ACK: Pump turned ON (manual mode)");
-    } 
-    else if (command == "PUMP_OFF") {
-      autoMode = false;
-      manualModeTimeout = millis() + MANUAL_TIMEOUT;
-      digitalWrite(PUMP_RELAY_PIN, LOW);   // Turn pump OFF (active-HIGH)
-      Serial.println("ACK: Pump turned OFF (manual mode)");
-    }
-    else if (command == "AUTO_MODE") {
-      autoMode = true;
-      manualModeTimeout = 0;  // Clear manual mode timeout
-      Serial.println("ACK: Switched to automatic mode");
-    }
-    else if (command == "STATUS") {
-      Serial.print("ACK: Pump is ");
-      Serial.print((digitalRead(PUMP_RELAY_PIN) == HIGH) ? "ON" : "OFF");
-      Serial.print(", Mode: ");
-      Serial.println(autoMode ? "AUTO" : "MANUAL");
-    }
-    else {
-      Serial.print("ERROR: Unknown command: ");
-      Serial.println(command);
-    }
-  }
+  checkSerialCommands();
 
-  // Wait 5 seconds before next reading
-  delay(5000);
+  // Wait 5 seconds before next reading, answering PC commands as they arrive
+  // so pump commands take effect within ~10 ms instead of after the next reading
+  unsigned long waitStart = millis();
+  while (millis() - waitStart < 5000) {
+    checkSerialCommands();
+    delay(10);
+  }
 }
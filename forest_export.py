@@ -0,0 +1,363 @@
+"""
+Random Forest to C Exporter for AgroSmart
+Turns the trained crop model into a self-contained C header so the ESP32 can
+recommend crops on-device, without streaming readings to a PC.
+
+- Thresholds are fixed-point integers: each feature is multiplied by its
+  FEATURE_SCALES entry and rounded, so the device only does integer compares.
+- Every tree is stored as flat node arrays; child indices < 0 are leaves
+  holding the majority crop (-1 - index), and the forest takes a majority vote.
+- If the forest is over the size budget, trees are picked greedily to keep
+  agreement with the full forest as high as possible (compaction).
+
+The harness (verify_header) parses the generated header back and runs it in
+Python on the full dataset, reporting how often it agrees with the joblib model.
+"""
+
+import argparse
+import re
+
+import joblib
+import numpy as np
+
+from dataset_cache import FEATURE_COLUMNS, load_dataset
+
+# Fixed-point scale per feature (same order as FEATURE_COLUMNS):
+# NPK are whole mg/kg, the rest keep two decimals
+FEATURE_SCALES = [1, 1, 1, 100, 100, 100]
+DEFAULT_SIZE_BUDGET = 64 * 1024  # bytes of node tables
+HEADER_FILENAME = 'esp32_firmware/src/crop_model.h'
+
+
+def quantize_features(X, scales=FEATURE_SCALES):
+    """
+    Converts float features to the device's fixed-point integers.
+    """
+    return np.rint(np.asarray(X, dtype=np.float64) * np.asarray(scales)).astype(np.int64)
+
+
+def quantize_threshold(threshold, scale):
+    """
+    Largest fixed-point value that still goes left (x <= threshold).
+    """
+    return int(np.floor(threshold * scale))
+
+
+def tree_leaf_classes(tree):
+    """
+    Majority class of every node of a fitted sklearn tree.
+    """
+    return np.argmax(tree.tree_.value[:, 0, :], axis=1)
+
+
+C_TYPE_SIZES = {'int8_t': 1, 'int16_t': 2, 'int32_t': 4}
+
+
+def tree_threshold_size(tree, scales=FEATURE_SCALES):
+    """
+    Bytes per threshold the tree needs: the size of the smallest C type that
+    holds its quantized thresholds.
+    """
+    tree = tree.tree_
+    internal = np.flatnonzero(tree.children_left >= 0)
+    thresholds = [quantize_threshold(tree.threshold[node], scales[tree.feature[node]]) for node in internal]
+    return C_TYPE_SIZES[c_int_type(thresholds)]
+
+
+def forest_table_size(n_nodes, n_trees, n_classes, threshold_size):
+    """
+    Bytes of node tables for a forest of `n_trees` trees with `n_nodes`
+    internal nodes in all, with the integer types generate_header() picks:
+    feature (1) + threshold + two children per node, plus one root per tree.
+    """
+    child_size = C_TYPE_SIZES[c_int_type([n_nodes - 1, -n_classes])]
+    return n_nodes * (1 + threshold_size + 2 * child_size) + n_trees * child_size
+
+
+def compact_forest(model, X, size_budget=DEFAULT_SIZE_BUDGET):
+    """
+    Chooses which trees to export when the whole forest does not fit.
+    Trees are added one at a time, each time taking the tree that best
+    keeps the majority vote in line with the full forest's predictions.
+    Returns the selected tree indices (all trees if they fit).
+    """
+    trees = model.estimators_
+    n_classes = len(model.classes_)
+    nodes = [int(np.sum(tree.tree_.children_left >= 0)) for tree in trees]
+    threshold_sizes = [tree_threshold_size(tree) for tree in trees]
+
+    def table_size(n_nodes, n_trees, threshold_size):
+        return forest_table_size(n_nodes, n_trees, n_classes, threshold_size)
+
+    if table_size(sum(nodes), len(trees), max(threshold_sizes, default=1)) <= size_budget:
+        return list(range(len(trees)))
+
+    X = np.asarray(X, dtype=np.float32)
+    target = np.searchsorted(model.classes_, model.predict(X))
+    tree_votes = np.array([tree_leaf_classes(tree)[tree.tree_.apply(X)] for tree in trees])
+
+    selected = []
+    votes = np.zeros((len(X), n_classes), dtype=np.int32)
+    used_nodes, threshold_size = 0, 1
+    remaining = set(range(len(trees)))
+    rows = np.arange(len(X))
+
+    while remaining:
+        best, best_agreement = None, -1
+        for index in remaining:
+            if table_size(used_nodes + nodes[index], len(selected) + 1,
+                          max(threshold_size, threshold_sizes[index])) > size_budget:
+                continue
+            trial = votes.copy()
+            trial[rows, tree_votes[index]] += 1
+            agreement = np.mean(np.argmax(trial, axis=1) == target)
+            if agreement > best_agreement:
+                best, best_agreement = index, agreement
+        if best is None:
+            break
+        selected.append(best)
+        remaining.remove(best)
+        votes[rows, tree_votes[best]] += 1
+        used_nodes += nodes[best]
+        threshold_size = max(threshold_size, threshold_sizes[best])
+
+    return sorted(selected)
+
+
+def flatten_forest(model, tree_indices, scales=FEATURE_SCALES):
+    """
+    Packs the selected trees into flat arrays shared by all trees.
+    Returns a dict with roots, feature, threshold, left and right arrays.
+    """
+    roots, features, thresholds, lefts, rights = [], [], [], [], []
+
+    for tree_index in tree_indices:
+        tree = model.estimators_[tree_index].tree_
+        leaf_classes = tree_leaf_classes(model.estimators_[tree_index])
+        internal = np.flatnonzero(tree.children_left >= 0)
+        offset = len(features)
+        new_index = {node: offset + i for i, node in enumerate(internal)}
+
+        def encode(node):
+            if tree.children_left[node] < 0:
+                return -1 - int(leaf_classes[node])
+            return new_index[node]
+
+        roots.append(encode(0))
+        for node in internal:
+            feature = int(tree.feature[node])
+            features.append(feature)
+            thresholds.append(quantize_threshold(tree.threshold[node], scales[feature]))
+            lefts.append(encode(tree.children_left[node]))
+            rights.append(encode(tree.children_right[node]))
+
+    return {
+        'roots': roots,
+        'feature': features,
+        'threshold': thresholds,
+        'left': lefts,
+        'right': rights
+    }
+
+
+def c_int_type(values):
+    """
+    Smallest signed C integer type that holds all values.
+    """
+    low, high = min(values, default=0), max(values, default=0)
+    if -128 <= low and high <= 127:
+        return 'int8_t'
+    if -32768 <= low and high <= 32767:
+        return 'int16_t'
+    return 'int32_t'
+
+
+def format_c_array(c_type, name, values, per_line=16):
+    """
+    Formats a static const C array.
+    """
+    lines = []
+    for start in range(0, len(values), per_line):
+        lines.append("  " + ", ".join(str(v) for v in values[start:start + per_line]) + ",")
+    body = "\n".join(lines) if lines else "  0"
+    return f"static const {c_type} {name}[{max(len(values), 1)}] = {{\n{body}\n}};\n"
+
+
+def generate_header(model, tables, scales=FEATURE_SCALES):
+    """
+    Renders the C header for the flattened forest.
+    """
+    classes = [str(c) for c in model.classes_]
+    child_type = c_int_type(tables['left'] + tables['right'] + tables['roots'])
+    threshold_type = c_int_type(tables['threshold'])
+    n_classes = len(classes)
+    class_names = ",\n".join(f'  "{name}"' for name in classes)
+
+    return f"""// Crop recommendation forest for on-device inference.
+// Generated by forest_export.py -- do not edit by hand.
+//
+// Usage:
+//   float features[CROP_MODEL_N_FEATURES] = {{N, P, K, temperature, humidity, rainfall}};
+//   const char *crop = crop_model_predict_name(features);
+#ifndef CROP_MODEL_H
+#define CROP_MODEL_H
+
+#include <stdint.h>
+#include <math.h>
+
+#define CROP_MODEL_N_FEATURES {len(FEATURE_COLUMNS)}
+#define CROP_MODEL_N_CLASSES {n_classes}
+#define CROP_MODEL_N_TREES {len(tables['roots'])}
+#define CROP_MODEL_N_NODES {len(tables['feature'])}
+
+// Feature order: {", ".join(FEATURE_COLUMNS)}
+// Fixed-point scale: feature value x becomes lroundf(x * scale)
+{format_c_array('int32_t', 'crop_model_feature_scale', list(scales))}
+static const char *const crop_model_classes[CROP_MODEL_N_CLASSES] = {{
+{class_names}
+}};
+
+// Child/root index >= 0 is an internal node, < 0 is a leaf with class (-1 - index)
+{format_c_array(child_type, 'crop_model_roots', tables['roots'])}
+{format_c_array('uint8_t', 'crop_model_feature', tables['feature'])}
+{format_c_array(threshold_type, 'crop_model_threshold', tables['threshold'])}
+{format_c_array(child_type, 'crop_model_left', tables['left'])}
+{format_c_array(child_type, 'crop_model_right', tables['right'])}
+// Returns the class index for fixed-point features (majority vote over all trees)
+static inline int crop_model_predict(const int32_t *x)
+{{
+  uint16_t votes[CROP_MODEL_N_CLASSES] = {{0}};
+  for (int t = 0; t < CROP_MODEL_N_TREES; t++) {{
+    int32_t node = crop_model_roots[t];
+    while (node >= 0) {{
+      node = (x[crop_model_feature[node]] <= crop_model_threshold[node])
+          ? crop_model_left[node] : crop_model_right[node];
+    }}
+    votes[-1 - node]++;
+  }}
+  int best = 0;
+  for (int c = 1; c < CROP_MODEL_N_CLASSES; c++) {{
+    if (votes[c] > votes[best]) best = c;
+  }}
+  return best;
+}}
+
+// Quantizes float features and returns the recommended crop name
+static inline const char *crop_model_predict_name(const float *features)
+{{
+  int32_t x[CROP_MODEL_N_FEATURES];
+  for (int f = 0; f < CROP_MODEL_N_FEATURES; f++) {{
+    x[f] = (int32_t)lroundf(features[f] * crop_model_feature_scale[f]);
+  }}
+  return crop_model_classes[crop_model_predict(x)];
+}}
+
+#endif  // CROP_MODEL_H
+"""
+
+
+def header_table_bytes(tables):
+    """
+    Bytes used by the node tables with the integer types the header picks.
+    """
+    child_size = C_TYPE_SIZES[c_int_type(tables['left'] + tables['right'] + tables['roots'])]
+    threshold_size = C_TYPE_SIZES[c_int_type(tables['threshold'])]
+    n_nodes = len(tables['feature'])
+    return n_nodes * (1 + threshold_size + 2 * child_size) + len(tables['roots']) * child_size
+
+
+def export_forest(model, X, filename=HEADER_FILENAME, size_budget=DEFAULT_SIZE_BUDGET):
+    """
+    Compacts the forest to the size budget (if needed) and writes the C header.
+    Returns a summary dict.
+    """
+    if not hasattr(model, 'estimators_'):
+        raise ValueError("Only tree ensembles (e.g. RandomForestClassifier) can be exported to C")
+
+    tree_indices = compact_forest(model, X, size_budget)
+    tables = flatten_forest(model, tree_indices)
+    with open(filename, 'w') as f:
+        f.write(generate_header(model, tables))
+
+    return {
+        'trees': len(tree_indices),
+        'nodes': len(tables['feature']),
+        'table_bytes': header_table_bytes(tables)
+    }
+
+
+# --- Verification Harness ---
+
+def load_header(filename):
+    """
+    Parses the arrays and class names back out of a generated header.
+    """
+    with open(filename) as f:
+        source = f.read()
+
+    tables = {}
+    for name in ('feature_scale', 'roots', 'feature', 'threshold', 'left', 'right'):
+        match = re.search(rf"crop_model_{name}\[\d+\] = \{{(.*?)\}};", source, re.S)
+        tables[name] = np.array([int(v) for v in re.findall(r"-?\d+", match.group(1))], dtype=np.int64)
+    classes_block = re.search(r"crop_model_classes\[CROP_MODEL_N_CLASSES\] = \{(.*?)\};", source, re.S)
+    tables['classes'] = re.findall(r'"([^"]*)"', classes_block.group(1))
+    tables['n_nodes'] = int(re.search(r"#define CROP_MODEL_N_NODES (\d+)", source).group(1))
+    return tables
+
+
+def run_header_forest(tables, X):
+    """
+    Runs the exported trees exactly as the C code does (vectorized over rows).
+    Returns the predicted crop names.
+    """
+    x = quantize_features(X, tables['feature_scale'])
+    rows = np.arange(len(x))
+    n_classes = len(tables['classes'])
+    votes = np.zeros((len(x), n_classes), dtype=np.int32)
+
+    for root in tables['roots']:
+        node = np.full(len(x), root, dtype=np.int64)
+        active = node >= 0
+        while active.any():
+            current = node[active]
+            go_left = x[rows[active], tables['feature'][current]] <= tables['threshold'][current]
+            node[active] = np.where(go_left, tables['left'][current], tables['right'][current])
+            active = node >= 0
+        votes[rows, -1 - node] += 1
+
+    # np.argmax picks the lowest index on ties, like the C loop
+    return np.array(tables['classes'])[np.argmax(votes, axis=1)]
+
+
+def verify_header(model, filename, X):
+    """
+    Compares the exported header with the joblib model on X.
+    Returns (agreement, mismatch_count).
+    """
+    tables = load_header(filename)
+    exported = run_header_forest(tables, X)
+    expected = model.predict(X)
+    mismatches = int(np.sum(exported != expected))
+    return 1 - mismatches / len(X), mismatches
+
+
+if __name__ == '__main__':
+    from crop_model_trainer import DATASET_FILENAME, MODEL_FILENAME
+
+    parser = argparse.ArgumentParser(description="Export the crop model as a C header for the ESP32.")
+    parser.add_argument('--model', default=MODEL_FILENAME, help="Trained joblib model")
+    parser.add_argument('--dataset', default=DATASET_FILENAME, help="Dataset used for compaction and verification")
+    parser.add_argument('--output', default=HEADER_FILENAME, help="Header to write (default: %(default)s)")
+    parser.add_argument('--size-budget', type=int, default=DEFAULT_SIZE_BUDGET,
+                        help="Maximum bytes of node tables (default: %(default)s)")
+    args = parser.parse_args()
+
+    model = joblib.load(args.model)
+    X, _ = load_dataset(args.dataset)
+    summary = export_forest(model, X, args.output, args.size_budget)
+    print(f"Exported {summary['trees']} of {len(model.estimators_)} trees "
+          f"({summary['nodes']} nodes, {summary['table_bytes'] / 1024:.1f} KB) to '{args.output}'")
+
+    agreement, mismatches = verify_header(model, args.output, X)
+    print(f"Header agrees with the joblib model on {agreement * 100:.2f}% of {len(X)} rows "
+          f"({mismatches} mismatches)")
@@ -36,6 +36,8 @@ export function ChatBot({ sensorContext }: ChatBotProps) {
   ]);
   const [inputValue, setInputValue] = useState("");
   const [isLoading, setIsLoading] = useState(false);
+  // Server-side conversation history is kept per session
+  const [sessionId] = useState(() => `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`);
 
   const handleSend = async () => {
     if (!inputValue.trim() || isLoading) return;
@@ -53,30 +55,100 @@ export function ChatBot({ sensorContext }: ChatBotProps) {
     setInputValue("");
     setIsLoading(true);
 
+    const botMessageId = (Date.now() + 1).toString();
+    const updateBotMessage = (text: string) => {
+      setMessages(prev => {
+        const existing = prev.find(m => m.id === botMessageId);
+        if (existing) {
+          return prev.map(m => (m.id === botMessageId ? { ...m, text } : m));
+        }
+        return [...prev, { id: botMessageId, text, sender: "bot", timestamp: new Date() }];
+      });
+    };
+
     try {
-      // Call backend API with context
+      // Call backend API with context, streaming tokens as they are generated
       const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:5000';
-      const response = await fetch(`${API_BASE_URL}/api/chat`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          message: currentInput,
-          context: sensorContext || {},
-        }),
+      const requestBody = JSON.stringify({
+        message: currentInput,
+        context: sensorContext || {},
+        session_id: sessionId,
       });
+      const fallbackMessage = "I apologize, but I couldn't generate a response. Please try again.";
+      // Non-streaming endpoint, for servers without /api/chat/stream or when the stream breaks
+      const postChat = async () => {
+        const fallback = await fetch(`${API_BASE_URL}/api/chat`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: requestBody,
+        });
+        const data = await fallback.json();
+        updateBotMessage(data.response || fallbackMessage);
+      };
 
-      const data = await response.json();
+      let response: Response;
+      try {
+        response = await fetch(`${API_BASE_URL}/api/chat/stream`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: requestBody,
+        });
+      } catch (streamError) {
+        console.warn('Chat stream unavailable, retrying without streaming:', streamError);
+        await postChat();
+        return;
+      }
 
-      const botMessage: Message = {
-        id: (Date.now() + 1).toString(),
-        text: data.response || "I apologize, but I couldn't generate a response. Please try again.",
-        sender: "bot",
-        timestamp: new Date(),
-      };
+      if (response.status === 404 || (response.ok && !response.body)) {
+        await postChat();
+      } else if (!response.ok) {
+        // 429/503: the server is shedding chat load; show its message instead of retrying
+        const data = await response.json().catch(() => ({}));
+        updateBotMessage(data.response || fallbackMessage);
+      } else {
+        // Parse Server-Sent Events: "data: {...}" lines, with "event: done" / "event: error" at the end
+        const reader = response.body!.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let streamedText = "";
+
+        try {
+          while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            const events = buffer.split("\n\n");
+            buffer = events.pop() || "";
+            for (const rawEvent of events) {
+              let eventType = "message";
+              let eventData = "";
+              for (const line of rawEvent.split("\n")) {
+                if (line.startsWith("event:")) eventType = line.slice(6).trim();
+                if (line.startsWith("data:")) eventData += line.slice(5).trim();
+              }
+              if (!eventData) continue;
 
-      setMessages(prev => [...prev, botMessage]);
+              const payload = JSON.parse(eventData);
+              if (eventType === "message" && payload.token) {
+                streamedText += payload.token;
+                updateBotMessage(streamedText);
+              } else if (eventType === "done" || eventType === "error") {
+                updateBotMessage(payload.response || fallbackMessage);
+              }
+            }
+          }
+        } catch (streamError) {
+          // The stream broke before any text arrived: ask again without streaming
+          if (streamedText) throw streamError;
+          console.warn('Chat stream failed, retrying without streaming:', streamError);
+          await postChat();
+        }
+      }
     } catch (error) {
       console.error('Chat API error:', error);
       const errorMessage: Message = {
@@ -0,0 +1,352 @@
+"""
+Device Ingest Gateway for AgroSmart
+Event-loop (asyncio) listener for large fleets of WiFi ESP32 field nodes. One
+thread holds thousands of idle device connections; no Flask worker is tied up
+per device. One port number serves three framings:
+- TCP, newline-delimited JSON: a device keeps its connection open and writes
+  one reading per line (it may send several before reading the replies); every
+  reading gets one JSON reply line, in order.
+- HTTP/1.1 keep-alive: POST /predict with a JSON body, the same request the
+  WiFi firmware sends to the Flask server. A TCP connection that starts with
+  an HTTP request line is served as HTTP.
+- UDP: one JSON reading per datagram; the reply is sent back to the sender.
+
+Readings from all connections are queued and handed to `handle_batch` in
+batches (up to batch_max readings, waiting at most batch_window seconds for
+more after the first), on a worker thread, so inference and storage run once
+per batch while the event loop keeps accepting. While one batch runs the next
+one accumulates, so batches grow with load.
+
+handle_batch(items) gets a list of (reading, device_id, received_at) and
+returns one reply dict per reading (sent back to the device as JSON); an
+optional 'status' key sets the HTTP status code and is not sent.
+
+Per-device connection and backlog statistics are kept in memory
+(IngestGateway.device_stats(), served as /api/gateway/devices); /metrics gets
+fleet-wide totals only, since a label per device would not scale to thousands.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter, Gauge, Histogram
+from reading_schema import loads
+
+GATEWAY_BATCH_MAX = int(os.getenv('AGROSMART_GATEWAY_BATCH_MAX', '256'))  # readings per batch
+GATEWAY_BATCH_WINDOW = float(os.getenv('AGROSMART_GATEWAY_BATCH_WINDOW', '0.005'))  # seconds to wait for a batch to fill
+GATEWAY_QUEUE_LIMIT = 10000  # queued readings before devices are told to back off
+CONNECTION_PIPELINE_LIMIT = 64  # unanswered readings per TCP connection before we stop reading from it
+MAX_LINE_BYTES = 64 * 1024
+DEVICE_STATS_TTL = 24 * 3600  # forget devices not seen for a day
+HTTP_METHODS = (b'GET', b'POST', b'PUT', b'HEAD', b'DELETE', b'OPTIONS', b'PATCH')
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+GATEWAY_CONNECTIONS = Gauge('agrosmart_gateway_connections', 'Open device connections on the ingest gateway',
+                            ['protocol'])
+GATEWAY_READINGS = Counter('agrosmart_gateway_readings_total', 'Readings received by the ingest gateway',
+                           ['protocol', 'result'])
+GATEWAY_BACKLOG = Gauge('agrosmart_gateway_backlog', 'Readings received but not yet answered')
+GATEWAY_BATCH_SIZE = Histogram('agrosmart_gateway_batch_size', 'Readings per gateway inference/storage batch',
+                               buckets=BATCH_SIZE_BUCKETS)
+GATEWAY_BATCH_SECONDS = Histogram('agrosmart_gateway_batch_seconds', 'Time to process one gateway batch')
+GATEWAY_REPLY_SECONDS = Histogram('agrosmart_gateway_reply_seconds', 'Time from reading received to reply sent',
+                                  ['protocol'])
+GATEWAY_DEVICES = Gauge('agrosmart_gateway_devices', 'Devices seen by the ingest gateway')
+
+logger = logging.getLogger('agrosmart.gateway')
+
+
+class IngestGateway:
+    """
+    asyncio ingest server running on its own thread
+    """
+
+    def __init__(self, handle_batch, host='0.0.0.0', port=5001, udp=True,
+                 batch_max=GATEWAY_BATCH_MAX, batch_window=GATEWAY_BATCH_WINDOW):
+        self.handle_batch = handle_batch
+        self.host = host
+        self.port = port
+        self.udp = udp
+        self.batch_max = batch_max
+        self.batch_window = batch_window
+        self.devices = {}  # device id -> stats dict (event loop thread only writes)
+        self.loop = None
+        self._queue = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gateway-batch')
+        self._started = threading.Event()
+        self._error = None
+        GATEWAY_DEVICES.set_function(lambda: len(self.devices))
+
+    # --- Lifecycle ---
+    def start(self, timeout=10):
+        """
+        Starts the event loop thread; returns once the port is bound (raises if binding failed)
+        """
+        threading.Thread(target=self._run, name='ingest-gateway', daemon=True).start()
+        self._started.wait(timeout)
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._listen())
+        except OSError as e:
+            self._error = e
+            self._started.set()
+            return
+        self._started.set()
+        self.loop.run_forever()
+
+    async def _listen(self):
+        self._queue = asyncio.Queue()
+        await asyncio.start_server(self._handle_stream, self.host, self.port, limit=MAX_LINE_BYTES,
+                                   reuse_address=True, backlog=1024)
+        if self.udp:
+            await self.loop.create_datagram_endpoint(lambda: _DatagramProtocol(self),
+                                                     local_addr=(self.host, self.port))
+        self.loop.create_task(self._batcher())
+        logger.info("Ingest gateway listening on %s:%s (TCP/HTTP%s)", self.host, self.port,
+                    "/UDP" if self.udp else "")
+
+    # --- Batching ---
+    def submit(self, reading, device_id, protocol, received_at):
+        """
+        Queues a reading for the next batch; returns a future resolving to its reply
+        """
+        future = self.loop.create_future()
+        if not isinstance(reading, dict):
+            GATEWAY_READINGS.inc(protocol=protocol, result='invalid')
+            future.set_result({'error': 'Reading must be a JSON object', 'status': 400})
+            return future
+        if self._queue.qsize() >= GATEWAY_QUEUE_LIMIT:
+            GATEWAY_READINGS.inc(protocol=protocol, result='busy')
+            self._device(device_id)['rejected'] += 1
+            future.set_result({'error': 'Gateway busy, retry shortly', 'status': 503})
+            return future
+
+        device = self._device(device_id)
+        device['readings'] += 1
+        device['backlog'] += 1
+        device['max_backlog'] = max(device['max_backlog'], device['backlog'])
+        device['last_seen'] = received_at
+        device['protocol'] = protocol
+        GATEWAY_BACKLOG.inc()
+        self._queue.put_nowait((reading, device_id, received_at, future))
+
+        def answered(_future):
+            device['backlog'] -= 1
+            GATEWAY_BACKLOG.dec()
+            GATEWAY_REPLY_SECONDS.observe(time.time() - received_at, protocol=protocol)
+        future.add_done_callback(answered)
+        GATEWAY_READINGS.inc(protocol=protocol, result='accepted')
+        return future
+
+    async def _batcher(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_max - 1:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.batch_max and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            GATEWAY_BATCH_SIZE.observe(len(batch))
+            items = [(reading, device_id, received_at) for reading, device_id, received_at, _ in batch]
+            started = time.perf_counter()
+            try:
+                replies = await self.loop.run_in_executor(self._executor, self.handle_batch, items)
+            except Exception as e:
+                logger.error("Gateway batch of %d readings failed: %s", len(batch), e)
+                replies = [{'error': 'Processing failed', 'status': 503}] * len(batch)
+            GATEWAY_BATCH_SECONDS.observe(time.perf_counter() - started)
+
+            for (_, _, _, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+    # --- Device statistics ---
+    def _device(self, device_id):
+        device = self.devices.get(device_id)
+        if device is None:
+            if len(self.devices) % 1000 == 999:
+                self._forget_idle_devices()
+            device = self.devices[device_id] = {
+                'protocol': None, 'connections': 0, 'readings': 0, 'rejected': 0,
+                'backlog': 0, 'max_backlog': 0, 'first_seen': time.time(), 'last_seen': None
+            }
+        return device
+
+    def _forget_idle_devices(self):
+        cutoff = time.time() - DEVICE_STATS_TTL
+        for device_id in [device_id for device_id, device in self.devices.items()
+                          if device['connections'] == 0 and (device['last_seen'] or device['first_seen']) < cutoff]:
+            del self.devices[device_id]
+
+    def device_stats(self):
+        """
+        {device id: {protocol, connections, readings, rejected, backlog, max_backlog, first_seen, last_seen}}
+        Safe to call from any thread.
+        """
+        return {device_id: dict(device) for device_id, device in list(self.devices.items())}
+
+    # --- TCP (newline-delimited JSON or HTTP keep-alive) ---
+    async def _handle_stream(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        address = peer[0] if peer else 'unknown'
+        protocol = None
+        try:
+            first_line = await reader.readline()
+            if not first_line:
+                return
+            protocol = 'http' if first_line.split(b' ', 1)[0] in HTTP_METHODS else 'tcp'
+            GATEWAY_CONNECTIONS.inc(protocol=protocol)
+            if protocol == 'http':
+                await self._serve_http(first_line, reader, writer, address)
+            else:
+                await self._serve_lines(first_line, reader, writer, address)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            if protocol is not None:
+                GATEWAY_CONNECTIONS.dec(protocol=protocol)
+            writer.close()
+
+    async def _serve_lines(self, line, reader, writer, address):
+        """
+        One reply line per reading line, written in order by a separate task so
+        a device can pipeline readings (e.g. flush what it buffered while offline)
+        """
+        pending = asyncio.Queue(CONNECTION_PIPELINE_LIMIT)
+        writer_task = self.loop.create_task(self._write_replies(pending, writer))
+        devices = set()
+        try:
+            while line:
+                line = line.strip()
+                if line:
+                    received_at = time.time()
+                    reading = _decode(line)
+                    device_id = _device_id(reading, address)
+                    if device_id not in devices:
+                        devices.add(device_id)
+                        self._device(device_id)['connections'] += 1
+                    await pending.put(self.submit(reading, device_id, 'tcp', received_at))
+                line = await reader.readline()
+            await pending.put(None)
+            await writer_task
+        finally:
+            writer_task.cancel()
+            for device_id in devices:
+                self._device(device_id)['connections'] -= 1
+
+    async def _write_replies(self, pending, writer):
+        while True:
+            future = await pending.get()
+            if future is None:
+                return
+            reply = dict(await future)
+            reply.pop('status', None)
+            writer.write(json.dumps(reply).encode() + b'\n')
+            if pending.empty():
+                await writer.drain()
+
+    async def _serve_http(self, request_line, reader, writer, address):
+        device_id = None
+        try:
+            while request_line:
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                received_at = time.time()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_LINE_BYTES:
+                    self._write_http(writer, 413, {'error': 'Reading too large'}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                if method != 'POST':
+                    status, reply = 405, {'error': 'Use POST'}
+                elif path.split('?', 1)[0] not in ('/predict', '/ingest'):
+                    status, reply = 404, {'error': 'Not found'}
+                else:
+                    reading = _decode(body)
+                    if device_id is None:
+                        device_id = _device_id(reading, address)
+                        self._device(device_id)['connections'] += 1
+                    reply = dict(await self.submit(reading, _device_id(reading, address), 'http', received_at))
+                    status = reply.pop('status', 200)
+
+                self._write_http(writer, status, reply, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+                request_line = await reader.readline()
+        finally:
+            if device_id is not None:
+                self._device(device_id)['connections'] -= 1
+
+    @staticmethod
+    def _write_http(writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        headers = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                   f"Content-Type: application/json\r\n"
+                   f"Content-Length: {len(body)}\r\n"
+                   f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n")
+        if status == 503:
+            headers += "Retry-After: 1\r\n"
+        writer.write(headers.encode() + b"\r\n" + body)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    """
+    One reading per datagram, one reply datagram back to the sender
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received_at = time.time()
+        reading = _decode(data)
+        future = self.gateway.submit(reading, _device_id(reading, addr[0]), 'udp', received_at)
+        future.add_done_callback(lambda done: self._reply(done.result(), addr))
+
+    def _reply(self, reply, addr):
+        reply = dict(reply)
+        reply.pop('status', None)
+        self.transport.sendto(json.dumps(reply).encode(), addr)
+
+
+def _decode(payload):
+    try:
+        return loads(payload)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def _device_id(reading, address):
+    """
+    The device's own id ('device_id' in the reading, e.g. its MAC) or its IP address
+    """
+    if isinstance(reading, dict) and reading.get('device_id'):
+        return str(reading['device_id'])
+    return address
@@ -0,0 +1,286 @@
+"""
+Irrigation Controller for AgroSmart
+Server-side, event-driven pump control. Each ingested reading is passed to
+IrrigationController.on_reading(), which re-evaluates only the zone the
+reading belongs to and dispatches a command when that zone's pump has to
+switch, so the server reacts to the reading that crossed a threshold rather
+than on a polling interval.
+
+Rules per zone (ZoneRule):
+- hysteresis band: switch on below `on_below` % soil moisture, off above `off_above`
+- minimum on/off times: a pump is not switched again within min_on / min_off seconds
+- maximum on time: safety cutoff after max_on seconds
+- rain suppression: no watering while the weather cache reports rain
+  (a running pump is stopped once its minimum on time is over)
+- manual override: a manual command from the dashboard pauses the zone for
+  MANUAL_OVERRIDE seconds (like the firmware's own 5 minute manual timeout)
+
+Zones map devices to pumps. A zone's pump is either on the serial ESP32
+('serial': commands go through the serial writer as "PUMP_ON" / "PUMP_ON:N")
+or on the WiFi node itself ('reply': the command goes back in the reply to its
+reading). Devices not assigned to a zone get their own 'reply' zone, up to
+MAX_ZONES zones in all; readings from further unassigned devices are ignored.
+A serial pump's state changes only once the ESP32 acknowledges the command;
+a command that is not acknowledged within ACK_TIMEOUT is sent again.
+
+While the controller holds a pump state it re-sends it every KEEPALIVE seconds,
+which keeps the ESP32 out of its own automatic mode; if the server stops, the
+firmware falls back to automatic mode after its manual timeout.
+
+Latency from the reading that triggered a command to the command being
+dispatched (and, for serial pumps, to the ESP32's ACK) is recorded in
+agrosmart_irrigation_dispatch_seconds / agrosmart_irrigation_actuation_seconds.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from metrics import Counter, Gauge, Histogram
+
+MANUAL_OVERRIDE = 300  # seconds a manual pump command pauses the controller for its zone
+KEEPALIVE = 120  # seconds between re-sends of the held pump state
+ACK_TIMEOUT = 10  # seconds before an unacknowledged serial pump command is sent again
+MAX_ZONES = 64  # configured zones plus the zones created for unassigned devices
+
+ZoneRule = namedtuple('ZoneRule', ['on_below', 'off_above', 'min_on', 'min_off', 'max_on',
+                                   'rain_suppression', 'pump', 'channel', 'devices'])
+DEFAULT_RULE = ZoneRule(on_below=40, off_above=50, min_on=60, min_off=300, max_on=1800,
+                        rain_suppression=True, pump='reply', channel=1, devices=())
+# Zone '1' is the pump on the USB-connected ESP32 (readings from the serial reader)
+DEFAULT_ZONES = {'1': {'pump': 'serial', 'channel': 1, 'devices': ['serial']}}
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+IRRIGATION_COMMANDS = Counter('agrosmart_irrigation_commands_total', 'Pump commands issued by the irrigation controller',
+                              ['command', 'reason'])
+IRRIGATION_DISPATCH_SECONDS = Histogram('agrosmart_irrigation_dispatch_seconds',
+                                        'Reading received -> pump command dispatched', buckets=LATENCY_BUCKETS)
+IRRIGATION_ACTUATION_SECONDS = Histogram('agrosmart_irrigation_actuation_seconds',
+                                         'Reading received -> pump command acknowledged by the ESP32',
+                                         buckets=LATENCY_BUCKETS)
+IRRIGATION_PUMPS_ON = Gauge('agrosmart_irrigation_pumps_on', 'Zones whose pump the controller holds on')
+
+logger = logging.getLogger('agrosmart.irrigation')
+
+
+def load_zones(config=None):
+    """
+    Zone rules from a JSON object such as
+    {"1": {"pump": "serial", "channel": 1, "devices": ["serial"], "on_below": 35, "off_above": 45}}
+    (missing settings take DEFAULT_RULE's values)
+    """
+    if config is None:
+        config = os.getenv('AGROSMART_IRRIGATION_ZONES')
+    zones = json.loads(config) if config else DEFAULT_ZONES
+    rules = {}
+    for name, settings in zones.items():
+        unknown = set(settings) - set(ZoneRule._fields)
+        if unknown:
+            raise ValueError(f"Unknown setting(s) for irrigation zone {name}: {', '.join(sorted(unknown))}")
+        rule = DEFAULT_RULE._replace(**settings)
+        if rule.pump not in ('serial', 'reply'):
+            raise ValueError(f"Irrigation zone {name}: pump must be 'serial' or 'reply'")
+        if rule.off_above < rule.on_below:
+            raise ValueError(f"Irrigation zone {name}: off_above must not be below on_below")
+        rules[str(name)] = rule._replace(devices=tuple(rule.devices))
+    return rules
+
+
+def serial_command(command, rule):
+    """Serial command for a zone's pump: "PUMP_ON" for channel 1, "PUMP_ON:N" otherwise"""
+    return command if rule.channel == 1 else f"{command}:{rule.channel}"
+
+
+class _ZoneState:
+    __slots__ = ('rule', 'pump_on', 'switched_at', 'dispatched_at', 'manual_until',
+                 'moisture', 'reason', 'suppressed', 'requested', 'requested_at')
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.pump_on = None  # unknown until the first reading reports it
+        self.switched_at = float('-inf')
+        self.dispatched_at = float('-inf')
+        self.manual_until = 0.0
+        self.moisture = {}  # device id -> latest soil moisture
+        self.reason = None
+        self.suppressed = False
+        self.requested = None  # pump state sent to the ESP32 and not acknowledged yet
+        self.requested_at = float('-inf')
+
+
+class IrrigationController:
+    """
+    Evaluates the zone rules on every reading and dispatches pump commands
+    """
+
+    def __init__(self, zones, send_serial, weather=lambda: None, max_zones=MAX_ZONES):
+        """
+        zones: {name: ZoneRule}; send_serial(command, on_ack) writes a command to
+        the ESP32 (on_ack(acked_at) is called when it is acknowledged) and returns
+        False if it could not be sent; weather() returns the cached weather or None.
+        """
+        self.send_serial = send_serial
+        self.weather = weather
+        self.max_zones = max(max_zones, len(zones))
+        self.device_zones = {device: name for name, rule in zones.items() for device in rule.devices}
+        self.zones = {name: _ZoneState(rule) for name, rule in zones.items()}
+        self._lock = threading.Lock()
+        IRRIGATION_PUMPS_ON.set_function(lambda: sum(1 for zone in list(self.zones.values()) if zone.pump_on))
+
+    def zone_for(self, device_id, reading=None):
+        if reading is not None and reading.get('zone') is not None and str(reading['zone']) in self.zones:
+            return str(reading['zone'])
+        return self.device_zones.get(device_id, device_id)
+
+    def raining(self):
+        weather = self.weather()
+        return bool(weather) and weather.get('condition') == 'rainy'
+
+    def on_reading(self, reading, device_id, received_at=None):
+        """
+        Feeds one reading to its zone. Returns the zone's pump command
+        ('PUMP_ON' / 'PUMP_OFF') or None if the reading has no soil moisture
+        or no zone (all MAX_ZONES zones are taken).
+        """
+        try:
+            moisture = float(reading['soil_moisture'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        received_at = received_at or time.time()
+
+        with self._lock:
+            name = self.zone_for(device_id, reading)
+            zone = self.zones.get(name)
+            if zone is None:
+                if len(self.zones) >= self.max_zones:
+                    logger.debug("Irrigation: no zone for device %s (%d zones)", device_id, len(self.zones))
+                    return None
+                zone = self.zones[name] = _ZoneState(DEFAULT_RULE)
+            zone.moisture[device_id] = moisture
+            if zone.pump_on is None:
+                zone.pump_on = reading.get('pump_command') == 'PUMP_ON'
+
+            now = time.time()
+            if now < zone.manual_until:
+                return 'PUMP_ON' if zone.pump_on else 'PUMP_OFF'
+
+            want_on, reason = self._evaluate(zone, now)
+            if zone.requested is not None and now - zone.requested_at >= ACK_TIMEOUT:
+                # Never acknowledged (lost, or the ESP32 reconnected): send it again
+                zone.requested = None
+            if want_on != zone.pump_on:
+                if zone.requested != want_on:
+                    self._dispatch(name, zone, want_on, reason, received_at)
+            elif zone.rule.pump == 'serial' and now - zone.dispatched_at >= KEEPALIVE:
+                self._dispatch(name, zone, want_on, 'keepalive', received_at)
+            return 'PUMP_ON' if zone.pump_on else 'PUMP_OFF'
+
+    def _evaluate(self, zone, now):
+        """
+        (pump should be on, reason) for the zone's current readings
+        """
+        rule = zone.rule
+        moisture = sum(zone.moisture.values()) / len(zone.moisture)
+        raining = rule.rain_suppression and self.raining()
+        zone.suppressed = raining and moisture < rule.on_below
+        elapsed = now - zone.switched_at
+
+        if zone.pump_on:
+            if elapsed >= rule.max_on:
+                return False, 'max_on'
+            if elapsed < rule.min_on:
+                return True, zone.reason
+            if moisture > rule.off_above:
+                return False, 'moist'
+            if raining:
+                return False, 'rain'
+            return True, zone.reason
+
+        if moisture < rule.on_below and not raining and elapsed >= rule.min_off:
+            return True, 'dry'
+        return False, zone.reason
+
+    def _dispatch(self, name, zone, pump_on, reason, received_at):
+        """
+        Sends a pump command for the zone. The zone switches to `pump_on` when
+        the ESP32 acknowledges it ('serial') or right away ('reply' pumps get the
+        command in the reply to this reading).
+        """
+        command = 'PUMP_ON' if pump_on else 'PUMP_OFF'
+        if zone.rule.pump == 'serial':
+            def acknowledged(acked_at):
+                IRRIGATION_ACTUATION_SECONDS.observe(max(0.0, acked_at - received_at))
+                with self._lock:
+                    if zone.requested == pump_on:
+                        zone.requested = None
+                    if zone.pump_on != pump_on and time.time() >= zone.manual_until:
+                        self._switched(zone, pump_on, reason)
+            if reason != 'keepalive':
+                zone.requested, zone.requested_at = pump_on, time.time()
+            if not self.send_serial(serial_command(command, zone.rule), acknowledged):
+                # Retried with the next reading
+                zone.requested = None
+                zone.dispatched_at = float('-inf')
+                logger.warning("Irrigation zone %s: could not send %s (ESP32 not connected)", name, command)
+                return
+        else:
+            self._switched(zone, pump_on, reason)
+        zone.dispatched_at = time.time()
+        IRRIGATION_DISPATCH_SECONDS.observe(max(0.0, time.time() - received_at))
+        IRRIGATION_COMMANDS.inc(command=command, reason=reason)
+        if reason != 'keepalive':
+            logger.info("Irrigation zone %s: %s (%s)", name, command, reason)
+
+    @staticmethod
+    def _switched(zone, pump_on, reason):
+        zone.pump_on = pump_on
+        zone.switched_at = time.time()
+        zone.reason = reason
+
+    def manual_override(self, zone_name, command):
+        """
+        A manual pump command from the dashboard: hold that state and pause the
+        controller for the zone for MANUAL_OVERRIDE seconds
+        """
+        with self._lock:
+            zone = self.zones.get(zone_name)
+            if zone is None:
+                return
+            zone.pump_on = command == 'PUMP_ON'
+            zone.requested = None
+            zone.switched_at = zone.dispatched_at = time.time()
+            zone.manual_until = time.time() + MANUAL_OVERRIDE
+            zone.reason = 'manual'
+
+    def resume(self, zone_name=None):
+        """
+        Ends manual overrides (all zones by default); the next reading re-evaluates
+        """
+        with self._lock:
+            for name, zone in self.zones.items():
+                if zone_name is None or name == zone_name:
+                    zone.manual_until = 0.0
+
+    def status(self):
+        """
+        {zone: {pump_on, reason, soil_moisture, rain_suppressed, manual_override_s, pump, devices}}
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                name: {
+                    'pump_on': zone.pump_on,
+                    'reason': zone.reason,
+                    'soil_moisture': round(sum(zone.moisture.values()) / len(zone.moisture), 1) if zone.moisture else None,
+                    'rain_suppressed': zone.suppressed,
+                    'manual_override_s': max(0, round(zone.manual_until - now)),
+                    'on_for_s': round(now - zone.switched_at) if zone.pump_on else None,
+                    'pump': zone.rule.pump,
+                    'band': [zone.rule.on_below, zone.rule.off_above],
+                    'devices': sorted(zone.moisture)
+                }
+                for name, zone in self.zones.items()
+            }
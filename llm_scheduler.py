@@ -0,0 +1,173 @@
+"""
+LLM Request Scheduler for AgroSmart
+Limits how many chatbot requests hit the local LLM at once so chat load
+cannot starve the sensor and pump endpoints.
+Requests that find no free slot wait at most a fraction of a second (so
+they never tie up the web server's threads), served round-robin per client,
+and are rejected when the queue is full (429) or that wait runs out (503).
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class SchedulerBusy(Exception):
+    """Raised when the queue is full; maps to HTTP 429"""
+    status_code = 429
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than the queue-time limit; maps to HTTP 503"""
+    status_code = 503
+
+
+class _Ticket:
+    """A request waiting for (or holding) an LLM slot"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.enqueued_at = time.perf_counter()
+        self.granted = False
+        self.released = False
+
+
+class LLMScheduler:
+    """
+    Admission control and fair queueing for LLM calls.
+
+    Usage:
+        with scheduler.slot(client_id):
+            call_the_llm()
+
+    or acquire()/release() when the slot must outlive the request handler
+    (e.g. a streaming response).
+    """
+
+    def __init__(self, max_concurrency=1, max_queue=8, max_queue_per_client=2, queue_timeout=0.5):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.queue_timeout = queue_timeout
+
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = OrderedDict()  # client_id -> deque of tickets, in round-robin order
+        self._queued = 0
+
+        self.stats_counters = {
+            'admitted': 0,
+            'rejected_busy': 0,
+            'rejected_timeout': 0,
+            'total_wait_ms': 0.0
+        }
+
+    def acquire(self, client_id):
+        """
+        Waits for an LLM slot and returns a ticket to pass to release().
+        Raises SchedulerBusy or QueueTimeout if the request is not admitted.
+        """
+        ticket = _Ticket(client_id)
+
+        with self._condition:
+            # Fast path: free slot and nobody waiting
+            if self._active < self.max_concurrency and self._queued == 0:
+                self._grant(ticket)
+                return ticket
+
+            client_queue = self._waiting.get(client_id)
+            if self._queued >= self.max_queue or (
+                    client_queue is not None and len(client_queue) >= self.max_queue_per_client):
+                self.stats_counters['rejected_busy'] += 1
+                raise SchedulerBusy("Too many chat requests waiting for the assistant")
+
+            if client_queue is None:
+                client_queue = self._waiting[client_id] = deque()
+            client_queue.append(ticket)
+            self._queued += 1
+
+            deadline = ticket.enqueued_at + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._remove_waiting(ticket)
+                    self.stats_counters['rejected_timeout'] += 1
+                    raise QueueTimeout(f"Chat request waited more than {self.queue_timeout}s in the queue")
+                self._condition.wait(remaining)
+
+            return ticket
+
+    def release(self, ticket):
+        """
+        Frees the ticket's slot and hands it to the next waiting client.
+        Safe to call more than once.
+        """
+        with self._condition:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            self._active -= 1
+            self._dispatch()
+
+    def slot(self, client_id):
+        """Context manager around acquire()/release()"""
+        return _Slot(self, client_id)
+
+    def stats(self):
+        """Returns current queue depth, active slots and admission counters"""
+        with self._condition:
+            admitted = self.stats_counters['admitted']
+            return {
+                'max_concurrency': self.max_concurrency,
+                'active': self._active,
+                'queued': self._queued,
+                'waiting_clients': len(self._waiting),
+                'admitted': admitted,
+                'rejected_busy': self.stats_counters['rejected_busy'],
+                'rejected_timeout': self.stats_counters['rejected_timeout'],
+                'avg_wait_ms': round(self.stats_counters['total_wait_ms'] / admitted, 1) if admitted else 0
+            }
+
+    # --- Internal helpers (called with the condition held) ---
+
+    def _grant(self, ticket):
+        ticket.granted = True
+        self._active += 1
+        self.stats_counters['admitted'] += 1
+        self.stats_counters['total_wait_ms'] += (time.perf_counter() - ticket.enqueued_at) * 1000
+
+    def _dispatch(self):
+        """Grants free slots to waiting tickets, one client at a time (round-robin)"""
+        while self._active < self.max_concurrency and self._waiting:
+            client_id, client_queue = next(iter(self._waiting.items()))
+            ticket = client_queue.popleft()
+            self._queued -= 1
+            if client_queue:
+                self._waiting.move_to_end(client_id)
+            else:
+                del self._waiting[client_id]
+            self._grant(ticket)
+        self._condition.notify_all()
+
+    def _remove_waiting(self, ticket):
+        client_queue = self._waiting.get(ticket.client_id)
+        if client_queue and ticket in client_queue:
+            client_queue.remove(ticket)
+            self._queued -= 1
+            if not client_queue:
+                del self._waiting[ticket.client_id]
+
+
+class _Slot:
+    def __init__(self, scheduler, client_id):
+        self.scheduler = scheduler
+        self.client_id = client_id
+        self.ticket = None
+
+    def __enter__(self):
+        self.ticket = self.scheduler.acquire(self.client_id)
+        return self.ticket
+
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.ticket)
+        return False
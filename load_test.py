@@ -0,0 +1,381 @@
+"""
+Synthetic Load Test for AgroSmart
+Simulates many clients against prediction_server.py at once:
+- N dashboards polling like Dashboard.tsx: sensors/current + pump/status,
+  sensors/history, crop/recommendation every 5 seconds, weather on load
+- M devices posting readings to /predict like the WiFi firmware
+- K chat users asking questions through /api/chat/stream like ChatBot.tsx
+
+Runs fully offline: local stand-ins replace WeatherAPI and LM Studio, and the
+server is started as a subprocess pointed at them (or use --target to load an
+already running server).
+
+Reports throughput, error rate and latency percentiles per endpoint:
+    python load_test.py --dashboards 50 --devices 20 --chat-users 5 --duration 60
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prediction_server.py')
+
+CHAT_QUESTIONS = [
+    "Should I water my crops right now?",
+    "What fertilizer do you recommend?",
+    "Is the temperature good for my crops?",
+    "When is the best time to plant?",
+    "How can I improve my soil nitrogen?"
+]
+LLM_REPLY = ("Based on the current soil moisture you should irrigate lightly in the evening "
+             "and check the nitrogen level again next week").split()
+
+
+# --- Offline stand-ins for the upstream services ---
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves a WeatherAPI-style GET /v1/current.json and an OpenAI-style
+    POST /v1/chat/completions (streaming and non-streaming).
+    """
+    protocol_version = 'HTTP/1.1'
+    token_delay = 0.02  # seconds between generated tokens
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if not self.path.startswith('/v1/current.json'):
+            self.send_error(404)
+            return
+        self._send_json({'current': {
+            'temp_c': round(random.uniform(24, 32), 1),
+            'humidity': random.randint(50, 80),
+            'wind_kph': round(random.uniform(5, 20), 1),
+            'condition': {'text': random.choice(['Sunny', 'Partly cloudy', 'Light rain shower'])}
+        }})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        tokens = [word + ' ' for word in LLM_REPLY]
+        usage = {'prompt_tokens': sum(len(m.get('content', '')) // 4 for m in payload.get('messages', [])),
+                 'completion_tokens': len(tokens)}
+
+        if not payload.get('stream'):
+            time.sleep(self.token_delay * len(tokens))
+            self._send_json({'choices': [{'message': {'content': ''.join(tokens)}}], 'usage': usage})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for token in tokens:
+            time.sleep(self.token_delay)
+            chunk = {'choices': [{'delta': {'content': token}}]}
+            self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self._send_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+
+def start_stand_ins(token_delay):
+    """
+    Starts the WeatherAPI / LM Studio stand-in on a free local port.
+    Returns (server, base_url).
+    """
+    StandInHandler.token_delay = token_delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_server(port, stand_in_url):
+    """
+    Starts prediction_server.py on `port` using the stand-ins, and waits until
+    /api/ready reports the model is loaded
+    """
+    env = dict(os.environ,
+               AGROSMART_PORT=str(port),
+               AGROSMART_RETRAIN='0',
+               AGROSMART_LOG_LEVEL=os.getenv('AGROSMART_LOG_LEVEL', 'WARNING'),
+               LMSTUDIO_URL=f"{stand_in_url}/v1/chat/completions",
+               WEATHER_API_URL=f"{stand_in_url}/v1/current.json")
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=env, cwd=os.path.dirname(SERVER_SCRIPT),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    target = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"prediction_server.py exited with code {process.returncode}")
+        try:
+            if requests.get(f"{target}/api/ready", timeout=1).ok:
+                return process, target
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("prediction_server.py did not start within 60 seconds")
+
+
+# --- Result collection ---
+
+class Results:
+    """
+    Thread-safe per-endpoint latency and outcome records
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)  # endpoint -> [seconds]
+        self.errors = defaultdict(int)      # endpoint -> failed requests
+        self.rejected = defaultdict(int)    # endpoint -> 429/503 from the LLM scheduler
+        self.late_cycles = 0                # polling cycles started more than one interval late
+
+    def record(self, endpoint, seconds, ok=True, rejected=False):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if rejected:
+                self.rejected[endpoint] += 1
+            elif not ok:
+                self.errors[endpoint] += 1
+
+    def late(self):
+        with self._lock:
+            self.late_cycles += 1
+
+    def summary(self, duration):
+        report = {}
+        with self._lock:
+            for endpoint, values in sorted(self.latencies.items()):
+                values = sorted(values)
+
+                def percentile(p):
+                    return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+
+                report[endpoint] = {
+                    'requests': len(values),
+                    'throughput_rps': round(len(values) / duration, 2),
+                    'errors': self.errors[endpoint],
+                    'rejected': self.rejected[endpoint],
+                    'error_rate': round(self.errors[endpoint] / len(values), 4),
+                    'p50_ms': percentile(50),
+                    'p90_ms': percentile(90),
+                    'p99_ms': percentile(99),
+                    'max_ms': round(values[-1] * 1000, 1)
+                }
+        return report
+
+
+def timed_request(session, results, endpoint, method, url, **kwargs):
+    """
+    Sends one request and records its latency under `endpoint`. Returns the response or None.
+    """
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=30, **kwargs)
+        response.content  # Read the whole body
+    except requests.exceptions.RequestException:
+        results.record(endpoint, time.perf_counter() - start, ok=False)
+        return None
+    rejected = endpoint.startswith('/api/chat') and response.status_code in (429, 503)
+    results.record(endpoint, time.perf_counter() - start, ok=response.ok, rejected=rejected)
+    return response
+
+
+def run_on_schedule(stop, interval, results, action):
+    """
+    Calls action() every `interval` seconds on a fixed schedule (so slow
+    responses do not lower the offered load), starting at a random offset.
+    """
+    next_run = time.time() + random.uniform(0, interval)
+    while not stop.wait(max(0, next_run - time.time())):
+        action()
+        next_run += interval
+        if time.time() - next_run > interval:
+            results.late()
+            next_run = time.time()
+
+
+# --- Simulated clients ---
+
+def dashboard_client(target, interval, results, stop):
+    """
+    One browser tab on the dashboard (see Dashboard.tsx)
+    """
+    session = requests.Session()
+    timed_request(session, results, '/api/weather', 'GET', f"{target}/api/weather")
+
+    def poll():
+        timed_request(session, results, '/api/sensors/current', 'GET', f"{target}/api/sensors/current")
+        timed_request(session, results, '/api/pump/status', 'GET', f"{target}/api/pump/status")
+        timed_request(session, results, '/api/sensors/history', 'GET', f"{target}/api/sensors/history?limit=24")
+        timed_request(session, results, '/api/crop/recommendation', 'GET', f"{target}/api/crop/recommendation")
+
+    poll()
+    run_on_schedule(stop, interval, results, poll)
+
+
+def device_client(target, interval, results, stop):
+    """
+    One ESP32 posting readings to /predict
+    """
+    session = requests.Session()
+    started = time.time()
+    seq = 0
+
+    def post_reading():
+        nonlocal seq
+        reading = {
+            'seq': seq,
+            'uptime_ms': int((time.time() - started) * 1000),
+            'N': random.randint(0, 140), 'P': random.randint(5, 145), 'K': random.randint(5, 205),
+            'temperature': round(random.uniform(10, 40), 1), 'humidity': round(random.uniform(20, 95), 1),
+            'rainfall': round(random.uniform(20, 300), 1), 'soil_moisture': random.randint(10, 90)
+        }
+        seq += 1
+        timed_request(session, results, '/predict', 'POST', f"{target}/predict", json=reading)
+
+    run_on_schedule(stop, interval, results, post_reading)
+
+
+def chat_client(target, interval, results, stop):
+    """
+    One user chatting through the streaming endpoint (see ChatBot.tsx).
+    Time to first token is recorded as '/api/chat/stream (first token)'.
+    """
+    session = requests.Session()
+    session_id = uuid.uuid4().hex
+
+    def ask():
+        payload = {
+            'message': random.choice(CHAT_QUESTIONS),
+            'context': {'temperature': round(random.uniform(15, 35), 1), 'humidity': random.randint(40, 90),
+                        'soil_moisture': random.randint(20, 70), 'N': 90, 'P': 42, 'K': 43},
+            'session_id': session_id
+        }
+        start = time.perf_counter()
+        first_token = None
+        ok = False
+        try:
+            with session.post(f"{target}/api/chat/stream", json=payload, stream=True, timeout=60) as response:
+                if response.status_code in (429, 503):
+                    results.record('/api/chat/stream', time.perf_counter() - start, rejected=True)
+                    return
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if first_token is None and line.startswith('data: {"token"'):
+                        first_token = time.perf_counter() - start
+                    if line.startswith('event: done'):
+                        ok = True
+                    elif line.startswith('event: error'):
+                        ok = False
+        except requests.exceptions.RequestException:
+            ok = False
+
+        results.record('/api/chat/stream', time.perf_counter() - start, ok=ok)
+        if first_token is not None:
+            results.record('/api/chat/stream (first token)', first_token)
+
+    run_on_schedule(stop, interval, results, ask)
+
+
+def run_load(target, args):
+    results = Results()
+    stop = threading.Event()
+    clients = ([(dashboard_client, args.dashboard_interval)] * args.dashboards +
+               [(device_client, args.device_interval)] * args.devices +
+               [(chat_client, args.chat_interval)] * args.chat_users)
+
+    threads = [threading.Thread(target=client, args=(target, interval, results, stop), daemon=True)
+               for client, interval in clients]
+    print(f"Starting {args.dashboards} dashboards, {args.devices} devices and {args.chat_users} chat users "
+          f"against {target} for {args.duration}s...")
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=60)
+    return results.summary(time.time() - start), results.late_cycles
+
+
+def print_report(report, late_cycles):
+    print(f"\n{'Endpoint':<32} {'Requests':>9} {'Req/s':>8} {'Errors':>7} {'429/503':>8} "
+          f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print("-" * 108)
+    for endpoint, stats in report.items():
+        print(f"{endpoint:<32} {stats['requests']:>9} {stats['throughput_rps']:>8.2f} {stats['errors']:>7} "
+              f"{stats['rejected']:>8} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} "
+              f"{stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+    total = sum(s['requests'] for name, s in report.items() if not name.endswith('(first token)'))
+    errors = sum(s['errors'] for s in report.values())
+    print(f"\nTotal: {total} requests, {errors} errors ({errors / total * 100 if total else 0:.2f}%)")
+    if late_cycles:
+        print(f"Warning: {late_cycles} client cycles fell more than one interval behind schedule "
+              f"(the load generator or server could not keep up)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate dashboards, devices and chat users against AgroSmart.")
+    parser.add_argument('--dashboards', type=int, default=10, help="Dashboard tabs (default: %(default)s)")
+    parser.add_argument('--devices', type=int, default=5, help="Devices posting to /predict (default: %(default)s)")
+    parser.add_argument('--chat-users', type=int, default=2, help="Chat users (default: %(default)s)")
+    parser.add_argument('--dashboard-interval', type=float, default=5, help="Dashboard poll interval in seconds")
+    parser.add_argument('--device-interval', type=float, default=5, help="Seconds between device readings")
+    parser.add_argument('--chat-interval', type=float, default=20, help="Seconds between a user's chat messages")
+    parser.add_argument('--duration', type=float, default=30, help="Test duration in seconds (default: %(default)s)")
+    parser.add_argument('--llm-token-delay', type=float, default=0.02,
+                        help="Stand-in LLM seconds per token (default: %(default)s)")
+    parser.add_argument('--target', help="Load an already running server (e.g. http://localhost:5000) "
+                                         "instead of starting one against the stand-ins")
+    parser.add_argument('--port', type=int, default=5055, help="Port for the started server (default: %(default)s)")
+    parser.add_argument('--output', help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    stand_ins, stand_in_url = start_stand_ins(args.llm_token_delay)
+    print(f"Offline WeatherAPI / LM Studio stand-ins on {stand_in_url}")
+
+    server_process = None
+    target = args.target
+    if target is None:
+        server_process, target = start_server(args.port, stand_in_url)
+
+    try:
+        report, late_cycles = run_load(target, args)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait(timeout=10)
+        stand_ins.shutdown()
+
+    print_report(report, late_cycles)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'endpoints': report, 'late_cycles': late_cycles}, f, indent=2)
+        print(f"Report written to '{args.output}'")
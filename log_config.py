@@ -0,0 +1,67 @@
+"""
+Logging Setup for AgroSmart
+Leveled logging with per-call-site rate limiting, so messages logged for every
+sensor reading or request cannot flood the console (or slow ingestion) at
+high data rates.
+
+Set the level with AGROSMART_LOG_LEVEL (DEBUG, INFO, WARNING, ...; default INFO).
+"""
+
+import logging
+import os
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+LOG_RATE = 1.0    # messages per second allowed from each logging call site
+LOG_BURST = 5     # messages a call site may log at once before being limited
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site (logger, file, line). Suppressed messages are
+    counted and reported on the next message that gets through.
+    """
+
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # call site -> [tokens, last refill time, suppressed count]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+def setup_logging(level=None):
+    """
+    Configures the root logger once: console handler, timestamped format and
+    rate limiting. Safe to call from every entry point.
+    """
+    root = logging.getLogger()
+    if any(isinstance(f, RateLimitFilter) for handler in root.handlers for f in handler.filters):
+        return
+
+    level = level or os.getenv('AGROSMART_LOG_LEVEL', 'INFO').upper()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter())
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,232 @@
+"""
+Prometheus-style Metrics for AgroSmart
+A small, dependency-free metrics registry (counters, gauges, histograms)
+rendered in the Prometheus text exposition format at /metrics.
+
+Usage:
+    READINGS = Counter('agrosmart_readings_total', 'Sensor readings received', ['source'])
+    READINGS.inc(source='serial')
+
+    with INFERENCE_SECONDS.time():
+        model.predict(...)
+
+    install_flask_metrics(app)   # per-route handler timing + GET /metrics
+"""
+
+import threading
+import time
+
+from flask import Response, g, request
+
+# Latency buckets in seconds, from sub-millisecond parsing up to slow upstream calls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+    """Holds every metric and renders them for scraping"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        # Called on every update, so no set comparison: same count and every name present
+        try:
+            if len(labels) == len(self.labelnames):
+                return tuple([str(labels[name]) for name in self.labelnames])
+        except KeyError:
+            pass
+        raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+
+    def _header(self):
+        return f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.metric_type}\n"
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}\n" for key, v in items]
+        return self._header() + "".join(lines)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down; can also be read from a callback at scrape time"""
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Report function() (unlabelled gauges only) each time metrics are scraped"""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                return self._header() + f"{self.name} {_format_value(self._function())}\n"
+            except Exception:
+                return self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}\n" for key, v in items]
+        return self._header() + "".join(lines)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (latencies in seconds) in cumulative buckets"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the elapsed time of its block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, {'counts': list(s['counts']), 'sum': s['sum'], 'count': s['count']})
+                           for key, s in self._values.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}\n")
+            labels = _format_labels(self.labelnames, key, ('le', '+Inf'))
+            lines.append(f"{self.name}_bucket{labels} {series['count']}\n")
+            base_labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{base_labels} {_format_value(series['sum'])}\n")
+            lines.append(f"{self.name}_count{base_labels} {series['count']}\n")
+        return self._header() + "".join(lines)
+
+
+def install_flask_metrics(app, registry=REGISTRY):
+    """
+    Times every request per route and serves the registry at GET /metrics.
+    Routes are labelled by their URL rule (e.g. /api/pump/<action>), not the
+    raw path, so the number of series stays small.
+    """
+    request_seconds = Histogram('agrosmart_http_request_duration_seconds',
+                                'Time spent in HTTP handlers', ['route', 'method'], registry=registry)
+    requests_total = Counter('agrosmart_http_requests_total',
+                             'HTTP requests handled', ['route', 'method', 'status'], registry=registry)
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = getattr(g, '_metrics_start', None)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if start is not None:
+            request_seconds.observe(time.perf_counter() - start, route=route, method=request.method)
+        requests_total.inc(route=route, method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    return request_seconds, requests_total
@@ -0,0 +1,319 @@
+"""
+Regional Crop Model Pool for AgroSmart
+Farms in different regions need crop models trained on their own data. The
+pool lets one server serve all of them without loading every model up front:
+
+- Routing: a reading's device ID picks its model key through the region map
+  (REGION_MAP_FILE, JSON; re-read when it changes):
+      {"devices": {"esp32-farm-7": "punjab", "esp32-farm-8": "punjab"},
+       "models": {"punjab": "models/punjab_2025.joblib"}}
+  A device without an entry uses its own model if MODEL_DIR has one
+  (<device id>.joblib), and the default model otherwise. Key <key> is loaded
+  from the "models" entry or MODEL_DIR/<key>.joblib; the default key from the
+  server's model file (the one the retraining worker publishes).
+- Models are loaded on first use and kept in an LRU bounded by POOL_MAX_BYTES
+  of estimated memory (the trees' arrays plus what prepare() precomputes for
+  the model, e.g. its explanation tables). Loading a model that does not fit
+  evicts the least recently used ones; pinned keys (the default model) are
+  never evicted. Concurrent requests for a model that is still loading wait
+  for that single load instead of loading it again.
+- A model that cannot be loaded is not retried for RETRY_FAILED seconds;
+  readings routed to it are predicted by the default model in the meantime.
+- refresh() reloads loaded models whose file changed and re-reads the region map.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from metrics import Counter, Gauge, Histogram
+
+DEFAULT_KEY = 'default'
+MODEL_DIR = os.getenv('AGROSMART_MODEL_DIR', 'models')
+REGION_MAP_FILE = os.getenv('AGROSMART_REGION_MAP', 'model_regions.json')
+POOL_MAX_BYTES = int(float(os.getenv('AGROSMART_MODEL_POOL_MB', '256')) * 1024 * 1024)
+RETRY_FAILED = 60  # seconds before a model that failed to load is tried again
+MODEL_SUFFIX = '.joblib'
+VALID_KEY = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+MODEL_POOL_REQUESTS = Counter('agrosmart_model_pool_requests_total', 'Model pool lookups', ['result'])
+MODEL_POOL_EVICTIONS = Counter('agrosmart_model_pool_evictions_total', 'Models evicted from the model pool')
+MODEL_LOAD_SECONDS = Histogram('agrosmart_model_load_seconds', 'Time to load and prepare one model',
+                               buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+MODEL_POOL_BYTES = Gauge('agrosmart_model_pool_bytes', 'Estimated memory of the loaded models')
+MODEL_POOL_MODELS = Gauge('agrosmart_model_pool_models', 'Models loaded in the model pool')
+
+logger = logging.getLogger('agrosmart.models')
+
+PoolEntry = namedtuple('PoolEntry', ['model', 'path', 'mtime', 'nbytes', 'loaded_at'])
+
+
+class ModelUnavailable(Exception):
+    """
+    The model for a key could not be loaded (recently)
+    """
+
+    def __init__(self, key, error):
+        self.key = key
+        self.error = error
+        super().__init__(f"Model '{key}' is not available: {error}")
+
+
+def load_model(path):
+    import joblib
+    return joblib.load(path)
+
+
+def model_nbytes(model, path=None):
+    """
+    Estimated memory of a model: the node and value arrays of its trees for
+    tree ensembles, the file size otherwise (joblib files are compressed, so
+    that is only a lower bound)
+    """
+    estimators = getattr(model, 'estimators_', None)
+    if estimators is not None and all(hasattr(estimator, 'tree_') for estimator in estimators):
+        total = 0
+        for estimator in estimators:
+            state = estimator.tree_.__getstate__()
+            total += state['nodes'].nbytes + state['values'].nbytes
+        return total
+    return os.path.getsize(path) if path and os.path.exists(path) else 0
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class ModelPool:
+    """
+    Lazily loaded models keyed by region or device, in a memory-bounded LRU
+    """
+
+    def __init__(self, default_path, model_dir=MODEL_DIR, region_map=REGION_MAP_FILE, max_bytes=POOL_MAX_BYTES,
+                 load=load_model, prepare=None, pinned=(DEFAULT_KEY,)):
+        """
+        load(path) returns a model; prepare(model) runs once after every load
+        (outside the pool's lock) and returns the bytes it allocated for the model.
+        """
+        self.default_path = default_path
+        self.model_dir = model_dir
+        self.region_map = region_map
+        self.max_bytes = max_bytes
+        self.load = load
+        self.prepare = prepare
+        self.pinned = frozenset(pinned)
+        self._entries = OrderedDict()  # key -> PoolEntry, least recently used first
+        self._loading = {}  # key -> threading.Event set when its load finishes
+        self._failures = {}  # key -> (time.monotonic(), error message)
+        self._lock = threading.Lock()
+        self._devices = {}  # device id -> key, from the region map
+        self._paths = {}  # key -> model file, from the region map
+        self._routes = {}  # device id -> key, resolved
+        self._map_mtime = None
+        self.hits = self.misses = self.loads = self.evictions = 0
+        self._read_region_map()
+        MODEL_POOL_BYTES.set_function(lambda: self.nbytes)
+        MODEL_POOL_MODELS.set_function(lambda: len(self._entries))
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in list(self._entries.values()))
+
+    def path_for(self, key):
+        """Model file of `key` (None for a key that cannot name a file)"""
+        if key == DEFAULT_KEY:
+            return self._paths.get(key, self.default_path)
+        if key in self._paths:
+            return self._paths[key]
+        if not VALID_KEY.match(key):
+            return None
+        return os.path.join(self.model_dir, key + MODEL_SUFFIX)
+
+    def route(self, device_id):
+        """Model key for a device's readings"""
+        if not device_id:
+            return DEFAULT_KEY
+        key = self._routes.get(device_id)
+        if key is None:
+            key = self._devices.get(device_id)
+            if key is None:
+                path = self.path_for(str(device_id))
+                key = str(device_id) if path is not None and os.path.exists(path) else DEFAULT_KEY
+            self._routes[device_id] = key
+        return key
+
+    def peek(self, key=DEFAULT_KEY):
+        """The loaded model for `key`, or None; never loads and does not count as a use"""
+        entry = self._entries.get(key)
+        return entry.model if entry is not None else None
+
+    def get(self, key=DEFAULT_KEY):
+        """
+        The model for `key`, loading it on first use; raises ModelUnavailable
+        (or the load error, for the caller that attempted the load)
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    MODEL_POOL_REQUESTS.inc(result='hit')
+                    return entry.model
+                failure = self._failures.get(key)
+                if failure is not None and time.monotonic() - failure[0] < RETRY_FAILED:
+                    raise ModelUnavailable(key, failure[1])
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    MODEL_POOL_REQUESTS.inc(result='miss')
+                    break
+            # Someone else is loading this model: wait for it, then look again
+            loading.wait()
+
+        try:
+            entry = self._load(key)
+        except Exception as e:
+            with self._lock:
+                self._failures[key] = (time.monotonic(), str(e))
+            logger.error("Could not load model '%s': %s", key, e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set()
+        self._insert(key, entry)
+        return entry.model
+
+    def model_for(self, device_id=None, key=None):
+        """
+        (key, model) for a device (or a key), falling back to the default model
+        when its own model is not available; the model is None if the default
+        model is not available either
+        """
+        key = key or self.route(device_id)
+        try:
+            return key, self.get(key)
+        except Exception:
+            if key == DEFAULT_KEY:
+                return DEFAULT_KEY, None
+        try:
+            return DEFAULT_KEY, self.get(DEFAULT_KEY)
+        except Exception:
+            return DEFAULT_KEY, None
+
+    def _load(self, key):
+        path = self.path_for(key)
+        if path is None:
+            raise ValueError("not a valid model name")
+        started = time.perf_counter()
+        mtime = _mtime(path)
+        model = self.load(path)
+        extra = self.prepare(model) if self.prepare is not None else 0
+        elapsed = time.perf_counter() - started
+        MODEL_LOAD_SECONDS.observe(elapsed)
+        entry = PoolEntry(model, path, mtime, model_nbytes(model, path) + (extra or 0), time.time())
+        logger.info("Loaded model '%s' from %s in %.2f s (~%.1f MB)", key, path, elapsed, entry.nbytes / 1e6)
+        return entry
+
+    def _insert(self, key, entry):
+        """Adds (or replaces) a loaded model and evicts least recently used ones over the budget"""
+        with self._lock:
+            replaced = key in self._entries
+            self._entries[key] = entry
+            if not replaced:
+                self._entries.move_to_end(key)
+            self._failures.pop(key, None)
+            self.loads += 1
+            total = sum(item.nbytes for item in self._entries.values())
+            for candidate in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                if candidate == key or candidate in self.pinned:
+                    continue
+                total -= self._entries.pop(candidate).nbytes
+                self.evictions += 1
+                MODEL_POOL_EVICTIONS.inc()
+                logger.info("Evicted model '%s' (model pool over %.0f MB)", candidate, self.max_bytes / 1e6)
+
+    def evict(self, key):
+        """Drops a loaded model (in-flight predictions keep their reference)"""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def _read_region_map(self):
+        mtime = _mtime(self.region_map) if self.region_map else None
+        if mtime == self._map_mtime:
+            return False
+        devices, paths = {}, {}
+        if mtime is not None:
+            try:
+                with open(self.region_map, 'r') as f:
+                    config = json.load(f)
+                devices = {str(device): str(key) for device, key in (config.get('devices') or {}).items()}
+                paths = {str(key): str(path) for key, path in (config.get('models') or {}).items()}
+            except (OSError, ValueError, AttributeError) as e:
+                logger.error("Could not read region map %s: %s", self.region_map, e)
+                return False
+        self._devices, self._paths, self._map_mtime = devices, paths, mtime
+        self._routes = {}
+        return True
+
+    def refresh(self):
+        """
+        Re-reads the region map and reloads loaded models whose file changed
+        (new models are swapped in with one assignment; in-flight predictions
+        keep the old one). Returns the reloaded keys.
+        """
+        if self._read_region_map():
+            logger.info("Region map %s reloaded (%d devices)", self.region_map, len(self._devices))
+        with self._lock:
+            # Device model files that appeared since are picked up by new routes
+            self._routes = {}
+            changed = [key for key, entry in self._entries.items()
+                       if self.path_for(key) != entry.path or _mtime(self.path_for(key) or '') != entry.mtime]
+        reloaded = []
+        for key in changed:
+            try:
+                entry = self._load(key)
+            except Exception as e:
+                logger.error("Error reloading model '%s': %s", key, e)
+                continue
+            with self._lock:
+                present = key in self._entries
+            if present:
+                self._insert(key, entry)
+                reloaded.append(key)
+        return reloaded
+
+    def stats(self):
+        """Budget, hit/miss/eviction counts and the loaded models (least recently used first)"""
+        with self._lock:
+            entries = list(self._entries.items())
+            failures = dict(self._failures)
+            routes = len(self._routes)
+        now = time.time()
+        return {
+            'max_bytes': self.max_bytes,
+            'bytes': sum(entry.nbytes for _, entry in entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'routed_devices': routes,
+            'region_map': self.region_map if self._map_mtime is not None else None,
+            'models': {
+                key: {'path': entry.path, 'bytes': entry.nbytes, 'pinned': key in self.pinned,
+                      'loaded_seconds_ago': round(now - entry.loaded_at, 1)}
+                for key, entry in entries
+            },
+            'failed': {key: error for key, (_, error) in failures.items()}
+        }
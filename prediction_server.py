@@ -1,24 +1,51 @@
-import joblib
-import pandas as pd
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
 import json
 import os
-import requests
 import time
 import serial
 import serial.tools.list_ports
 import threading
+import multiprocessing
+import csv
+import re
+import logging
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from llm_scheduler import LLMScheduler, SchedulerBusy, QueueTimeout
+from metrics import Counter, Gauge, Histogram, install_flask_metrics
+from log_config import setup_logging
+from reading_trace import DeviceClock, start_trace, mark, finish_ingest, mark_served, latency_summary
+from state_store import VersionedStore
+from reading_schema import REQUIRED, SENSOR_FIELDS, ReadingError, schema as reading_schema
+from sensor_bus import SensorBus
+from sensor_archive import ARCHIVE_FIELDS, SensorArchive, resample
+from serial_supervisor import SerialSupervisor, open_serial_port
+from rolling_stats import RollingStats
+from ingest_gateway import IngestGateway
+from irrigation import IrrigationController, load_zones
+import crop_whatif
+import crop_explain
+from model_pool import DEFAULT_KEY as DEFAULT_MODEL_KEY, ModelPool
+import detect_com_port
 
 # --- 1. Initialize the Flask App ---
 # Flask is a lightweight framework for building web applications and APIs in Python.
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes to allow frontend access
 
-# Store sensor data history in memory (in production, use a database)
-sensor_history = []
-latest_sensor_data = {
+# Leveled, rate-limited logging for per-reading and per-request messages
+setup_logging()
+logger = logging.getLogger('agrosmart.server')
+
+# Store sensor data history in memory (in production, use a database).
+# The latest reading and the history are published together as immutable,
+# versioned snapshots: request handlers read sensor_state.snapshot once and
+# never lock, the serial thread and /predict publish new readings.
+SENSOR_HISTORY_LIMIT = 100  # Keep only the last 100 readings
+SENSOR_LONG_POLL_MAX = 30  # seconds a client may wait for a new reading
+sensor_state = VersionedStore({
     'temperature': 0,
     'humidity': 0,
     'soil_moisture': 0,
@@ -27,10 +54,30 @@ latest_sensor_data = {
     'K': 0,
     'rainfall': 0,
     'timestamp': None
-}
+}, history_limit=SENSOR_HISTORY_LIMIT)
+
+# Rolling statistics (mean, variance, min/max, rate of change, EWMA) of every
+# sensor field, updated incrementally as readings are published.
+# AGROSMART_STATS_WINDOWS: comma-separated window lengths in seconds
+SENSOR_STATS_WINDOWS = [int(seconds) for seconds in os.getenv('AGROSMART_STATS_WINDOWS', '300,3600,86400').split(',')]
+sensor_stats = RollingStats(SENSOR_STATS_WINDOWS)
+
+# Shared-memory sensor bus (sensor_bus.py): with AGROSMART_SENSOR_BUS=1 every
+# published reading and its prediction also go into a shared-memory ring that
+# local processes (e.g. the bridge with AGROSMART_BRIDGE_SOURCE=bus) read
+# without opening the serial port or loading the model themselves
+SENSOR_BUS_ENABLED = os.getenv('AGROSMART_SENSOR_BUS', '0') == '1'
+sensor_bus = None  # created in __main__
+
+# Long-term compressed archive of every reading (sensor_archive.py), one
+# series per device, e.g. on the gateway's SD card. Set AGROSMART_ARCHIVE_DIR
+# to enable it; query it with /api/sensors/archive
+ARCHIVE_DIR = os.getenv('AGROSMART_ARCHIVE_DIR', '')
+sensor_archive = SensorArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None  # flushing starts in __main__
 
 # Weather API configuration
 WEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY', '3d0f470cb64243c0b4494926250411')  # WeatherAPI key
+WEATHER_API_URL = os.getenv('WEATHER_API_URL', 'http://api.weatherapi.com/v1/current.json')
 DEFAULT_CITY = "Mumbai"  # Mumbai, India
 weather_cache = {
     'data': None,
@@ -38,19 +85,207 @@ weather_cache = {
 }
 WEATHER_CACHE_DURATION = 3600  # 1 hour in seconds
 
+# LM Studio configuration (OpenAI-compatible API, default runs on localhost:1234)
+LMSTUDIO_URL = os.getenv('LMSTUDIO_URL', 'http://localhost:1234/v1/chat/completions')
+LMSTUDIO_TIMEOUT = 30  # seconds
+LMSTUDIO_BUSY_MESSAGE = "The AI assistant is busy helping other users. Please try again in a moment."
+
+# Only a few chat requests may use the local LLM at once (match the model's capacity);
+# the rest wait briefly in a fair per-client queue (keyed on the client's address,
+# which a client cannot change per request) or are turned away with 429/503
+llm_scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '1')),
+    max_queue=int(os.getenv('LLM_MAX_QUEUE', '8')),
+    max_queue_per_client=int(os.getenv('LLM_MAX_QUEUE_PER_CLIENT', '2')),
+    queue_timeout=float(os.getenv('LLM_QUEUE_TIMEOUT', '0.5'))
+)
+LLM_RETRY_AFTER = int(os.getenv('LLM_RETRY_AFTER', '5'))  # seconds, sent with 429/503 chat responses
+LMSTUDIO_OFFLINE_MESSAGE = "⚠️ I couldn't connect to the local AI assistant. Please install and start LM Studio:\n\n1. Download from https://lmstudio.ai\n2. Load LLaMA 2 7B model (or any model you prefer)\n3. Start the local server (click the ↔ icon in LM Studio)\n4. Make sure it's running on port 1234\n\nLM Studio makes running local AI super easy with a GUI!"
+
+# Chatbot response cache: repeated questions against similar farm conditions
+# are answered from memory instead of running the LLM again
+CHAT_CACHE_TTL = 900  # 15 minutes in seconds
+CHAT_CACHE_MAX_ENTRIES = 256
+chat_cache = OrderedDict()  # key -> {'response': ..., 'created': ...}, oldest first
+chat_cache_lock = threading.Lock()
+
+# Agronomic bands used to quantize the chat context for the cache key.
+# Readings in the same band get the same advice (e.g. soil moisture below 40% means "irrigate").
+CHAT_CONTEXT_BANDS = {
+    'temperature': [10, 18, 24, 30, 35],   # cold / cool / mild / warm / hot / very hot (°C)
+    'humidity': [30, 50, 70, 85],          # dry / moderate / humid / very humid (%)
+    'soil_moisture': [20, 40, 60, 80],     # very dry / dry / adequate / moist / saturated (%)
+    'N': [40, 80, 120],                    # low / medium / high / very high
+    'P': [30, 60, 100],
+    'K': [30, 60, 150]
+}
+
+# Multi-turn chat sessions: history is kept server-side per session_id,
+# trimmed to a token budget so prompts stay small
+CHAT_SESSION_TTL = 3600  # 1 hour in seconds
+CHAT_MAX_SESSIONS = 200
+CHAT_HISTORY_TOKEN_BUDGET = 1024
+chat_sessions = OrderedDict()  # session_id -> {'history': [...], 'history_tokens': ..., 'last_used': ...}
+chat_sessions_lock = threading.Lock()
+
+# Per-request chat stats (prompt tokens, time-to-first-token, tokens/sec), keep last 100
+chat_request_stats = []
+
+# Background retraining: labeled field readings are appended to FIELD_DATA_FILENAME,
+# a low-priority process folds them into the model and atomically replaces MODEL_FILENAME,
+# and the server swaps the new model in when the file changes
+MODEL_FILENAME = 'crop_recommendation_model.joblib'
+FIELD_DATA_FILENAME = 'field_data.csv'
+FIELD_DATA_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall', 'label']
+field_data_lock = threading.Lock()
+RETRAIN_ENABLED = os.getenv('AGROSMART_RETRAIN', '1') == '1'
+RETRAIN_INTERVAL = int(os.getenv('AGROSMART_RETRAIN_INTERVAL', '3600'))  # seconds
+MODEL_RELOAD_INTERVAL = 15  # seconds between checks for a newly published model
+
+# Prometheus-style metrics, served at GET /metrics (HTTP handler time per route is recorded automatically)
+install_flask_metrics(app)
+SERIAL_LINES = Counter('agrosmart_serial_lines_total', 'Lines read from the ESP32 serial port', ['result'])
+SERIAL_PARSE_SECONDS = Histogram('agrosmart_serial_parse_seconds', 'Time to parse one serial line')
+INFERENCE_SECONDS = Histogram('agrosmart_inference_seconds', 'Crop model prediction time')
+PREDICTIONS = Counter('agrosmart_predictions_total', 'Crop predictions made', ['result'])
+CACHE_REQUESTS = Counter('agrosmart_cache_requests_total', 'Weather and chat cache lookups', ['cache', 'result'])
+WEATHER_UPSTREAM_SECONDS = Histogram('agrosmart_weather_upstream_seconds', 'WeatherAPI request time')
+WEATHER_UPSTREAM_REQUESTS = Counter('agrosmart_weather_upstream_requests_total', 'WeatherAPI requests', ['result'])
+LLM_UPSTREAM_SECONDS = Histogram('agrosmart_llm_upstream_seconds', 'LM Studio request time (whole response)', ['endpoint'])
+LLM_FIRST_TOKEN_SECONDS = Histogram('agrosmart_llm_time_to_first_token_seconds', 'LM Studio time to first streamed token')
+LLM_UPSTREAM_REQUESTS = Counter('agrosmart_llm_upstream_requests_total', 'LM Studio requests', ['endpoint', 'result'])
+LLM_REJECTIONS = Counter('agrosmart_llm_rejections_total', 'Chat requests turned away by the LLM scheduler', ['reason'])
+LLM_QUEUE_DEPTH = Gauge('agrosmart_llm_queue_depth', 'Chat requests waiting for an LLM slot')
+LLM_QUEUE_DEPTH.set_function(lambda: llm_scheduler.stats()['queued'])
+LLM_ACTIVE = Gauge('agrosmart_llm_active_requests', 'Chat requests currently using the LLM')
+LLM_ACTIVE.set_function(lambda: llm_scheduler.stats()['active'])
+SENSOR_HISTORY_SIZE = Gauge('agrosmart_sensor_history_size', 'Readings kept in the in-memory history')
+SENSOR_HISTORY_SIZE.set_function(lambda: len(sensor_state.snapshot.history))
+SENSOR_STATE_VERSION = Gauge('agrosmart_sensor_state_version', 'Version of the published sensor state')
+SENSOR_STATE_VERSION.set_function(lambda: sensor_state.version)
+
 # --- 2. Load the Trained Model ---
-# This line loads the model you trained and saved earlier.
+# pandas, scikit-learn (via joblib) and requests take seconds to import on small
+# gateways, so they are imported lazily. With AGROSMART_FAST_START=1 (default)
+# the port is bound immediately and warm_up() loads everything in the background;
+# /api/ready reports when inference is available. Set it to 0 to load first.
 # The script expects 'crop_recommendation_model.joblib' to be in the same folder.
-print("Loading the machine learning model...")
-try:
-    model = joblib.load('crop_recommendation_model.joblib')
-    print("Model loaded successfully.")
-except FileNotFoundError:
-    print("Error: 'crop_recommendation_model.joblib' not found. Make sure the model file is in the same directory.")
-    model = None
-except Exception as e:
-    print(f"An error occurred while loading the model: {e}")
-    model = None
+FAST_START = os.getenv('AGROSMART_FAST_START', '1') == '1'
+model = None  # the default model (model_pool's DEFAULT_MODEL_KEY)
+warmup_status = {
+    'state': 'starting',  # starting -> warming_up -> ready | failed
+    'error': None,
+    'steps_ms': {},
+    'warmup_seconds': None
+}
+SERVER_STARTED_AT = time.time()
+
+def prepare_model(loaded_model):
+    """
+    Precomputes a newly loaded model's explanation tables, so its first
+    prediction does not pay for them; returns their size for the model pool
+    """
+    explainer = crop_explain.compile_model(loaded_model)
+    return explainer.nbytes if explainer is not None else 0
+
+# Per-region / per-device models (model_pool.py): each reading is predicted by
+# the model its device ID routes to (AGROSMART_REGION_MAP, AGROSMART_MODEL_DIR),
+# loaded on first use and kept within AGROSMART_MODEL_POOL_MB; the default
+# model (MODEL_FILENAME) is always loaded
+model_pool = ModelPool(MODEL_FILENAME, prepare=prepare_model)
+
+def warm_up():
+    """
+    Imports the heavy libraries, loads the model and runs one prediction so
+    the first real request does not pay for lazy initialization.
+    Step timings are reported by /api/ready.
+    """
+    global model
+    warmup_status['state'] = 'warming_up'
+    started = last = time.perf_counter()
+    
+    def lap(step):
+        nonlocal last
+        now = time.perf_counter()
+        warmup_status['steps_ms'][step] = round((now - last) * 1000, 1)
+        last = now
+    
+    print("Loading the machine learning model...")
+    try:
+        import pandas as pd
+        lap('import_pandas')
+        import requests
+        lap('import_requests')
+        import joblib
+        lap('import_joblib')
+        # Loading through the pool also precomputes the explanation tables (prepare_model)
+        loaded_model = model_pool.get(DEFAULT_MODEL_KEY)
+        lap('load_model')
+        loaded_model.predict(pd.DataFrame([[90, 42, 43, 20.8, 82.0, 202.9]], columns=FIELD_DATA_COLUMNS[:-1]))
+        lap('first_prediction')
+        
+        model = loaded_model
+        warmup_status['state'] = 'ready'
+        print("Model loaded successfully.")
+    except FileNotFoundError:
+        warmup_status.update(state='failed', error=f"'{MODEL_FILENAME}' not found")
+        print("Error: 'crop_recommendation_model.joblib' not found. Make sure the model file is in the same directory.")
+    except Exception as e:
+        warmup_status.update(state='failed', error=str(e))
+        print(f"An error occurred while loading the model: {e}")
+    warmup_status['warmup_seconds'] = round(time.perf_counter() - started, 2)
+
+def complete_startup():
+    """
+    Warms up, then starts the model file watcher and the retraining process.
+    Retraining is forked only after warm-up, so the child never inherits a
+    half-finished import from the warm-up thread.
+    """
+    warm_up()
+    # Pick up models published by the retraining process
+    threading.Thread(target=watch_model_file, daemon=True).start()
+    if RETRAIN_ENABLED:
+        start_retraining_process()
+        print(f"Background retraining started (every {RETRAIN_INTERVAL // 60} minutes)")
+
+def watch_model_file():
+    """
+    Reloads models whenever their file changes (e.g. the retraining process
+    publishes a new default model) and picks up region map changes. New models
+    are loaded on this thread and swapped in with a single assignment, so
+    in-flight predictions keep using the old one.
+    """
+    global model
+    while True:
+        time.sleep(MODEL_RELOAD_INTERVAL)
+        try:
+            reloaded = model_pool.refresh()
+            if model is None:
+                # The default model failed to load at startup: retry once its file exists
+                model = model_pool.get(DEFAULT_MODEL_KEY)
+                print("Default model loaded")
+            elif DEFAULT_MODEL_KEY in reloaded:
+                model = model_pool.peek(DEFAULT_MODEL_KEY) or model
+                print(f"Reloaded retrained model ({len(getattr(model, 'estimators_', []))} trees)")
+            for key in reloaded:
+                if key != DEFAULT_MODEL_KEY:
+                    print(f"Reloaded model '{key}'")
+        except Exception as e:
+            print(f"Error reloading model: {e}")
+
+def start_retraining_process():
+    """
+    Starts the background retraining worker in its own process
+    """
+    from retrain_worker import run_retraining_loop
+    
+    process = multiprocessing.Process(
+        target=run_retraining_loop,
+        kwargs={'interval': RETRAIN_INTERVAL, 'field_data': FIELD_DATA_FILENAME, 'model_filename': MODEL_FILENAME},
+        daemon=True
+    )
+    process.start()
+    return process
 
 def fetch_weather_data(city=DEFAULT_CITY):
     """
@@ -58,17 +293,20 @@ def fetch_weather_data(city=DEFAULT_CITY):
     Falls back to mock data if API key is not set or request fails
     """
     global weather_cache
+    import requests
     
     # Check if cache is still valid (less than 1 hour old)
     if weather_cache['data'] and weather_cache['last_updated']:
         time_since_update = time.time() - weather_cache['last_updated']
         if time_since_update < WEATHER_CACHE_DURATION:
-            print(f"Using cached weather data (updated {int(time_since_update/60)} minutes ago)")
+            logger.debug("Using cached weather data (updated %d minutes ago)", time_since_update // 60)
+            CACHE_REQUESTS.inc(cache='weather', result='hit')
             return weather_cache['data']
+    CACHE_REQUESTS.inc(cache='weather', result='miss')
     
     # If no API key, return mock data
     if not WEATHER_API_KEY:
-        print("No WeatherAPI key found. Using mock weather data.")
+        logger.info("No WeatherAPI key found. Using mock weather data.")
         mock_data = {
             'condition': 'sunny',
             'temperature': 28,
@@ -83,8 +321,9 @@ def fetch_weather_data(city=DEFAULT_CITY):
     
     try:
         # Fetch from WeatherAPI.com
-        url = f"http://api.weatherapi.com/v1/current.json?key={WEATHER_API_KEY}&q={city}&aqi=no"
-        response = requests.get(url, timeout=5)
+        url = f"{WEATHER_API_URL}?key={WEATHER_API_KEY}&q={city}&aqi=no"
+        with WEATHER_UPSTREAM_SECONDS.time():
+            response = requests.get(url, timeout=5)
         response.raise_for_status()
         data = response.json()
         
@@ -110,11 +349,13 @@ def fetch_weather_data(city=DEFAULT_CITY):
         weather_cache['data'] = weather_data
         weather_cache['last_updated'] = time.time()
         
-        print(f"Weather data fetched successfully for {city}: {weather_data['temperature']}°C, {weather_data['forecast']}")
+        WEATHER_UPSTREAM_REQUESTS.inc(result='ok')
+        logger.info("Weather data fetched successfully for %s: %s°C, %s", city, weather_data['temperature'], weather_data['forecast'])
         return weather_data
         
     except Exception as e:
-        print(f"Error fetching weather data: {e}")
+        WEATHER_UPSTREAM_REQUESTS.inc(result='error')
+        logger.warning("Error fetching weather data: %s", e)
         # Return mock data as fallback
         mock_data = {
             'condition': 'sunny',
@@ -127,115 +368,231 @@ def fetch_weather_data(city=DEFAULT_CITY):
         return mock_data
 
 # --- Serial Communication with ESP32 ---
-ser = None  # Global serial connection object
+# The port itself is owned by serial_link (a SerialSupervisor, created below):
+# it connects, notices unplugging and reconnects with backoff on its own thread.
+# Serial writer: commands to the ESP32 are written under this lock; the ESP32
+# answers each one in order with an ACK:/ERROR: line, which the reader thread
+# matches to the oldest pending command
+serial_write_lock = threading.Lock()
+pending_serial_acks = deque(maxlen=32)  # (command, on_ack or None)
+device_clocks = {}  # 'serial' or device IP -> DeviceClock, for tracing reading latency
+
+# Ingest gateway for WiFi ESP32 fleets: an asyncio listener (newline-delimited
+# JSON over TCP, HTTP keep-alive POST /predict, UDP datagrams) that batches
+# readings into ingest_batch(). AGROSMART_GATEWAY_PORT=0 (default) disables it.
+GATEWAY_PORT = int(os.getenv('AGROSMART_GATEWAY_PORT', '0'))
+ingest_gateway = None
+
+def send_serial_command(command, on_ack=None):
+    """
+    Writes one command line to the ESP32. `on_ack(acked_at)` is called when
+    the ESP32 acknowledges it. Returns False if the ESP32 is not connected.
+    """
+    port = serial_link.current()
+    if port is None:
+        return False
+    with serial_write_lock:
+        try:
+            port.write(f"{command}\n".encode())
+        except (serial.SerialException, OSError) as e:
+            serial_link.report_failure(port, e)
+            return False
+        pending_serial_acks.append((command, on_ack))
+    return True
+
+def serial_command_answered(line, received_at):
+    """
+    Called by the reader thread for ACK:/ERROR: lines
+    """
+    try:
+        command, on_ack = pending_serial_acks.popleft()
+    except IndexError:
+        return
+    logger.info("ESP32 response to %s: %s", command, line)
+    if on_ack is not None and line.startswith('ACK:'):
+        on_ack(received_at)
+
+# Server-side irrigation control: every reading is fed to the controller,
+# which switches zone pumps (hysteresis, min on/off times, rain suppression
+# from the weather cache). Zones come from AGROSMART_IRRIGATION_ZONES (JSON).
+# It is opt-in (AGROSMART_IRRIGATION=1); by default pump control stays with
+# the ESP32's automatic mode.
+def cached_weather():
+    """The cached weather if it is still fresh, without fetching"""
+    if weather_cache['last_updated'] and time.time() - weather_cache['last_updated'] < WEATHER_CACHE_DURATION:
+        return weather_cache['data']
+    return None
+
+IRRIGATION_ENABLED = os.getenv('AGROSMART_IRRIGATION', '0') == '1'
+irrigation = IrrigationController(load_zones(), send_serial_command, cached_weather) if IRRIGATION_ENABLED else None
 
 def find_esp32_port():
     """
-    Automatically detect the ESP32's COM port by looking for Silicon Labs CP210x
-    """
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        if 'CP210' in port.description or 'Silicon Labs' in port.description:
-            print(f"Found ESP32 on port: {port.device}")
-            return port.device
-        # Also check for CH340 which is another common USB-to-serial chip
-        if 'CH340' in port.description:
-            print(f"Found ESP32 on port: {port.device}")
-            return port.device
+    Automatically detect the ESP32's COM port: all USB serial ports are probed
+    in parallel for the AgroSmart firmware's output (see detect_com_port.py).
+    If no port identifies itself within the probe timeout, falls back to the
+    first port with a known ESP32 USB chip (Silicon Labs CP210x, CH340, ...).
+    """
+    devices = detect_com_port.detect_devices()
+    for device in devices:
+        if device['board']:
+            logger.info("Found ESP32 on port: %s (%s%s)", device['port'], device['signature'],
+                        ", cached" if device['cached'] else "")
+            return device['port']
+    for device in devices:
+        if device['known_chip'] and device['error'] is None:
+            logger.info("Found possible ESP32 on port: %s (%s)", device['port'], device['description'])
+            return device['port']
     return None
 
-def connect_to_esp32():
+def open_esp32_port(port):
     """
-    Establish serial connection to ESP32
+    Opens the ESP32's serial port (called by the connection supervisor)
     """
-    global ser
-    port = find_esp32_port()
-    
-    if port is None:
-        print("ESP32 not found. Please check USB connection.")
-        return False
-    
     try:
-        ser = serial.Serial(port, 115200, timeout=1)
-        print(f"Connected to ESP32 on {port}")
-        return True
-    except Exception as e:
-        print(f"Error connecting to ESP32: {e}")
-        return False
+        return open_serial_port(port)
+    except Exception:
+        # Probe it again next time instead of trusting the cached result
+        detect_com_port.forget_port(port)
+        raise
 
-def read_sensor_data():
+def esp32_connected(port):
+    """
+    Commands sent over the previous connection will never be acknowledged
+    """
+    pending_serial_acks.clear()
+
+serial_link = SerialSupervisor(find_esp32_port, open_esp32_port, on_connect=esp32_connected,
+                               on_plugged=detect_com_port.forget_ports)
+
+def parse_sensor_line(line, received_at=None):
     """
-    Continuously read sensor data from ESP32 in a separate thread
+    Parses one JSON line from the ESP32 into a sensor reading (validated and
+    defaulted by the reading schema, see reading_schema.py).
+    Returns None if the line is not JSON (e.g. boot messages or ACKs); raises
+    ReadingError for readings the schema rejects.
+    The reading carries a latency trace starting at `received_at` (time.time()
+    when the line arrived) and is timestamped with the device's sample time.
     """
-    global latest_sensor_data, sensor_history, ser
+    if received_at is None:
+        received_at = time.time()
+    reading = reading_schema.parse_line(line, 'serial')
+    if reading is None:
+        return None
     
+    trace = start_trace(reading, received_at, device_clocks.setdefault('serial', DeviceClock()))
+    reading['timestamp'] = datetime.fromtimestamp(trace['sampled_at'] or received_at).isoformat()
+    reading['trace'] = trace
+    mark(trace, 'parsed')
+    return reading
+
+def publish_reading(reading):
+    """
+    Publishes a complete reading as the latest one and appends it to the
+    history (last SENSOR_HISTORY_LIMIT entries). The reading is frozen: build
+    it fully before publishing. Also folds it into the rolling statistics.
+    """
+    return publish_readings([reading])
+
+def publish_readings(readings):
+    """
+    publish_reading for a batch: one snapshot swap for all readings, the last
+    one becomes the latest reading
+    """
+    for reading in readings:
+        trace = reading.get('trace') or {}
+        sensor_stats.add(reading, trace.get('sampled_at') or trace.get('received_at'))
+    if sensor_bus is not None:
+        sensor_bus.publish(readings)
+    if sensor_archive is not None:
+        sensor_archive.append(readings)
+    return sensor_state.publish_many(readings)
+
+def read_sensor_data():
+    """
+    Continuously read sensor data from ESP32 in a separate thread.
+    Connecting and reconnecting is left to serial_link: a read error is
+    reported to it and the loop waits for the next connection.
+    """
     while True:
+        port = serial_link.wait_connected(timeout=1)
+        if port is None:
+            continue
         try:
-            if ser and ser.in_waiting > 0:
-                line = ser.readline().decode('utf-8').strip()
-                
-                # Try to parse as JSON
-                try:
-                    data = json.loads(line)
-                    
-                    # Update latest sensor data
-                    latest_sensor_data = {
-                        'temperature': data.get('temperature', 0),
-                        'humidity': data.get('humidity', 0),
-                        'soil_moisture': data.get('soil_moisture', 0),
-                        'N': data.get('N', 0),
-                        'P': data.get('P', 0),
-                        'K': data.get('K', 0),
-                        'rainfall': data.get('rainfall', 0),
-                        'pump_command': data.get('pump_command', 'PUMP_OFF'),  # Get pump status from ESP32
-                        'timestamp': datetime.now().isoformat()
-                    }
-                    
-                    # Run ML model to get crop recommendation
-                    if model is not None:
-                        try:
-                            prediction_input = {
-                                'N': latest_sensor_data['N'],
-                                'P': latest_sensor_data['P'],
-                                'K': latest_sensor_data['K'],
-                                'temperature': latest_sensor_data['temperature'],
-                                'humidity': latest_sensor_data['humidity'],
-                                'rainfall': latest_sensor_data['rainfall'],
-                                'soil_moisture': latest_sensor_data['soil_moisture']
-                            }
-                            crop_prediction, pump_cmd = make_prediction(prediction_input)
-                            latest_sensor_data['recommended_crop'] = crop_prediction
-                            # Note: Pump command from make_prediction is for logging only
-                            # Actual pump control is handled by ESP32
-                            print(f"Prediction successful. Recommended Crop: {crop_prediction}, ESP32 Pump: {latest_sensor_data['pump_command']}")
-                        except Exception as pred_error:
-                            print(f"Error making crop prediction: {pred_error}")
-                            latest_sensor_data['recommended_crop'] = 'Error'
-                    
-                    # Add to history
-                    sensor_history.append(latest_sensor_data.copy())
-                    
-                    # Keep only last 100 readings
-                    if len(sensor_history) > 100:
-                        sensor_history.pop(0)
-                    
-                    print(f"Received sensor data: Temp={latest_sensor_data['temperature']}°C, "
-                          f"Humidity={latest_sensor_data['humidity']}%, "
-                          f"Soil Moisture={latest_sensor_data['soil_moisture']}%, "
-                          f"Pump={latest_sensor_data['pump_command']}")
-                    
-                except json.JSONDecodeError:
-                    # If not JSON, just print the raw line
-                    print(f"ESP32: {line}")
-                    
+            # Blocks until a full line arrives (or the port's 1 s timeout), so
+            # readings and ACKs are handled as soon as they come in
+            line = port.readline()
         except Exception as e:
-            print(f"Error reading sensor data: {e}")
-            # Try to reconnect
-            time.sleep(5)
-            if not connect_to_esp32():
-                print("Failed to reconnect to ESP32")
-        
-        time.sleep(0.1)  # Small delay to prevent CPU hogging
+            logger.error("Error reading from ESP32: %s", e)
+            serial_link.report_failure(port, e)
+            continue
+        if not line:
+            continue
+        try:
+            handle_serial_line(line.decode('utf-8').strip(), time.time())
+        except Exception as e:
+            logger.error("Error reading sensor data: %s", e)
+
+def handle_serial_line(line, received_at):
+    """
+    Processes one line from the ESP32: a sensor reading, or an ACK/ERROR/log line
+    """
+    # Try to parse as JSON
+    try:
+        with SERIAL_PARSE_SECONDS.time():
+            reading = parse_sensor_line(line, received_at)
+    except ReadingError as e:
+        SERIAL_LINES.inc(result='rejected')
+        logger.warning("Rejected ESP32 reading: %s", e)
+        return
+    if reading is None:
+        SERIAL_LINES.inc(result='other')
+        if line.startswith(('ACK:', 'ERROR:')):
+            serial_command_answered(line, received_at)
+        else:
+            # If not JSON, just log the raw line
+            logger.info("ESP32: %s", line)
+        return
+    
+    SERIAL_LINES.inc(result='reading')
+    
+    # Irrigation decisions come first: they do not wait for the crop model
+    if irrigation is not None:
+        irrigation.on_reading(reading, 'serial', received_at)
+    
+    # Run ML model to get crop recommendation
+    if model is not None:
+        try:
+            prediction_input = {
+                'N': reading['N'],
+                'P': reading['P'],
+                'K': reading['K'],
+                'temperature': reading['temperature'],
+                'humidity': reading['humidity'],
+                'rainfall': reading['rainfall'],
+                'soil_moisture': reading['soil_moisture']
+            }
+            crop_prediction, pump_cmd, explanation = make_predictions([prediction_input], [reading.get('device_id')])[0]
+            reading['recommended_crop'] = crop_prediction
+            reading['explanation'] = explanation
+            # Note: Pump command from make_prediction is for logging only
+            # Actual pump control is handled by the irrigation controller
+            # (or the ESP32's automatic mode when it is disabled)
+            logger.debug("Prediction successful. Recommended Crop: %s, ESP32 Pump: %s",
+                         crop_prediction, reading['pump_command'])
+        except Exception as pred_error:
+            logger.error("Error making crop prediction: %s", pred_error)
+            reading['recommended_crop'] = 'Error'
+        mark(reading['trace'], 'inferred')
+    
+    # Publish the complete reading and add it to history
+    mark(reading['trace'], 'stored')
+    publish_reading(reading)
+    finish_ingest(reading['trace'])
+    
+    logger.info("Received sensor data: Temp=%s°C, Humidity=%s%%, Soil Moisture=%s%%, Pump=%s",
+                reading['temperature'], reading['humidity'],
+                reading['soil_moisture'], reading['pump_command'])
 
 # --- 3. Define the Prediction Logic ---
 def make_prediction(data):
@@ -243,34 +600,116 @@ def make_prediction(data):
     Takes sensor and API data, formats it, and returns a crop prediction
     and a pump control command.
     """
-    if model is None:
-        return "Model not loaded", "Error"
+    # Note: This pump_command is for reference only
+    # Actual pump control is handled by the irrigation controller / ESP32 automatic mode
+    crop_prediction, pump_command, _ = make_predictions([data])[0]
+    return crop_prediction, pump_command
 
-    # The model expects specific column names. Create a DataFrame from the input data.
-    # The feature order must match the training data: ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
-    try:
-        feature_columns = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
-        df = pd.DataFrame([data], columns=feature_columns)
-
-        # Use the model to predict the crop
-        crop_prediction = model.predict(df)[0]
+def pump_command_for(data):
+    """
+    Simple pump control logic: automatic control based on soil moisture
+    """
+    soil_moisture = float(data.get('soil_moisture', 100))  # Use a default if not provided
+    
+    # Turn on the pump if soil moisture is below 40%
+    return "PUMP_ON" if soil_moisture < 40 else "PUMP_OFF"
 
-        # --- Simple Pump Control Logic ---
-        # Automatic control based on soil moisture
-        pump_command = "PUMP_OFF"
-        soil_moisture = data.get('soil_moisture', 100) # Use a default if not provided
-        
-        # Turn on the pump if soil moisture is below 40%
-        if soil_moisture < 40:
-            pump_command = "PUMP_ON"
-        
-        # Note: This pump_command is for reference only
-        # Actual pump control is handled by ESP32 automatic mode
-        return crop_prediction, pump_command
+def make_predictions(batch, device_ids=None):
+    """
+    make_prediction for a list of readings, with a single call per model.
+    Each reading is predicted by the model its device routes to (device_ids,
+    parallel to batch; see model_pool.py), or the default model.
+    Returns one (crop, pump_command, explanation) per reading; readings with
+    missing or non-numeric values get ("Prediction Error", "Error", None).
+    The explanation (confidence and per-feature contributions, see
+    crop_explain.py) comes from the same pass over the trees as the crop, and
+    names the model that made the prediction.
+    """
+    if model is None:
+        return [("Model not loaded", "Error", None)] * len(batch)
+    import pandas as pd
+    
+    # The feature order must match the training data: ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
+    feature_columns = FIELD_DATA_COLUMNS[:-1]
+    results = [("Prediction Error", "Error", None)] * len(batch)
+    groups = {}  # model key -> (rows, indices into batch)
+    for index, data in enumerate(batch):
+        try:
+            row = [float(data[column]) for column in feature_columns]
+            pump_command_for(data)
+        except (KeyError, TypeError, ValueError):
+            PREDICTIONS.inc(result='error')
+            continue
+        rows, valid = groups.setdefault(model_pool.route(device_ids[index] if device_ids else None), ([], []))
+        rows.append(row)
+        valid.append(index)
+    
+    for key, (rows, valid) in groups.items():
+        # Loads the model on its first use; falls back to the default model
+        key, group_model = model_pool.model_for(key=key)
+        if group_model is None:
+            group_model, key = model, DEFAULT_MODEL_KEY
+        try:
+            with INFERENCE_SECONDS.time():
+                explained = crop_explain.explain_rows(group_model, rows)
+                if explained is None:
+                    # Not a tree ensemble: predict without explanations
+                    explained = [(crop, None) for crop in group_model.predict(pd.DataFrame(rows, columns=feature_columns))]
+            PREDICTIONS.inc(len(rows), result='ok')
+            for index, (crop, explanation) in zip(valid, explained):
+                if explanation is not None:
+                    explanation['model'] = key
+                results[index] = (crop, pump_command_for(batch[index]), explanation)
+        except Exception as e:
+            PREDICTIONS.inc(len(rows), result='error')
+            logger.error("Error during batch prediction (model '%s'): %s", key, e)
+    return results
 
-    except Exception as e:
-        print(f"Error during prediction: {e}")
-        return "Prediction Error", "Error"
+def ingest_batch(items):
+    """
+    Ingest gateway batch handler: one model call and one state update for a
+    batch of device readings. `items` are (data, device_id, received_at);
+    returns the /predict reply for each reading (400 for readings the
+    reading schema rejects).
+    """
+    if model is None and warmup_status['state'] in ('starting', 'warming_up'):
+        return [{'error': 'Model is warming up, retry shortly', 'status': 503}] * len(items)
+    
+    replies = [None] * len(items)
+    accepted, traces, irrigation_commands = [], [], []
+    for index, (data, device_id, received_at) in enumerate(items):
+        try:
+            data = reading_schema.coerce(data, 'gateway')
+        except ReadingError as e:
+            replies[index] = {'seq': data.get('seq'), 'error': str(e), 'fields': e.errors, 'status': 400}
+            continue
+        trace = start_trace(data, received_at, device_clocks.setdefault(device_id, DeviceClock()))
+        mark(trace, 'parsed')
+        accepted.append((index, data, device_id, received_at))
+        traces.append(trace)
+        irrigation_commands.append(irrigation.on_reading(data, device_id, received_at) if irrigation is not None else None)
+    
+    predictions = make_predictions([data for _, data, _, _ in accepted],
+                                   [data.get('device_id') or device_id for _, data, device_id, _ in accepted])
+    readings = []
+    for (index, data, device_id, received_at), trace, (crop, pump_action, explanation), irrigation_command in zip(
+            accepted, traces, predictions, irrigation_commands):
+        if irrigation_command is not None:
+            pump_action = irrigation_command
+        mark(trace, 'inferred')
+        reading = dict(data, recommended_crop=crop, explanation=explanation, pump_command=pump_action,
+                       device_id=device_id, timestamp=datetime.fromtimestamp(trace['sampled_at'] or received_at).isoformat(),
+                       trace=trace)
+        readings.append(reading)
+        replies[index] = {'seq': data.get('seq'), 'recommended_crop': crop, 'pump_command': pump_action}
+    
+    for trace in traces:
+        mark(trace, 'stored')
+    if readings:
+        publish_readings(readings)
+    for trace in traces:
+        finish_ingest(trace)
+    return replies
 
 # --- 4. Create an API Endpoint ---
 # This sets up a URL (e.g., http://your-pc-ip:5000/predict) that the ESP32 will send data to.
@@ -280,18 +719,31 @@ def predict():
     """
     Receives data from the ESP32, makes a prediction, and returns the result.
     """
-    print("\nReceived a request on /predict")
-    # Get the JSON data sent by the ESP32
-    data = request.get_json()
-
-    if not data:
-        print("Error: No data received.")
-        return jsonify({"error": "No input data provided"}), 400
+    received_at = time.time()
+    if model is None and warmup_status['state'] in ('starting', 'warming_up'):
+        response = jsonify({"error": "Model is warming up, retry shortly"})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    
+    # Get the JSON data sent by the ESP32, validated by the reading schema
+    try:
+        data = reading_schema.parse(request.get_data(), 'http')
+    except ReadingError as e:
+        logger.warning("Rejected reading on /predict: %s", e)
+        return jsonify({"error": str(e), "fields": e.errors}), 400
 
-    print("Data received from ESP32:", data)
+    logger.debug("Data received from ESP32 on /predict: %s", data)
+    trace = start_trace(data, received_at, device_clocks.setdefault(request.remote_addr, DeviceClock()))
+    mark(trace, 'parsed')
+    irrigation_command = None
+    if irrigation is not None:
+        irrigation_command = irrigation.on_reading(data, data.get('device_id') or request.remote_addr, received_at)
     
     # Call our prediction function
-    crop, pump_action = make_prediction(data)
+    crop, pump_action, explanation = make_predictions([data], [data.get('device_id') or request.remote_addr])[0]
+    if irrigation_command is not None:
+        pump_action = irrigation_command
+    mark(trace, 'inferred')
     
     # Return the results to the ESP32 in JSON format
     response_data = {
@@ -299,20 +751,18 @@ def predict():
         'pump_command': pump_action
     }
     
-    # Store the sensor data with prediction for history
-    sensor_data_with_prediction = data.copy()
+    # Store the sensor data with prediction for history (data is the schema's new dict)
+    sensor_data_with_prediction = data
     sensor_data_with_prediction['recommended_crop'] = crop
+    sensor_data_with_prediction['explanation'] = explanation
     sensor_data_with_prediction['pump_command'] = pump_action
-    sensor_data_with_prediction['timestamp'] = datetime.now().isoformat()
+    sensor_data_with_prediction['timestamp'] = datetime.fromtimestamp(trace['sampled_at'] or received_at).isoformat()
+    sensor_data_with_prediction['trace'] = trace
     
-    # Update latest sensor data
-    global latest_sensor_data
-    latest_sensor_data = sensor_data_with_prediction
-    
-    # Add to history (keep last 100 entries)
-    sensor_history.append(sensor_data_with_prediction)
-    if len(sensor_history) > 100:
-        sensor_history.pop(0)
+    # Update latest sensor data and add to history (keep last 100 entries)
+    mark(trace, 'stored')
+    publish_reading(sensor_data_with_prediction)
+    finish_ingest(trace)
     
     return jsonify(response_data)
 
@@ -320,10 +770,21 @@ def predict():
 @app.route('/api/sensors/current', methods=['GET'])
 def get_current_sensors():
     """
-    Returns the latest sensor readings for the dashboard
+    Returns the latest sensor readings for the dashboard.
+    Optional long polling: ?after_version=N waits (up to ?timeout= seconds,
+    max SENSOR_LONG_POLL_MAX) until a reading newer than version N arrives.
+    The snapshot version is returned in the X-State-Version header.
     """
-    if latest_sensor_data['timestamp'] is None:
-        return jsonify({
+    after_version = request.args.get('after_version', type=int)
+    if after_version is None:
+        snapshot = sensor_state.snapshot
+    else:
+        timeout = min(request.args.get('timeout', SENSOR_LONG_POLL_MAX, type=float), SENSOR_LONG_POLL_MAX)
+        snapshot = sensor_state.wait_for_version(after_version, timeout)
+    
+    reading = snapshot.latest
+    if reading['timestamp'] is None:
+        response = jsonify({
             'temperature': 0,
             'humidity': 0,
             'soil_moisture': 0,
@@ -332,7 +793,11 @@ def get_current_sensors():
             'K': 0,
             'message': 'No data received yet'
         })
-    return jsonify(latest_sensor_data)
+    else:
+        mark_served(reading)
+        response = jsonify(reading)
+    response.headers['X-State-Version'] = str(snapshot.version)
+    return response
 
 @app.route('/api/sensors/history', methods=['GET'])
 def get_sensor_history():
@@ -341,17 +806,115 @@ def get_sensor_history():
     """
     # Get last N entries (default 24)
     limit = request.args.get('limit', 24, type=int)
-    return jsonify(sensor_history[-limit:])
+    readings = sensor_state.snapshot.history[-limit:]
+    for reading in readings:
+        mark_served(reading)
+    return jsonify(readings)
+
+@app.route('/api/sensors/archive', methods=['GET'])
+def get_sensor_archive():
+    """
+    Archived readings of one device: ?device=<id>&start=<epoch s>&end=<epoch s>
+    &field=temperature (repeatable; default all) &every=<seconds> (bucket means,
+    for charts over long ranges). Without a device, lists the archived devices.
+    """
+    if sensor_archive is None:
+        return jsonify({'enabled': False}), 404
+    device = request.args.get('device')
+    if not device:
+        return jsonify({'enabled': True, 'devices': sensor_archive.devices(), 'stats': sensor_archive.stats()})
+    fields = request.args.getlist('field') or list(ARCHIVE_FIELDS)
+    unknown = [field for field in fields if field not in ARCHIVE_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}", 'fields': list(ARCHIVE_FIELDS)}), 400
+    every = request.args.get('every', type=float)
+    try:
+        result = sensor_archive.query(device, request.args.get('start', type=float),
+                                      request.args.get('end', type=float), fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if every:
+        result = resample(result, every)
+    return jsonify({
+        'device': device,
+        'readings': len(result['timestamp']),
+        'timestamps': result['timestamp'].tolist(),
+        'fields': {field: [None if value is None or value != value else value for value in values.tolist()]
+                   for field, values in result.items() if field != 'timestamp'}
+    })
+
+@app.route('/api/sensors/latency', methods=['GET'])
+def get_sensor_latency():
+    """
+    Returns p50/p90/p99 latency of each reading stage (transport, parse,
+    inference, store, serve) plus sample-to-storage and sample-to-served age
+    """
+    return jsonify(latency_summary())
+
+@app.route('/api/readings/schema', methods=['GET'])
+def get_reading_schema():
+    """
+    The reading schema every entry point validates against (ranges and
+    defaults) and its parse statistics: readings accepted/rejected per source
+    and parse throughput
+    """
+    return jsonify({
+        'fields': {
+            field.name: {'min': field.minimum, 'max': field.maximum,
+                         'default': None if field.default is REQUIRED else field.default,
+                         'required': field.default is REQUIRED}
+            for field in SENSOR_FIELDS
+        },
+        'stats': reading_schema.stats()
+    })
+
+@app.route('/api/serial/status', methods=['GET'])
+def get_serial_status():
+    """
+    USB serial link to the ESP32: connection, reconnect counts and time spent disconnected
+    """
+    return jsonify(serial_link.status())
+
+@app.route('/api/gateway/devices', methods=['GET'])
+def get_gateway_devices():
+    """
+    Per-device connection and backlog statistics from the ingest gateway
+    """
+    if ingest_gateway is None:
+        return jsonify({'enabled': False, 'devices': {}})
+    devices = ingest_gateway.device_stats()
+    return jsonify({
+        'enabled': True,
+        'port': ingest_gateway.port,
+        'connected_devices': sum(1 for device in devices.values() if device['connections'] > 0),
+        'devices': devices
+    })
+
+@app.route('/api/sensors/stats', methods=['GET'])
+def get_sensor_stats():
+    """
+    Returns rolling statistics of each sensor field per window (e.g. 5m, 1h, 24h):
+    count, mean, variance, std, min, max, rate_per_hour, ewma, latest.
+    Optional filters: ?window=1h&field=temperature (both repeatable)
+    """
+    windows = request.args.getlist('window')
+    fields = request.args.getlist('field')
+    return jsonify({
+        'windows': sensor_stats.summary(window_labels=windows or None, fields=fields or None),
+        'version': sensor_state.version,
+        'generated_at': datetime.now().isoformat()
+    })
 
 @app.route('/api/pump/status', methods=['GET'])
 def get_pump_status():
     """
     Returns current pump status
     """
-    pump_active = latest_sensor_data.get('pump_command', 'PUMP_OFF') == 'PUMP_ON'
+    reading = sensor_state.snapshot.latest
+    pump_active = reading.get('pump_command', 'PUMP_OFF') == 'PUMP_ON'
     return jsonify({
         'active': pump_active,
-        'last_updated': latest_sensor_data.get('timestamp')
+        'last_updated': reading.get('timestamp')
     })
 
 @app.route('/api/pump/control', methods=['POST'])
@@ -360,72 +923,171 @@ def control_pump():
     Manual pump control endpoint
     Sends PUMP_ON or PUMP_OFF commands to ESP32
     """
-    global ser
-    
     data = request.get_json()
     command = data.get('command', 'PUMP_OFF')
     mode = data.get('mode', 'manual')
     
-    # Send command to ESP32 via serial
-    if ser and ser.is_open:
-        try:
-            ser.write(f"{command}\n".encode())
-            print(f"Sent {command} command to ESP32 (mode: {mode})")
-            
-            # Wait briefly for acknowledgment
-            time.sleep(0.1)
-            response_lines = []
-            while ser.in_waiting > 0:
-                line = ser.readline().decode('utf-8').strip()
-                response_lines.append(line)
-                if "ACK:" in line:
-                    print(f"ESP32 response: {line}")
-            
-            return jsonify({
-                'status': 'success',
-                'message': f'Pump command {command} sent successfully',
-                'mode': mode
-            })
-        except Exception as e:
-            print(f"Error sending pump command: {e}")
-            return jsonify({
-                'status': 'error',
-                'message': f'Failed to send command: {str(e)}'
-            }), 500
-    else:
+    # Send command to ESP32 via the serial writer (the reader thread logs the ACK)
+    try:
+        sent = send_serial_command(command)
+    except Exception as e:
+        logger.error("Error sending pump command: %s", e)
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to send command: {str(e)}'
+        }), 500
+    if not sent:
         return jsonify({
             'status': 'error',
             'message': 'ESP32 not connected'
         }), 503
+    logger.info("Sent %s command to ESP32 (mode: %s)", command, mode)
+    
+    # Manual commands pause the irrigation controller for the pump's zone; AUTO_MODE hands control back
+    if irrigation is not None:
+        if command == 'AUTO_MODE':
+            irrigation.resume()
+        elif command in ('PUMP_ON', 'PUMP_OFF'):
+            irrigation.manual_override(str(data.get('zone', irrigation.zone_for('serial'))), command)
+    
+    return jsonify({
+        'status': 'success',
+        'message': f'Pump command {command} sent successfully',
+        'mode': mode
+    })
+
+@app.route('/api/irrigation/status', methods=['GET'])
+def get_irrigation_status():
+    """
+    Returns the irrigation controller's state per zone
+    """
+    if irrigation is None:
+        return jsonify({'enabled': False, 'zones': {}})
+    return jsonify({'enabled': True, 'raining': irrigation.raining(), 'zones': irrigation.status()})
+
+@app.route('/api/field/label', methods=['POST'])
+def label_field_reading():
+    """
+    Records which crop actually suits a field reading, for background retraining.
+    Expects: {"label": "rice"} to label the latest sensor reading, or a full
+    reading {"N": ..., "P": ..., "K": ..., "temperature": ..., "humidity": ..., "rainfall": ..., "label": ...}
+    """
+    data = request.get_json(silent=True) or {}
+    label = str(data.get('label', '')).strip().lower()
+    if not label:
+        return jsonify({'status': 'error', 'message': 'No crop label provided'}), 400
+    
+    reading = data if 'temperature' in data else sensor_state.snapshot.latest
+    if reading.get('timestamp', True) is None:
+        return jsonify({'status': 'error', 'message': 'No sensor reading to label yet'}), 400
+    
+    try:
+        row = [float(reading[column]) for column in FIELD_DATA_COLUMNS[:-1]] + [label]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Reading must include N, P, K, temperature, humidity and rainfall'}), 400
+    
+    with field_data_lock:
+        new_file = not os.path.exists(FIELD_DATA_FILENAME)
+        with open(FIELD_DATA_FILENAME, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(FIELD_DATA_COLUMNS)
+            writer.writerow(row)
+    
+    return jsonify({'status': 'success', 'message': f'Reading labeled as {label}'})
 
 @app.route('/api/crop/recommendation', methods=['GET'])
 def get_crop_recommendation():
     """
     Returns the latest crop recommendation from ML prediction
     """
-    if latest_sensor_data['timestamp'] is None:
+    reading = sensor_state.snapshot.latest
+    if reading['timestamp'] is None:
         return jsonify({
             'recommended_crop': None,
             'confidence': 0,
             'message': 'No prediction available yet'
         })
     
-    recommended_crop = latest_sensor_data.get('recommended_crop', 'Unknown')
+    mark_served(reading)
+    recommended_crop = reading.get('recommended_crop', 'Unknown')
+    explanation = reading.get('explanation')
     
-    # Return crop recommendation with additional info
+    # Return crop recommendation with additional info. The explanation splits
+    # the crop's probability into the prior ('bias') plus one contribution per feature.
     return jsonify({
         'recommended_crop': recommended_crop,
-        'timestamp': latest_sensor_data.get('timestamp'),
+        'confidence': explanation['confidence'] if explanation else None,
+        'explanation': explanation,
+        'top_factors': crop_explain.top_factors(explanation) or None,
+        'timestamp': reading.get('timestamp'),
         'current_conditions': {
-            'temperature': latest_sensor_data.get('temperature'),
-            'humidity': latest_sensor_data.get('humidity'),
-            'soil_moisture': latest_sensor_data.get('soil_moisture'),
-            'N': latest_sensor_data.get('N'),
-            'P': latest_sensor_data.get('P'),
-            'K': latest_sensor_data.get('K')
+            'temperature': reading.get('temperature'),
+            'humidity': reading.get('humidity'),
+            'soil_moisture': reading.get('soil_moisture'),
+            'N': reading.get('N'),
+            'P': reading.get('P'),
+            'K': reading.get('K')
         }
     })
 
+@app.route('/api/crop/whatif', methods=['GET'])
+def get_crop_whatif():
+    """
+    Fertilizer what-if: for each crop, the smallest N/P/K change that makes the
+    model recommend it at the current temperature, humidity and rainfall, and
+    the grid region around it. Any of N, P, K, temperature, humidity, rainfall
+    can be overridden (defaults: the latest reading); ?crop= (repeatable) limits
+    the crops; ?N_step=&P_step=&K_step= (and _min/_max) change the grid;
+    ?device= uses that device's regional model.
+    """
+    if model is None:
+        response = jsonify({'error': 'Model is not loaded yet, retry shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    
+    reading = sensor_state.snapshot.latest
+    values = {}
+    for field in crop_whatif.NUTRIENTS + crop_whatif.CONDITIONS:
+        value = request.args.get(field, type=float)
+        if value is None and reading['timestamp'] is not None:
+            value = reading.get(field)
+        if value is None:
+            return jsonify({'error': f'No sensor reading yet; pass {field} as a query parameter'}), 400
+        values[field] = float(value)
+    
+    grid = {}
+    for nutrient, (start, stop, step) in crop_whatif.DEFAULT_GRID.items():
+        grid[nutrient] = (request.args.get(f'{nutrient}_min', start, type=float),
+                          request.args.get(f'{nutrient}_max', stop, type=float),
+                          request.args.get(f'{nutrient}_step', step, type=float))
+    
+    started = time.perf_counter()
+    try:
+        model_key, whatif_model = model_pool.model_for(request.args.get('device'))
+        result = crop_whatif.whatif(whatif_model or model, values,
+                                    tuple(values[field] for field in crop_whatif.CONDITIONS),
+                                    grid=grid, crops=request.args.getlist('crop') or None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    result['model'] = model_key
+    result['current'] = values
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return jsonify(result)
+
+@app.route('/api/models', methods=['GET'])
+def get_models():
+    """
+    Model pool: loaded models (least recently used first) and their estimated
+    memory, the budget, hit/miss/eviction counts and models that failed to load.
+    ?device=<id> also shows which model that device is routed to.
+    """
+    stats = model_pool.stats()
+    device = request.args.get('device')
+    if device:
+        stats['device'] = {'id': device, 'model': model_pool.route(device)}
+    return jsonify(stats)
+
 @app.route('/api/weather', methods=['GET'])
 def get_weather():
     """
@@ -436,94 +1098,530 @@ def get_weather():
     weather_data = fetch_weather_data(city)
     return jsonify(weather_data)
 
+# The instruction prefix never changes, so the LLM server can reuse its cached
+# prompt prefix (KV cache) across requests; live sensor values go last.
+CHAT_SYSTEM_PROMPT = """You are AgroSmart Assistant, an expert agricultural advisor helping farmers optimize their crop management.
+
+Each question comes with the current farm conditions from the sensors. Provide practical, actionable advice based on these conditions. Be concise, friendly, and focus on helping the farmer succeed."""
+
+def format_farm_conditions(context):
+    """
+    Formats the live sensor context as the farm-state block of the prompt
+    """
+    conditions = f"""Current Farm Conditions:
+- Temperature: {context.get('temperature', 'N/A')}°C
+- Humidity: {context.get('humidity', 'N/A')}%
+- Soil Moisture: {context.get('soil_moisture', 'N/A')}%
+- NPK Values: N={context.get('N', 'N/A')}, P={context.get('P', 'N/A')}, K={context.get('K', 'N/A')}
+- Recommended Crop: {context.get('recommended_crop', 'Analyzing...')}"""
+    factors = crop_explain.top_factors(context.get('explanation'))
+    if factors:
+        conditions += f"\n- Main Factors (change in confidence): {factors}"
+    return conditions
+
+def with_explanation(context):
+    """
+    Adds the model's explanation of the latest recommendation to the chat context,
+    unless the context is about a different crop or already has one
+    """
+    if not isinstance(context, dict) or context.get('explanation'):
+        return context
+    reading = sensor_state.snapshot.latest
+    explanation = reading.get('explanation')
+    crop = context.get('recommended_crop')
+    if not explanation or (crop and str(crop) != str(reading.get('recommended_crop'))):
+        return context
+    return dict(context, explanation=explanation, recommended_crop=reading.get('recommended_crop'))
+
+def build_chat_messages(user_message, context, history=()):
+    """
+    Builds the OpenAI-style message list for the chatbot.
+    Layout (stable to volatile): system instructions, earlier turns of the
+    session, then the new question followed by the current farm conditions.
+    """
+    return [
+        {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+        *history,
+        {"role": "user", "content": f"{user_message}\n\n{format_farm_conditions(context)}"}
+    ]
+
+def estimate_tokens(text):
+    """
+    Rough token count (about 4 characters per token for LLaMA-style tokenizers)
+    """
+    return max(1, (len(text) + 3) // 4)
+
+def count_prompt_tokens(messages):
+    """
+    Estimates the prompt size of a message list, including per-message overhead
+    """
+    return sum(estimate_tokens(message['content']) + 4 for message in messages)
+
+def get_chat_history(session_id):
+    """
+    Returns a copy of the session's earlier turns, or [] for a new/expired session
+    """
+    if not session_id:
+        return []
+    with chat_sessions_lock:
+        session = chat_sessions.get(session_id)
+        if session is None:
+            return []
+        if time.time() - session['last_used'] >= CHAT_SESSION_TTL:
+            del chat_sessions[session_id]
+            return []
+        return list(session['history'])
+
+def append_chat_turn(session_id, user_message, bot_message):
+    """
+    Adds a question/answer pair to the session history.
+    When the history goes over CHAT_HISTORY_TOKEN_BUDGET the oldest turns are
+    dropped down to half the budget in one go, so the prompt prefix stays the
+    same (and cacheable) for several turns instead of shifting every turn.
+    """
+    if not session_id:
+        return
+    with chat_sessions_lock:
+        session = chat_sessions.get(session_id)
+        if session is None:
+            session = chat_sessions[session_id] = {'history': [], 'history_tokens': 0, 'last_used': time.time()}
+        chat_sessions.move_to_end(session_id)
+
+        for role, content in (("user", user_message), ("assistant", bot_message)):
+            session['history'].append({"role": role, "content": content})
+            session['history_tokens'] += estimate_tokens(content)
+
+        if session['history_tokens'] > CHAT_HISTORY_TOKEN_BUDGET:
+            while session['history'] and session['history_tokens'] > CHAT_HISTORY_TOKEN_BUDGET // 2:
+                # Drop whole question/answer pairs
+                for dropped in session['history'][:2]:
+                    session['history_tokens'] -= estimate_tokens(dropped['content'])
+                del session['history'][:2]
+
+        session['last_used'] = time.time()
+        while len(chat_sessions) > CHAT_MAX_SESSIONS:
+            chat_sessions.popitem(last=False)
+
+def normalize_chat_message(message):
+    """
+    Lowercases the message and strips punctuation and extra whitespace,
+    so "Should I water now?" and "should i water now" share a cache entry.
+    """
+    message = re.sub(r"[^\w\s]", " ", message.lower())
+    return " ".join(message.split())
+
+def chat_cache_key(user_message, context):
+    """
+    Builds the cache key from the normalized message and the chat context
+    quantized into agronomic bands
+    """
+    bands = []
+    for field, edges in CHAT_CONTEXT_BANDS.items():
+        value = context.get(field)
+        try:
+            bands.append(f"{field}:{bisect_right(edges, float(value))}")
+        except (TypeError, ValueError):
+            bands.append(f"{field}:N/A")
+    crop = str(context.get('recommended_crop') or 'N/A').strip().lower()
+    bands.append(f"crop:{crop}")
+    return normalize_chat_message(user_message) + "|" + "|".join(bands)
+
+def get_cached_chat_response(key):
+    """
+    Returns the cached response for this key, or None if missing or expired
+    """
+    with chat_cache_lock:
+        entry = chat_cache.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['created'] >= CHAT_CACHE_TTL:
+            del chat_cache[key]
+            return None
+        chat_cache.move_to_end(key)  # Mark as recently used
+        return entry['response']
+
+def store_chat_response(key, response_text):
+    """
+    Caches a successful LLM response, evicting the least recently used entries
+    """
+    with chat_cache_lock:
+        chat_cache[key] = {'response': response_text, 'created': time.time()}
+        chat_cache.move_to_end(key)
+        while len(chat_cache) > CHAT_CACHE_MAX_ENTRIES:
+            chat_cache.popitem(last=False)
+
+def prompt_stats(messages, history, usage=None):
+    """
+    Prompt size for this request: the LLM server's own count when it reports
+    usage, otherwise our estimate. prefix_tokens is the part shared with the
+    previous turn (instructions and history) that a prefix cache can reuse.
+    """
+    estimated = count_prompt_tokens(messages)
+    reported = usage.get('prompt_tokens') if usage else None
+    return {
+        'prompt_tokens': reported or estimated,
+        'prompt_tokens_estimated': not reported,
+        'prefix_tokens': count_prompt_tokens(messages[:1 + len(history)]),
+        'history_messages': len(history)
+    }
+
+def chat_scheduler_rejection(error):
+    """
+    Builds the fast 429/503 response for a chat request the scheduler turned away
+    """
+    LLM_REJECTIONS.inc(reason='busy' if isinstance(error, SchedulerBusy) else 'timeout')
+    response = jsonify({'response': LMSTUDIO_BUSY_MESSAGE, 'error': str(error)})
+    response.headers['Retry-After'] = str(LLM_RETRY_AFTER)
+    return response, error.status_code
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """
     Handle chatbot conversations using local Ollama LLM.
     Expects: {"message": "user query", "context": {...sensor data...}}
-    Returns: {"response": "LLM answer"}
+    Optional: "session_id": "..." to keep a multi-turn conversation,
+              "bypass_cache": true to always ask the LLM
+    Returns: {"response": "LLM answer", "cached": bool}
     """
+    import requests
     try:
         data = request.get_json()
         user_message = data.get('message', '')
-        context = data.get('context', {})
+        context = with_explanation(data.get('context', {}))
+        session_id = data.get('session_id')
+        bypass_cache = bool(data.get('bypass_cache', False))
         
         if not user_message:
             return jsonify({'error': 'No message provided'}), 400
         
-        # Build system prompt with agricultural context
-        system_prompt = f"""You are AgroSmart Assistant, an expert agricultural advisor helping farmers optimize their crop management.
-
-Current Farm Conditions:
-- Temperature: {context.get('temperature', 'N/A')}°C
-- Humidity: {context.get('humidity', 'N/A')}%
-- Soil Moisture: {context.get('soil_moisture', 'N/A')}%
-- NPK Values: N={context.get('N', 'N/A')}, P={context.get('P', 'N/A')}, K={context.get('K', 'N/A')}
-- Recommended Crop: {context.get('recommended_crop', 'Analyzing...')}
-
-Provide practical, actionable advice based on these conditions. Be concise, friendly, and focus on helping the farmer succeed."""
-
-        # Call LM Studio API (default runs on localhost:1234)
+        # Answer repeated questions from the cache (only at the start of a
+        # conversation; follow-ups depend on the earlier turns)
+        history = get_chat_history(session_id)
+        cache_key = chat_cache_key(user_message, context)
+        if not bypass_cache and not history:
+            cached_response = get_cached_chat_response(cache_key)
+            if cached_response is not None:
+                CACHE_REQUESTS.inc(cache='chat', result='hit')
+                logger.debug("Using cached chat response")
+                return jsonify({'response': cached_response, 'cached': True})
+            CACHE_REQUESTS.inc(cache='chat', result='miss')
+        
+        # Call LM Studio API
         # LM Studio uses OpenAI-compatible API format
-        lmstudio_url = "http://localhost:1234/v1/chat/completions"
+        messages = build_chat_messages(user_message, context, history)
         lmstudio_payload = {
             "model": "local-model",  # LM Studio uses whatever model is loaded
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
+            "messages": messages,
             "temperature": 0.7,
             "max_tokens": 200,
             "stream": False
         }
         
+        # Wait briefly for a free LLM slot (fair queue per client address)
+        try:
+            ticket = llm_scheduler.acquire(request.remote_addr)
+        except (SchedulerBusy, QueueTimeout) as e:
+            return chat_scheduler_rejection(e)
+        
         # Try to call LM Studio
         try:
-            response = requests.post(lmstudio_url, json=lmstudio_payload, timeout=30)
+            request_start = time.perf_counter()
+            with LLM_UPSTREAM_SECONDS.time(endpoint='chat'):
+                response = requests.post(LMSTUDIO_URL, json=lmstudio_payload, timeout=LMSTUDIO_TIMEOUT)
             
             if response.status_code == 200:
+                LLM_UPSTREAM_REQUESTS.inc(endpoint='chat', result='ok')
                 lmstudio_response = response.json()
-                bot_message = lmstudio_response['choices'][0]['message']['content']
-                return jsonify({'response': bot_message.strip()})
+                bot_message = lmstudio_response['choices'][0]['message']['content'].strip()
+                usage = lmstudio_response.get('usage') or {}
+                
+                stats = prompt_stats(messages, history, usage)
+                stats.update({
+                    'endpoint': 'chat',
+                    'total_time_ms': round((time.perf_counter() - request_start) * 1000, 1),
+                    'completion_tokens': usage.get('completion_tokens'),
+                    'timestamp': datetime.now().isoformat()
+                })
+                record_chat_stats(stats)
+                
+                if not history:
+                    store_chat_response(cache_key, bot_message)
+                append_chat_turn(session_id, user_message, bot_message)
+                return jsonify({'response': bot_message, 'cached': False})
             else:
+                LLM_UPSTREAM_REQUESTS.inc(endpoint='chat', result='http_error')
                 return jsonify({
                     'response': "I'm having trouble connecting to the AI assistant. Please make sure LM Studio is running with a model loaded.",
                     'error': f"LM Studio returned status code {response.status_code}"
                 }), 500
                 
         except requests.exceptions.ConnectionError:
+            LLM_UPSTREAM_REQUESTS.inc(endpoint='chat', result='offline')
             return jsonify({
-                'response': "⚠️ I couldn't connect to the local AI assistant. Please install and start LM Studio:\n\n1. Download from https://lmstudio.ai\n2. Load LLaMA 2 7B model (or any model you prefer)\n3. Start the local server (click the ↔ icon in LM Studio)\n4. Make sure it's running on port 1234\n\nLM Studio makes running local AI super easy with a GUI!",
+                'response': LMSTUDIO_OFFLINE_MESSAGE,
                 'error': 'LM Studio not running'
             }), 503
             
         except requests.exceptions.Timeout:
+            LLM_UPSTREAM_REQUESTS.inc(endpoint='chat', result='timeout')
             return jsonify({
                 'response': "The AI assistant is taking too long to respond. Please try again.",
                 'error': 'Request timeout'
             }), 504
+        
+        finally:
+            llm_scheduler.release(ticket)
             
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
+        logger.error("Error in chat endpoint: %s", e)
         return jsonify({
             'response': "I encountered an unexpected error. Please try again.",
             'error': str(e)
         }), 500
 
+def record_chat_stats(stats):
+    """
+    Stores per-request chat stats (keep last 100 entries)
+    """
+    chat_request_stats.append(stats)
+    if len(chat_request_stats) > 100:
+        chat_request_stats.pop(0)
+    if stats['endpoint'] == 'chat/stream':
+        logger.info("Chat stream finished: prompt=%s tokens, TTFT=%s ms, %s tokens at %s tokens/sec",
+                    stats['prompt_tokens'], stats['time_to_first_token_ms'],
+                    stats['completion_tokens'], stats['tokens_per_second'])
+    else:
+        logger.info("Chat finished: prompt=%s tokens, %s ms", stats['prompt_tokens'], stats['total_time_ms'])
+
+def sse_event(payload, event=None):
+    """
+    Formats a payload as a Server-Sent Events message
+    """
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(payload)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Streaming variant of /api/chat using Server-Sent Events.
+    Expects: {"message": "user query", "context": {...sensor data...}}
+    Emits: "data: {"token": ...}" for every token as LM Studio generates it,
+    then "event: done" with the full response and timing stats.
+    Errors are sent as "event: error" with the same fields as /api/chat.
+    Cached answers (see /api/chat) are sent as a single "event: done".
+    Accepts the same "session_id" and "bypass_cache" options as /api/chat.
+    """
+    import requests
+    data = request.get_json(silent=True) or {}
+    user_message = data.get('message', '')
+    context = with_explanation(data.get('context', {}))
+    session_id = data.get('session_id')
+    bypass_cache = bool(data.get('bypass_cache', False))
+    
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
+    
+    history = get_chat_history(session_id)
+    cache_key = chat_cache_key(user_message, context)
+    if not bypass_cache and not history:
+        cached_response = get_cached_chat_response(cache_key)
+        if cached_response is not None:
+            CACHE_REQUESTS.inc(cache='chat', result='hit')
+            logger.debug("Using cached chat response")
+            return Response(sse_event({'response': cached_response, 'cached': True}, event='done'),
+                            mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        CACHE_REQUESTS.inc(cache='chat', result='miss')
+    
+    messages = build_chat_messages(user_message, context, history)
+    lmstudio_payload = {
+        "model": "local-model",
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": 200,
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+    
+    try:
+        ticket = llm_scheduler.acquire(request.remote_addr)
+    except (SchedulerBusy, QueueTimeout) as e:
+        return chat_scheduler_rejection(e)
+    
+    def generate():
+        try:
+            yield from stream_tokens()
+        finally:
+            llm_scheduler.release(ticket)
+    
+    def stream_tokens():
+        request_start = time.perf_counter()
+        first_token_at = None
+        completion_tokens = 0
+        usage = None
+        chunks = []
+        
+        try:
+            with requests.post(LMSTUDIO_URL, json=lmstudio_payload, stream=True,
+                               timeout=LMSTUDIO_TIMEOUT) as response:
+                if response.status_code != 200:
+                    LLM_UPSTREAM_REQUESTS.inc(endpoint='chat/stream', result='http_error')
+                    yield sse_event({
+                        'response': "I'm having trouble connecting to the AI assistant. Please make sure LM Studio is running with a model loaded.",
+                        'error': f"LM Studio returned status code {response.status_code}"
+                    }, event='error')
+                    return
+                
+                # OpenAI-compatible stream: one "data: {...}" line per chunk, ends with "data: [DONE]".
+                # chunk_size=None forwards lines as they arrive instead of waiting for a full buffer
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    chunk_data = line[len('data:'):].strip()
+                    if chunk_data == '[DONE]':
+                        break
+                    
+                    try:
+                        chunk = json.loads(chunk_data)
+                    except json.JSONDecodeError:
+                        continue
+                    
+                    # Some servers report token usage in the final chunk
+                    if chunk.get('usage'):
+                        usage = chunk['usage']
+                    
+                    choices = chunk.get('choices') or [{}]
+                    token = choices[0].get('delta', {}).get('content')
+                    if not token:
+                        continue
+                    
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        LLM_FIRST_TOKEN_SECONDS.observe(first_token_at - request_start)
+                    completion_tokens += 1
+                    chunks.append(token)
+                    yield sse_event({'token': token})
+        
+        except requests.exceptions.ConnectionError:
+            LLM_UPSTREAM_REQUESTS.inc(endpoint='chat/stream', result='offline')
+            yield sse_event({'response': LMSTUDIO_OFFLINE_MESSAGE, 'error': 'LM Studio not running'}, event='error')
+            return
+        except requests.exceptions.Timeout:
+            LLM_UPSTREAM_REQUESTS.inc(endpoint='chat/stream', result='timeout')
+            yield sse_event({
+                'response': "The AI assistant is taking too long to respond. Please try again.",
+                'error': 'Request timeout'
+            }, event='error')
+            return
+        except Exception as e:
+            LLM_UPSTREAM_REQUESTS.inc(endpoint='chat/stream', result='error')
+            logger.error("Error in chat stream: %s", e)
+            yield sse_event({
+                'response': "I encountered an unexpected error. Please try again.",
+                'error': str(e)
+            }, event='error')
+            return
+        
+        finished_at = time.perf_counter()
+        LLM_UPSTREAM_SECONDS.observe(finished_at - request_start, endpoint='chat/stream')
+        LLM_UPSTREAM_REQUESTS.inc(endpoint='chat/stream', result='ok')
+        if usage and usage.get('completion_tokens'):
+            completion_tokens = usage['completion_tokens']
+        
+        # Tokens/sec is measured over the generation phase (after the first token)
+        generation_time = finished_at - first_token_at if first_token_at else 0
+        stats = prompt_stats(messages, history, usage)
+        stats.update({
+            'endpoint': 'chat/stream',
+            'time_to_first_token_ms': round((first_token_at - request_start) * 1000, 1) if first_token_at else None,
+            'total_time_ms': round((finished_at - request_start) * 1000, 1),
+            'completion_tokens': completion_tokens,
+            'tokens_per_second': round((completion_tokens - 1) / generation_time, 2) if generation_time > 0 else None,
+            'timestamp': datetime.now().isoformat()
+        })
+        record_chat_stats(stats)
+        
+        bot_message = ''.join(chunks).strip()
+        if bot_message:
+            if not history:
+                store_chat_response(cache_key, bot_message)
+            append_chat_turn(session_id, user_message, bot_message)
+        yield sse_event({'response': bot_message, 'cached': False, 'stats': stats}, event='done')
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also release if the client disconnects before the stream starts
+    response.call_on_close(lambda: llm_scheduler.release(ticket))
+    return response
+
+@app.route('/api/chat/stats', methods=['GET'])
+def get_chat_stats():
+    """
+    Returns prompt size, time-to-first-token and tokens/sec for recent chats
+    """
+    limit = request.args.get('limit', 24, type=int)
+    return jsonify(chat_request_stats[-limit:])
+
+@app.route('/api/chat/session/<session_id>', methods=['DELETE'])
+def clear_chat_session(session_id):
+    """
+    Forgets a conversation's history
+    """
+    with chat_sessions_lock:
+        existed = chat_sessions.pop(session_id, None) is not None
+    return jsonify({'status': 'success', 'cleared': existed})
+
+@app.route('/api/ready', methods=['GET'])
+def get_readiness():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 before
+    (or if loading failed), with warm-up step timings
+    """
+    status = dict(warmup_status, ready=model is not None,
+                  uptime_seconds=round(time.time() - SERVER_STARTED_AT, 1))
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/api/chat/scheduler', methods=['GET'])
+def get_chat_scheduler_status():
+    """
+    Returns LLM queue depth, active requests and admission counters
+    """
+    return jsonify(llm_scheduler.stats())
+
 # --- 5. Run the Server ---
 # This starts the server when you run 'python prediction_server.py'
 if __name__ == '__main__':
-    # Connect to ESP32 and start reading sensor data
-    print("Connecting to ESP32...")
-    if connect_to_esp32():
-        # Start sensor reading in a separate thread
-        sensor_thread = threading.Thread(target=read_sensor_data, daemon=True)
-        sensor_thread.start()
-        print("ESP32 sensor reading thread started")
+    if SENSOR_BUS_ENABLED:
+        try:
+            sensor_bus = SensorBus.create()
+            print(f"Publishing readings on the shared-memory sensor bus '{sensor_bus.memory.name}'")
+        except RuntimeError as e:
+            print(f"Warning: sensor bus not available: {e}")
+    if sensor_archive is not None:
+        sensor_archive.start()
+        print(f"Archiving readings to {ARCHIVE_DIR}")
+    
+    # Connect to ESP32 (the supervisor keeps reconnecting in the background)
+    # and start reading sensor data; the server binds without waiting for it
+    serial_link.start()
+    sensor_thread = threading.Thread(target=read_sensor_data, daemon=True)
+    sensor_thread.start()
+    print("ESP32 sensor reading thread started; GET /api/serial/status reports the connection "
+          "(mock data is served until the ESP32 is connected)")
+    
+    # Load the model (in the background with FAST_START), then start the
+    # model watcher and retraining
+    if FAST_START:
+        threading.Thread(target=complete_startup, daemon=True).start()
+        print("Warming up in the background; GET /api/ready reports when predictions are available")
     else:
-        print("Warning: ESP32 not connected. Using mock data.")
+        complete_startup()
+    
+    if GATEWAY_PORT:
+        ingest_gateway = IngestGateway(ingest_batch, port=GATEWAY_PORT)
+        ingest_gateway.start()
+        print(f"Ingest gateway listening on port {GATEWAY_PORT} (TCP lines, HTTP keep-alive, UDP)")
     
     # '0.0.0.0' makes the server accessible from any device on your local network (like your ESP32).
-    # 'port=5000' is the standard port for Flask apps.
+    # 'port=5000' is the standard port for Flask apps (override with AGROSMART_PORT).
     print("Starting Flask server...")
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=int(os.getenv('AGROSMART_PORT', '5000')))
@@ -0,0 +1,210 @@
+"""
+Device Reading Schema for AgroSmart
+The one definition of a sensor reading, shared by every way readings come in:
+serial lines (prediction_server and the serial-to-web bridge), POST /predict
+and the ingest gateway. The field table is compiled once into a tuple of
+(name, minimum, maximum, default) entries, and each reading is
+decoded, type-coerced, range-checked and defaulted in a single pass straight
+into the dict that is later stored in the sensor history.
+
+- Required fields (temperature, humidity, soil moisture) must be present and
+  numeric (numeric strings are converted) and within the sensor's range;
+  otherwise the reading is rejected with ReadingError, which names every bad
+  field. Nothing is silently replaced by 0 any more.
+- Optional fields that are missing are filled with explicit defaults (the
+  median of the training data for N, P, K and rainfall) and listed under
+  'defaulted' in the reading, so a prediction made from defaults is visible.
+- Device metadata (seq, uptime_ms, device_id, zone, ...) is kept if it has the
+  right type and dropped otherwise; any other key is dropped.
+
+JSON is decoded with orjson when it is installed (pip install orjson), and
+with the standard library otherwise. Parse counts, rejections per field and
+parse throughput are reported by stats() and as agrosmart_readings_parsed_total
+and agrosmart_reading_field_errors_total.
+"""
+
+import json
+import threading
+import time
+from collections import namedtuple
+
+from metrics import Counter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+
+Field = namedtuple('Field', ['name', 'minimum', 'maximum', 'default'])
+REQUIRED = object()  # default of a field that has to be sent
+
+# Sensor fields (float). Ranges are what the sensors can physically report.
+SENSOR_FIELDS = (
+    Field('temperature', -40.0, 85.0, REQUIRED),  # DHT11/DHT22
+    Field('humidity', 0.0, 100.0, REQUIRED),
+    Field('soil_moisture', 0.0, 100.0, REQUIRED),
+    Field('N', 0.0, 1000.0, 37.0),  # mg/kg; defaults are Crop_recommendation.csv medians
+    Field('P', 0.0, 1000.0, 51.0),
+    Field('K', 0.0, 1000.0, 32.0),
+    Field('rainfall', 0.0, 5000.0, 95.0),  # mm
+)
+FEATURE_COLUMNS = ['N', 'P', 'K', 'temperature', 'humidity', 'rainfall']
+PUMP_COMMANDS = ('PUMP_ON', 'PUMP_OFF')
+DEFAULT_PUMP_COMMAND = 'PUMP_OFF'
+# Device metadata kept when it has the right type: name -> type
+METADATA_FIELDS = {'seq': int, 'uptime_ms': int, 'device_id': str, 'zone': (str, int),
+                   'device_crop': str, 'soil_moisture_raw': int}
+
+READINGS_PARSED = Counter('agrosmart_readings_parsed_total', 'Device readings parsed by the reading schema',
+                          ['source', 'result'])
+READING_FIELD_ERRORS = Counter('agrosmart_reading_field_errors_total', 'Reading fields rejected by the schema',
+                               ['field', 'reason'])
+
+_MISSING = object()
+
+
+class ReadingError(ValueError):
+    """
+    A reading the schema rejects; `errors` maps each bad field to the reason
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Invalid reading: " + ", ".join(f"{field} {reason}" for field, reason in errors.items()))
+
+
+def loads(payload):
+    """
+    Decodes JSON (str or bytes) with the fastest available backend; raises ValueError
+    """
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+class ReadingSchema:
+    """
+    Compiled reading schema: parse() / parse_line() / coerce()
+    """
+
+    def __init__(self, fields=SENSOR_FIELDS, metadata=METADATA_FIELDS):
+        self._fields = tuple((field.name, float(field.minimum), float(field.maximum), field.default)
+                             for field in fields)
+        self._metadata = tuple(metadata.items())
+        self._lock = threading.Lock()
+        self._counts = {}  # (source, result) -> readings
+        self._parse_seconds = 0.0
+
+    def coerce(self, data, source='unknown'):
+        """
+        Validates a decoded reading; returns the new reading dict or raises ReadingError
+        """
+        return self._validate(data, source, time.perf_counter())
+
+    def _validate(self, data, source, started):
+        try:
+            reading = self._coerce(data)
+        except ReadingError as e:
+            self._count(source, 'rejected', started)
+            for field, reason in e.errors.items():
+                READING_FIELD_ERRORS.inc(field=field, reason=reason)
+            raise
+        self._count(source, 'ok', started)
+        return reading
+
+    def parse(self, payload, source='unknown'):
+        """
+        Decodes and validates one JSON reading (str or bytes); raises ReadingError
+        """
+        started = time.perf_counter()
+        try:
+            data = loads(payload)
+        except (ValueError, UnicodeDecodeError):
+            self._count(source, 'invalid_json', started)
+            raise ReadingError({'reading': 'is not valid JSON'})
+        return self._validate(data, source, started)
+
+    def parse_line(self, line, source='serial'):
+        """
+        parse() for a serial line: returns None for lines that are not JSON
+        objects (boot messages, ACKs, debug output)
+        """
+        if not line.startswith('{'):
+            return None
+        return self.parse(line, source)
+
+    def _coerce(self, data):
+        if not isinstance(data, dict):
+            raise ReadingError({'reading': 'is not a JSON object'})
+        reading, errors, defaulted = {}, {}, []
+        for name, minimum, maximum, default in self._fields:
+            value = data.get(name, _MISSING)
+            if value is _MISSING or value is None or value == '':
+                if default is REQUIRED:
+                    errors[name] = 'missing'
+                else:
+                    reading[name] = default
+                    defaulted.append(name)
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                errors[name] = 'not a number'
+                continue
+            # NaN fails both comparisons
+            if not minimum <= value <= maximum:
+                errors[name] = 'out of range'
+                continue
+            reading[name] = value
+
+        pump_command = data.get('pump_command', DEFAULT_PUMP_COMMAND)
+        if pump_command not in PUMP_COMMANDS:
+            errors['pump_command'] = 'invalid'
+        if errors:
+            raise ReadingError(errors)
+        reading['pump_command'] = pump_command
+
+        for name, kind in self._metadata:
+            value = data.get(name)
+            if value is not None and isinstance(value, kind) and not isinstance(value, bool):
+                reading[name] = value
+        if defaulted:
+            reading['defaulted'] = tuple(defaulted)
+        return reading
+
+    def _count(self, source, result, started):
+        READINGS_PARSED.inc(source=source, result=result)
+        with self._lock:
+            self._parse_seconds += time.perf_counter() - started
+            self._counts[(source, result)] = self._counts.get((source, result), 0) + 1
+
+    def stats(self):
+        """
+        {'backend', 'readings', 'by_source', 'parse_seconds', 'readings_per_second'}
+        (throughput counts parse time only, not the time between readings)
+        """
+        with self._lock:
+            counts, parse_seconds = dict(self._counts), self._parse_seconds
+        by_source = {}
+        for (source, result), count in counts.items():
+            by_source.setdefault(source, {})[result] = count
+        total = sum(counts.values())
+        return {
+            'backend': JSON_BACKEND,
+            'readings': total,
+            'by_source': by_source,
+            'parse_seconds': round(parse_seconds, 6),
+            'readings_per_second': round(total / parse_seconds) if parse_seconds > 0 else None
+        }
+
+
+def feature_row(reading):
+    """
+    The model's input row (FEATURE_COLUMNS order) from a validated reading
+    """
+    return [reading[column] for column in FEATURE_COLUMNS]
+
+
+schema = ReadingSchema()
@@ -0,0 +1,187 @@
+"""
+Reading Latency Tracing for AgroSmart
+Follows each sensor reading from the ESP32 to the dashboard and records how
+long every stage took:
+    transport   device sample -> serial line received on the PC
+    parse       received -> parsed into a reading
+    inference   parsed -> crop prediction done
+    store       prediction done -> stored as the latest reading / in history
+    serve       stored -> first returned to the dashboard
+The firmware sends a sequence number ('seq') and its uptime at sample time
+('uptime_ms'). The device clock is not synchronized with the PC, so the
+transport stage is measured relative to the fastest reading seen since the
+device booted: it shows queueing delay (serial buffering, a busy reader)
+rather than absolute wire time.
+
+Durations go to the agrosmart_reading_stage_seconds histogram (/metrics) and a
+short in-memory window for percentile summaries. Readings slower than
+SLOW_READING_THRESHOLD from sample to storage are logged with their full trace.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import Histogram
+
+STAGES = ('transport', 'parse', 'inference', 'store', 'serve')
+SLOW_READING_THRESHOLD = float(os.getenv('AGROSMART_SLOW_READING', '0.5'))  # seconds, sample -> stored
+TRACE_WINDOW = 500  # recent durations kept per stage for percentile summaries
+SERVED_TRACES_LIMIT = 10000  # published readings remembered as already served
+
+# Buckets cover sub-millisecond parsing up to readings stuck for a minute
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+READING_STAGE_SECONDS = Histogram('agrosmart_reading_stage_seconds', 'Per-stage latency of sensor readings',
+                                  ['stage'], buckets=STAGE_BUCKETS)
+READING_INGEST_SECONDS = Histogram('agrosmart_reading_ingest_seconds',
+                                   'Sensor reading latency from sample (or receive) to storage', buckets=STAGE_BUCKETS)
+READING_AGE_SECONDS = Histogram('agrosmart_reading_age_seconds',
+                                'Age of a sensor reading when first served to the dashboard', buckets=STAGE_BUCKETS)
+
+logger = logging.getLogger('agrosmart.trace')
+
+recent_durations = {stage: deque(maxlen=TRACE_WINDOW) for stage in STAGES + ('ingest', 'age')}
+# Published readings are immutable, so serve times are kept here instead of in the trace
+_served_traces = OrderedDict()  # id(trace) -> trace (kept so the id is not reused)
+_served_lock = threading.Lock()
+
+
+class DeviceClock:
+    """
+    Maps device uptime to PC time using the smallest observed offset
+    (received_at - uptime), i.e. the reading that arrived with the least delay.
+    A reboot (uptime going backwards) starts a new estimate.
+    """
+
+    def __init__(self):
+        self.offset = None
+        self.last_uptime_ms = None
+
+    def sample_time(self, uptime_ms, received_at):
+        try:
+            uptime_ms = float(uptime_ms)
+        except (TypeError, ValueError):
+            return None
+
+        offset = received_at - uptime_ms / 1000
+        if self.offset is None or self.last_uptime_ms is None or uptime_ms < self.last_uptime_ms:
+            self.offset = offset
+        else:
+            self.offset = min(self.offset, offset)
+        self.last_uptime_ms = uptime_ms
+        return uptime_ms / 1000 + self.offset
+
+
+def start_trace(data, received_at, device_clock=None):
+    """
+    Creates the trace for a reading received at `received_at` (time.time()).
+    `data` is the raw device payload; its 'seq' and 'uptime_ms' are carried along.
+    """
+    trace = {
+        'seq': data.get('seq'),
+        'device_uptime_ms': data.get('uptime_ms'),
+        'sampled_at': None,
+        'received_at': received_at
+    }
+    if device_clock is not None and trace['device_uptime_ms'] is not None:
+        trace['sampled_at'] = device_clock.sample_time(trace['device_uptime_ms'], received_at)
+    return trace
+
+
+def mark(trace, stage):
+    """
+    Records the time a stage finished ('parsed', 'inferred', 'stored', ...)
+    """
+    if trace is not None:
+        trace[f'{stage}_at'] = time.time()
+
+
+def _observe(stage, seconds):
+    seconds = max(0.0, seconds)
+    READING_STAGE_SECONDS.observe(seconds, stage=stage)
+    recent_durations[stage].append(seconds)
+
+
+def stage_durations(trace):
+    """
+    Per-stage durations in seconds for the stages this trace has completed
+    """
+    durations = {}
+    if trace.get('sampled_at') is not None:
+        durations['transport'] = trace['received_at'] - trace['sampled_at']
+    previous = trace['received_at']
+    for stage, field in (('parse', 'parsed_at'), ('inference', 'inferred_at'), ('store', 'stored_at')):
+        if trace.get(field) is not None:
+            durations[stage] = trace[field] - previous
+            previous = trace[field]
+    return durations
+
+
+def finish_ingest(trace):
+    """
+    Call once the reading is stored: records the ingest stages and logs slow readings
+    """
+    if trace is None:
+        return
+    durations = stage_durations(trace)
+    for stage, seconds in durations.items():
+        _observe(stage, seconds)
+
+    start = trace['sampled_at'] if trace.get('sampled_at') is not None else trace['received_at']
+    ingest = max(0.0, trace['stored_at'] - start)
+    READING_INGEST_SECONDS.observe(ingest)
+    recent_durations['ingest'].append(ingest)
+
+    if ingest > SLOW_READING_THRESHOLD:
+        logger.warning("Slow reading seq=%s: %.1f ms from sample to storage (%s)", trace.get('seq'), ingest * 1000,
+                       ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in durations.items()))
+
+
+def mark_served(reading):
+    """
+    Records the serve stage the first time a stored reading is returned to a client.
+    Returns False if it had already been served (or has no trace).
+    """
+    trace = reading.get('trace') if isinstance(reading, dict) else None
+    if trace is None or trace.get('stored_at') is None or id(trace) in _served_traces:
+        return False
+    with _served_lock:
+        if id(trace) in _served_traces:
+            return False
+        _served_traces[id(trace)] = trace
+        if len(_served_traces) > SERVED_TRACES_LIMIT:
+            _served_traces.popitem(last=False)
+    served_at = time.time()
+
+    _observe('serve', served_at - trace['stored_at'])
+    start = trace['sampled_at'] if trace.get('sampled_at') is not None else trace['received_at']
+    age = max(0.0, served_at - start)
+    READING_AGE_SECONDS.observe(age)
+    recent_durations['age'].append(age)
+    return True
+
+
+def latency_summary():
+    """
+    p50/p90/p99 (ms) of each stage over the recent window
+    """
+    summary = {}
+    for stage, durations in recent_durations.items():
+        values = sorted(durations)
+        if not values:
+            summary[stage] = {'count': 0}
+            continue
+
+        def percentile(p):
+            return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 2)
+
+        summary[stage] = {
+            'count': len(values),
+            'p50_ms': percentile(50),
+            'p90_ms': percentile(90),
+            'p99_ms': percentile(99),
+            'max_ms': round(values[-1] * 1000, 2)
+        }
+    return summary
@@ -0,0 +1,186 @@
+"""
+Background Retraining Worker for AgroSmart
+Periodically folds labeled field readings (field_data.csv) into the crop model.
+Forests are warm-started: each cycle adds a few new trees trained on the
+combined data instead of refitting from scratch, and the oldest trees are
+retired once the forest reaches its size cap.
+The new model is validated on a holdout set and published atomically, so the
+running prediction_server can swap it in without pausing inference.
+"""
+
+import argparse
+import copy
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score
+from sklearn.model_selection import train_test_split
+
+from crop_model_trainer import DATASET_FILENAME, MODEL_FILENAME
+from dataset_cache import FEATURE_COLUMNS, load_dataset
+
+FIELD_DATA_FILENAME = 'field_data.csv'
+
+RETRAIN_INTERVAL = 3600          # seconds between retraining cycles
+RETRAIN_MIN_NEW_ROWS = 20        # labeled readings needed before retraining
+TREES_PER_CYCLE = 10             # trees added per warm-start cycle
+MAX_TREES = 200                  # oldest trees are retired above this size
+MAX_ACCURACY_DROP = 0.01         # reject models that lose more holdout accuracy than this
+FIELD_HOLDOUT_EVERY = 5          # every 5th field reading is kept for validation
+
+
+def load_base_data(filename=DATASET_FILENAME):
+    """
+    Loads the static training data and splits off the fixed holdout set
+    (same split as crop_model_trainer).
+    """
+    X, y = load_dataset(filename)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    return X_train, X_test, y_train, y_test
+
+
+def load_field_data(filename=FIELD_DATA_FILENAME):
+    """
+    Loads labeled field readings appended by the server.
+    Returns (train_X, train_y, holdout_X, holdout_y); empty frames if there is no data yet.
+    """
+    if not os.path.exists(filename):
+        empty = pd.DataFrame(columns=FEATURE_COLUMNS, dtype='float32')
+        return empty, pd.Series(dtype=object), empty, pd.Series(dtype=object)
+
+    X, y = load_dataset(filename)
+    holdout = np.arange(len(X)) % FIELD_HOLDOUT_EVERY == 0
+    return X[~holdout], y[~holdout], X[holdout], y[holdout]
+
+
+def warm_start_update(model, X, y):
+    """
+    Updates the model with the combined data without a full refit.
+    - Forests: add TREES_PER_CYCLE trees fitted on X, y and retire the oldest
+      trees beyond MAX_TREES.
+    - Models with partial_fit (e.g. naive Bayes): fold in the new rows.
+    - Anything else, or new crop labels the model has never seen: full refit.
+    Returns the updated model and a short description of what was done.
+    """
+    unseen_labels = set(y) - set(getattr(model, 'classes_', []))
+
+    if hasattr(model, 'estimators_') and 'warm_start' in model.get_params() and not unseen_labels:
+        # With warm_start, fit() keeps the fitted trees and only grows the additional ones
+        updated = copy.deepcopy(model)
+        updated.set_params(warm_start=True, n_estimators=len(model.estimators_) + TREES_PER_CYCLE)
+        updated.fit(X, y)
+
+        retired = max(0, len(updated.estimators_) - MAX_TREES)
+        if retired:
+            updated.estimators_ = updated.estimators_[retired:]
+        updated.set_params(n_estimators=len(updated.estimators_), warm_start=False)
+        return updated, f"added {TREES_PER_CYCLE} trees, retired {retired}"
+
+    if hasattr(model, 'partial_fit') and not unseen_labels:
+        # Caller passes only the new rows in this case
+        updated = copy.deepcopy(model)
+        updated.partial_fit(X, y)
+        return updated, f"partial_fit on {len(X)} rows"
+
+    refit = clone(model)
+    refit.fit(X, y)
+    reason = f"new labels {sorted(unseen_labels)}" if unseen_labels else "no incremental fit"
+    return refit, f"full refit ({reason})"
+
+
+def publish_model(model, filename=MODEL_FILENAME):
+    """
+    Writes the model next to the target and renames it into place, so readers
+    only ever see the complete old file or the complete new one.
+    """
+    temp_filename = f"{filename}.tmp-{os.getpid()}"
+    joblib.dump(model, temp_filename)
+    os.replace(temp_filename, filename)
+
+
+def lower_priority():
+    """
+    Runs this process at low CPU priority so retraining never competes with inference.
+    """
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+
+
+def retrain_once(model, folded_rows, dataset=DATASET_FILENAME, field_data=FIELD_DATA_FILENAME,
+                 model_filename=MODEL_FILENAME):
+    """
+    Runs one retraining cycle.
+    Returns (model, folded_rows): the published model (or the old one if
+    nothing changed or validation failed) and how many field rows it includes.
+    """
+    X_base, X_holdout, y_base, y_holdout = load_base_data(dataset)
+    X_field, y_field, X_field_holdout, y_field_holdout = load_field_data(field_data)
+
+    new_rows = len(X_field) - folded_rows
+    if new_rows < RETRAIN_MIN_NEW_ROWS:
+        return model, folded_rows
+
+    print(f"Retraining with {new_rows} new field readings ({len(X_field)} total)...")
+    X_valid = pd.concat([X_holdout, X_field_holdout], ignore_index=True)
+    y_valid = pd.concat([y_holdout, y_field_holdout], ignore_index=True)
+
+    if hasattr(model, 'partial_fit') and not hasattr(model, 'estimators_'):
+        X_new, y_new = X_field.iloc[folded_rows:], y_field.iloc[folded_rows:]
+    else:
+        X_new = pd.concat([X_base, X_field], ignore_index=True)
+        y_new = pd.concat([y_base, y_field], ignore_index=True)
+
+    start = time.perf_counter()
+    candidate, action = warm_start_update(model, X_new, y_new)
+    fit_time = time.perf_counter() - start
+
+    current_accuracy = accuracy_score(y_valid, model.predict(X_valid))
+    candidate_accuracy = accuracy_score(y_valid, candidate.predict(X_valid))
+    print(f"Retraining {action} in {fit_time:.1f}s: holdout accuracy "
+          f"{current_accuracy * 100:.2f}% -> {candidate_accuracy * 100:.2f}%")
+
+    if candidate_accuracy < current_accuracy - MAX_ACCURACY_DROP:
+        print("Rejected: new model is less accurate on the holdout set.")
+        return model, len(X_field)
+
+    publish_model(candidate, model_filename)
+    print(f"Published retrained model to '{model_filename}'")
+    return candidate, len(X_field)
+
+
+def run_retraining_loop(interval=RETRAIN_INTERVAL, dataset=DATASET_FILENAME,
+                        field_data=FIELD_DATA_FILENAME, model_filename=MODEL_FILENAME, once=False):
+    """
+    Retraining process entry point: retrain every `interval` seconds.
+    """
+    lower_priority()
+    model = joblib.load(model_filename)
+    folded_rows = 0
+
+    while True:
+        try:
+            model, folded_rows = retrain_once(model, folded_rows, dataset, field_data, model_filename)
+        except Exception as e:
+            print(f"Error during retraining: {e}")
+        if once:
+            return
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fold labeled field readings into the crop model.")
+    parser.add_argument('--dataset', default=DATASET_FILENAME, help="Base training CSV")
+    parser.add_argument('--field-data', default=FIELD_DATA_FILENAME, help="Labeled field readings CSV")
+    parser.add_argument('--model', default=MODEL_FILENAME, help="Model file to update")
+    parser.add_argument('--interval', type=int, default=RETRAIN_INTERVAL, help="Seconds between cycles")
+    parser.add_argument('--once', action='store_true', help="Run a single cycle and exit")
+    args = parser.parse_args()
+
+    run_retraining_loop(args.interval, args.dataset, args.field_data, args.model, args.once)
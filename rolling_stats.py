@@ -0,0 +1,225 @@
+"""
+Rolling Sensor Statistics for AgroSmart
+Keeps mean, variance, min/max, rate of change and an exponentially weighted
+average of every sensor field over several time windows (e.g. 5 minutes,
+1 hour, 24 hours). Each reading updates all windows in O(1) amortized time,
+so /api/sensors/stats never scans the history:
+- mean/variance: Welford's algorithm, with readings added and expired
+- min/max: monotonic queues
+- rate of change: least-squares slope from running sums of t, t², v and t·v
+- EWMA: time-aware, with the window length as its time constant
+Running sums are rebuilt from the window every so often (still amortized
+O(1)) so floating point error cannot build up over months of readings.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+
+DEFAULT_FIELDS = ('temperature', 'humidity', 'soil_moisture', 'N', 'P', 'K', 'rainfall')
+
+
+def window_label(seconds):
+    """300 -> '5m', 3600 -> '1h', 86400 -> '24h'"""
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+class _FieldWindow:
+    """
+    Running statistics of one field inside one window
+    """
+    __slots__ = ('n', 'mean', 'm2', 'sum_t', 'sum_tt', 'sum_tv', 'min_queue', 'max_queue',
+                 'ewma', 'ewma_t', 'latest')
+
+    def __init__(self):
+        self.reset()
+        self.ewma = None
+        self.ewma_t = None
+        self.latest = None
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_tv = 0.0
+        self.min_queue = deque()  # (t, value), values increasing
+        self.max_queue = deque()  # (t, value), values decreasing
+
+    def add(self, t, value, tau):
+        self.push(t, value)
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            alpha = 1 - math.exp(-(t - self.ewma_t) / tau)
+            self.ewma += alpha * (value - self.ewma)
+        self.ewma_t = t
+        self.latest = value
+
+    def push(self, t, value):
+        """Adds a value to the windowed statistics (not the EWMA, which never expires)"""
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.sum_t += t
+        self.sum_tt += t * t
+        self.sum_tv += t * value
+
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append((t, value))
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append((t, value))
+
+    def remove(self, t, value):
+        self.n -= 1
+        if self.n == 0:
+            self.reset()
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.n
+        self.m2 = max(0.0, self.m2 - delta * (value - self.mean))
+        self.sum_t -= t
+        self.sum_tt -= t * t
+        self.sum_tv -= t * value
+
+        if self.min_queue and self.min_queue[0][0] <= t:
+            self.min_queue.popleft()
+        if self.max_queue and self.max_queue[0][0] <= t:
+            self.max_queue.popleft()
+
+    def slope(self):
+        """Least-squares rate of change in units per second, None with too few points"""
+        if self.n < 2:
+            return None
+        denominator = self.n * self.sum_tt - self.sum_t * self.sum_t
+        if denominator <= 1e-9:
+            return None
+        return (self.n * self.sum_tv - self.sum_t * self.mean * self.n) / denominator
+
+    def summary(self):
+        if self.n == 0:
+            return {'count': 0, 'ewma': _round(self.ewma), 'latest': _round(self.latest)}
+        variance = self.m2 / (self.n - 1) if self.n > 1 else 0.0
+        slope = self.slope()
+        return {
+            'count': self.n,
+            'mean': _round(self.mean),
+            'variance': _round(variance),
+            'std': _round(math.sqrt(variance)),
+            'min': _round(self.min_queue[0][1]),
+            'max': _round(self.max_queue[0][1]),
+            'rate_per_hour': _round(slope * 3600 if slope is not None else None),
+            'ewma': _round(self.ewma),
+            'latest': _round(self.latest)
+        }
+
+
+class _Window:
+    """
+    All fields over one time window; samples are shared between the fields
+    """
+
+    def __init__(self, seconds, fields):
+        self.seconds = seconds
+        self.fields = fields
+        self.samples = deque()  # (t, (value or None per field))
+        self.stats = [_FieldWindow() for _ in fields]
+        self.removed_since_rebuild = 0
+
+    def add(self, t, values):
+        self.samples.append((t, values))
+        for stats, value in zip(self.stats, values):
+            if value is not None:
+                stats.add(t, value, self.seconds)
+        self.expire(t)
+
+    def expire(self, now):
+        cutoff = now - self.seconds
+        while self.samples and self.samples[0][0] <= cutoff:
+            t, values = self.samples.popleft()
+            for stats, value in zip(self.stats, values):
+                if value is not None:
+                    stats.remove(t, value)
+            self.removed_since_rebuild += 1
+
+        if self.removed_since_rebuild > max(1000, len(self.samples)):
+            self.rebuild()
+
+    def rebuild(self):
+        """Recomputes the running sums from the samples in the window"""
+        for stats in self.stats:
+            stats.reset()
+        for t, values in self.samples:
+            for stats, value in zip(self.stats, values):
+                if value is not None:
+                    stats.push(t, value)
+        self.removed_since_rebuild = 0
+
+    def summary(self):
+        return {field: stats.summary() for field, stats in zip(self.fields, self.stats)}
+
+
+class RollingStats:
+    """
+    Rolling statistics of sensor fields over several time windows (seconds)
+    """
+
+    def __init__(self, windows=(300, 3600, 86400), fields=DEFAULT_FIELDS):
+        self.fields = tuple(fields)
+        self.windows = [_Window(int(seconds), self.fields) for seconds in sorted(windows)]
+        # Times are kept relative to this origin so t² stays well inside float precision
+        self.origin = time.time()
+        self.last_t = None
+        self._lock = threading.Lock()
+
+    def add(self, reading, timestamp=None):
+        """
+        Folds one reading (dict of field -> number) sampled at `timestamp` (time.time()) into every window
+        """
+        values = []
+        for field in self.fields:
+            try:
+                value = float(reading[field])
+                values.append(value if math.isfinite(value) else None)
+            except (KeyError, TypeError, ValueError):
+                values.append(None)
+        values = tuple(values)
+
+        t = (timestamp if timestamp is not None else time.time()) - self.origin
+        with self._lock:
+            # Readings from several devices can arrive slightly out of order
+            if self.last_t is not None and t < self.last_t:
+                t = self.last_t
+            self.last_t = t
+            for window in self.windows:
+                window.add(t, values)
+
+    def summary(self, window_labels=None, fields=None, now=None):
+        """
+        {window label: {field: {count, mean, variance, std, min, max, rate_per_hour, ewma, latest}}}
+        Readings older than each window are expired first, so idle windows empty out.
+        """
+        t = (now if now is not None else time.time()) - self.origin
+        result = {}
+        with self._lock:
+            for window in self.windows:
+                label = window_label(window.seconds)
+                if window_labels and label not in window_labels:
+                    continue
+                window.expire(t)
+                stats = window.summary()
+                result[label] = {field: stats[field] for field in self.fields if not fields or field in fields}
+        return result
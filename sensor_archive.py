@@ -0,0 +1,557 @@
+"""
+Compressed Sensor Archive for AgroSmart
+Long-term storage of every reading, per device, in append-only segment files
+small enough for the gateway's SD card (a year of 5-second readings is a few
+megabytes per device).
+
+Readings are buffered per device and written as blocks of up to BLOCK_SIZE
+readings, or whatever arrived in FLUSH_INTERVAL seconds (written by the
+start() thread even if the device goes quiet, and at exit). Once a segment
+has a block's worth of readings in such small blocks, that thread compacts
+them into full blocks (a rewrite of the file, swapped in atomically). Within a block every
+field is stored as a column:
+    timestamp   multiples of TIME_RESOLUTION_MS, delta-of-delta: a fixed sampling
+                interval encodes as zeros (millisecond jitter would not, which
+                is why timestamps are kept to the second by default)
+    decimals    values with at most MAX_DECIMALS decimal places (sensor readings,
+                N/P/K, pump state, crop code) are scaled to integers and
+                delta-encoded: a slowly varying value encodes as small numbers
+    other       float64 bits XORed with the previous value's bits
+Each column uses the narrowest integer type that fits, its bytes are split
+into byte planes (all low bytes, then all next bytes, ...), and the block is
+compressed with zlib, so the runs of zeros all these encodings produce
+compress to almost nothing. Decoding is vectorized: one zlib call per block,
+then numpy cumsum / bitwise_xor.accumulate per column.
+
+Segment files are <root>/<device>/<YYYY-MM>.agsa. Each block starts with a
+fixed header (reading count, first and last timestamp, payload size), so a
+time-range query reads only the headers of blocks outside the range and
+decodes just the blocks it needs.
+"""
+
+import atexit
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+from reading_schema import SENSOR_FIELDS
+
+BLOCK_SIZE = 4096  # readings per block
+# Seconds readings may wait in memory: what a power cut can lose. Shorter
+# intervals mean smaller blocks, which compress less well.
+FLUSH_INTERVAL = int(os.getenv('AGROSMART_ARCHIVE_FLUSH', '300'))
+TIME_RESOLUTION_MS = int(os.getenv('AGROSMART_ARCHIVE_RESOLUTION_MS', '1000'))
+MAX_DECIMALS = 4
+SEGMENT_SUFFIX = '.agsa'
+BLOCK_MAGIC = b'AGSA'
+FORMAT_VERSION = 1
+# magic, version, reading count, first and last timestamp (ms), compressed payload size
+BLOCK_HEADER = struct.Struct('<4sBxxxIqqI')
+
+NUMERIC_FIELDS = tuple(field.name for field in SENSOR_FIELDS)
+ARCHIVE_FIELDS = NUMERIC_FIELDS + ('confidence', 'pump_on', 'crop')
+INTEGER_TYPES = (np.int8, np.int16, np.int32, np.int64)
+SAFE_DEVICE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+logger = logging.getLogger('agrosmart.archive')
+
+
+def _narrowest(values):
+    """values as the narrowest signed integer type that holds them"""
+    if len(values) == 0:
+        return values.astype(np.int8)
+    low, high = int(values.min()), int(values.max())
+    for dtype in INTEGER_TYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return values.astype(np.int64)
+
+
+def _planes(values):
+    """Byte planes of a numeric array (little-endian): all first bytes, then all second bytes, ..."""
+    values = np.ascontiguousarray(values)
+    return values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+
+
+def _from_planes(buffer, dtype, count):
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(buffer, dtype=np.uint8).reshape(dtype.itemsize, count)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(count)
+
+
+def _decimal_scale(values):
+    """
+    Smallest number of decimal places (0..MAX_DECIMALS) that represents every
+    value exactly, or None (NaN, huge values, more decimals)
+    """
+    if not np.all(np.isfinite(values)) or np.any(np.abs(values) > 1e12):
+        return None
+    for decimals in range(MAX_DECIMALS + 1):
+        scaled = np.round(values * 10 ** decimals)
+        if np.array_equal(scaled / 10 ** decimals, values):
+            return decimals
+    return None
+
+
+def encode_column(values):
+    """
+    (descriptor, bytes) for one float64 column: delta-encoded scaled integers
+    when the values are decimals, XORed float bits otherwise
+    """
+    decimals = _decimal_scale(values)
+    if decimals is not None:
+        integers = np.round(values * 10 ** decimals).astype(np.int64)
+        deltas = _narrowest(np.diff(integers, prepend=np.int64(0)))
+        return ['delta', deltas.dtype.str, decimals], _planes(deltas)
+    bits = values.astype(np.float64).view(np.uint64)
+    xored = bits ^ np.concatenate(([np.uint64(0)], bits[:-1]))
+    return ['xor', '<u8', None], _planes(xored)
+
+
+def decode_column(descriptor, buffer, count):
+    encoding, dtype, decimals = descriptor
+    stored = _from_planes(buffer, dtype, count)
+    if encoding == 'delta':
+        integers = np.cumsum(stored, dtype=np.int64)
+        return integers / 10 ** decimals if decimals else integers.astype(np.float64)
+    return np.bitwise_xor.accumulate(stored).view(np.float64)
+
+
+def encode_timestamps(milliseconds, resolution):
+    """
+    Delta-of-delta in units of `resolution` ms: the first value is in the block
+    header, then second differences
+    """
+    deltas = np.diff(milliseconds) // resolution
+    dod = _narrowest(np.diff(deltas, prepend=np.int64(0)))
+    return dod.dtype.str, _planes(dod)
+
+
+def decode_timestamps(first, resolution, dtype, buffer, count):
+    dod = _from_planes(buffer, dtype, count - 1)
+    deltas = np.cumsum(dod, dtype=np.int64) * resolution
+    return first + np.concatenate(([0], np.cumsum(deltas)))
+
+
+def encode_block(device_id, columns, resolution=TIME_RESOLUTION_MS):
+    """
+    One block from {'timestamp': int64 ms (ascending), field: float64 array, 'crops': [names]};
+    timestamps are rounded to `resolution` ms
+    """
+    milliseconds = (columns['timestamp'] + resolution // 2) // resolution * resolution
+    count = len(milliseconds)
+    time_dtype, time_bytes = encode_timestamps(milliseconds, resolution)
+    descriptors, parts = [], [time_bytes]
+    for field in ARCHIVE_FIELDS:
+        descriptor, data = encode_column(columns[field])
+        descriptors.append([field] + descriptor + [len(data)])
+        parts.append(data)
+    header = json.dumps({'device': device_id, 'resolution': resolution, 'time_dtype': time_dtype,
+                         'time_bytes': len(time_bytes),
+                         'columns': descriptors, 'crops': columns['crops']}, separators=(',', ':')).encode()
+    payload = zlib.compress(struct.pack('<I', len(header)) + header + b''.join(parts), 9)
+    return BLOCK_HEADER.pack(BLOCK_MAGIC, FORMAT_VERSION, count, int(milliseconds[0]), int(milliseconds[-1]),
+                             len(payload)) + payload
+
+
+def decode_block(count, first, payload, fields=None):
+    """
+    Decoded block: {'timestamp': int64 ms, field: float64 array, ...}; crop is
+    returned as names (object array)
+    """
+    return _decode_block(count, first, payload, fields)[1]
+
+
+def _decode_block(count, first, payload, fields=None):
+    """(block header dict, decoded columns)"""
+    raw = zlib.decompress(payload)
+    header_size = struct.unpack_from('<I', raw)[0]
+    header = json.loads(raw[4:4 + header_size])
+    offset = 4 + header_size
+    columns = {'timestamp': decode_timestamps(first, header['resolution'], header['time_dtype'],
+                                              raw[offset:offset + header['time_bytes']], count)}
+    offset += header['time_bytes']
+    for name, encoding, dtype, decimals, size in header['columns']:
+        if fields is None or name in fields:
+            columns[name] = decode_column((encoding, dtype, decimals), raw[offset:offset + size], count)
+        offset += size
+    if 'crop' in columns:
+        columns['crop'] = _crop_names(columns['crop'], header['crops'])
+    return header, columns
+
+
+def _crop_names(codes, crops):
+    """Crop codes (NaN for none) as an object array of names"""
+    names = np.array([None] + list(crops), dtype=object)
+    return names[np.where(np.isnan(codes), 0, codes + 1).astype(np.intp)]
+
+
+def iter_blocks(filename):
+    """
+    (count, first ms, last ms, payload offset, payload size) for every block in a segment file
+    """
+    with open(filename, 'rb') as f:
+        yield from _blocks(f)
+
+
+def _blocks(f):
+    """iter_blocks over an open segment file"""
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    f.seek(0)
+    while True:
+        position = f.tell()
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+        magic, version, count, first, last, size = BLOCK_HEADER.unpack(header)
+        if magic != BLOCK_MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{f.name}: not an AgroSmart archive block at offset {position}")
+        offset = position + BLOCK_HEADER.size
+        if offset + size > end:
+            return  # truncated by a crash mid-write: the block is ignored
+        yield count, first, last, offset, size
+        f.seek(offset + size)
+
+
+def device_directory_name(device_id):
+    """
+    Directory name of a device: the ID itself if it is a safe file name
+    (leading letter or digit, then letters, digits, '_', '.', '-'), otherwise
+    '_x' + the hex of its UTF-8 bytes, which no safe ID can collide with
+    """
+    device_id = str(device_id)
+    if SAFE_DEVICE_NAME.match(device_id):
+        return device_id
+    return '_x' + device_id.encode('utf-8').hex()
+
+
+def device_id_from_directory(name):
+    if name.startswith('_x'):
+        try:
+            return bytes.fromhex(name[2:]).decode('utf-8')
+        except ValueError:
+            pass
+    return name
+
+
+def reading_time(reading):
+    """Seconds since the epoch the reading was sampled (or received)"""
+    trace = reading.get('trace') or {}
+    sampled = trace.get('sampled_at') or trace.get('received_at')
+    if sampled:
+        return float(sampled)
+    try:
+        return datetime.fromisoformat(reading['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+class SensorArchive:
+    """
+    Append-only compressed archive of readings, one series per device
+    """
+
+    def __init__(self, root, block_size=BLOCK_SIZE, flush_interval=FLUSH_INTERVAL, resolution=TIME_RESOLUTION_MS):
+        self.root = root
+        self.resolution = resolution
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self._pending = {}  # device id -> list of row tuples
+        self._first_pending_at = {}  # device id -> time.monotonic() of its oldest unwritten reading
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._flusher = None
+        self._small_readings = {}  # segment file -> readings written in small blocks since its last compaction
+        self._compact_due = set()  # segments with enough small blocks to merge
+        # Whatever is still buffered when the process exits normally is written
+        atexit.register(self.flush)
+
+    def append(self, readings, default_device='serial'):
+        """
+        Buffers readings; blocks are written when full or FLUSH_INTERVAL after
+        their first reading arrived
+        """
+        due = []
+        with self._lock:
+            now = time.monotonic()
+            for reading in readings:
+                device_id = str(reading.get('device_id') or default_device)
+                rows = self._pending.setdefault(device_id, [])
+                if not rows:
+                    self._first_pending_at[device_id] = now
+                rows.append(self._row(reading))
+                if len(rows) >= self.block_size:
+                    due.append((device_id, self._take(device_id)))
+            due.extend(self._take_expired(now))
+        self._write_all(due)
+
+    def start(self):
+        """
+        Starts a thread that writes buffered readings FLUSH_INTERVAL seconds
+        after they arrived even when no new readings come in; returns self
+        """
+        self._flusher = threading.Thread(target=self._run_flusher, name='archive-flush', daemon=True)
+        self._flusher.start()
+        return self
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(min(self.flush_interval, 60))
+            with self._lock:
+                due = self._take_expired(time.monotonic())
+            self._write_all(due)
+            for segment in list(self._compact_due):
+                try:
+                    self.compact(segment)
+                except (OSError, ValueError) as e:
+                    # e.g. a reader holds the file open on Windows: retried after the next flush
+                    logger.warning("Could not compact %s: %s", segment, e)
+
+    def flush(self):
+        """Writes every buffered reading"""
+        with self._lock:
+            due = [(device_id, self._take(device_id)) for device_id in list(self._pending) if self._pending[device_id]]
+        self._write_all(due)
+
+    def _take_expired(self, now):
+        """Takes the buffers whose oldest reading has waited FLUSH_INTERVAL (called with the lock held)"""
+        return [(device_id, self._take(device_id)) for device_id, started in list(self._first_pending_at.items())
+                if now - started >= self.flush_interval and self._pending.get(device_id)]
+
+    def _write_all(self, due):
+        for device_id, rows in due:
+            try:
+                self._write(device_id, rows)
+            except (OSError, ValueError) as e:
+                logger.error("Could not archive %d readings of device %r: %s", len(rows), device_id, e)
+
+    def _take(self, device_id):
+        self._first_pending_at.pop(device_id, None)
+        return self._pending.pop(device_id)
+
+    @staticmethod
+    def _row(reading):
+        explanation = reading.get('explanation') or {}
+        pump_command = reading.get('pump_command')
+        return (round(reading_time(reading) * 1000),
+                *[_number(reading.get(field)) for field in NUMERIC_FIELDS],
+                _number(explanation.get('confidence')),
+                np.nan if pump_command is None else float(pump_command == 'PUMP_ON'),
+                reading.get('recommended_crop'))
+
+    @staticmethod
+    def _columns(rows):
+        """Column arrays (sorted by time) from buffered rows"""
+        rows = sorted(rows, key=lambda row: row[0])
+        columns = {'timestamp': np.array([row[0] for row in rows], dtype=np.int64)}
+        numbers = np.array([row[1:-1] for row in rows], dtype=np.float64).reshape(len(rows), -1)
+        for index, field in enumerate(ARCHIVE_FIELDS[:-1]):
+            columns[field] = numbers[:, index]
+        crops = sorted({str(row[-1]) for row in rows if row[-1]})
+        codes = {crop: code for code, crop in enumerate(crops)}
+        columns['crop'] = np.array([codes[str(row[-1])] if row[-1] else np.nan for row in rows], dtype=np.float64)
+        columns['crops'] = crops
+        return columns
+
+    def _device_directory(self, device_id):
+        """The device's directory; ValueError if it would not be inside the archive root"""
+        root = os.path.realpath(self.root)
+        directory = os.path.realpath(os.path.join(root, device_directory_name(device_id)))
+        if os.path.dirname(directory) != root:
+            raise ValueError(f"Device id {device_id!r} does not map to a directory in the archive")
+        return directory
+
+    def _segment(self, device_id, milliseconds):
+        month = datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc).strftime('%Y-%m')
+        return os.path.join(self._device_directory(device_id), month + SEGMENT_SUFFIX)
+
+    def _write(self, device_id, rows):
+        # A block never spans two monthly segment files
+        by_segment = {}
+        for row in sorted(rows, key=lambda row: row[0]):
+            by_segment.setdefault(self._segment(device_id, row[0]), []).append(row)
+        with self._file_lock:
+            for segment, segment_rows in by_segment.items():
+                block = encode_block(device_id, self._columns(segment_rows), self.resolution)
+                os.makedirs(os.path.dirname(segment), exist_ok=True)
+                with open(segment, 'ab') as f:
+                    f.write(block)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if len(segment_rows) < self.block_size:
+                    small = self._small_readings[segment] = self._small_readings.get(segment, 0) + len(segment_rows)
+                    if small >= self.block_size:
+                        self._compact_due.add(segment)
+
+    def compact(self, segment):
+        """
+        Rewrites a segment file with its runs of small blocks (written every
+        FLUSH_INTERVAL) merged into blocks of up to BLOCK_SIZE readings, which
+        compress far better. The new file replaces the old one atomically.
+        Returns the number of blocks saved.
+        """
+        with self._file_lock:
+            with open(segment, 'rb') as f:
+                blocks = []
+                for count, first, last, offset, size in _blocks(f):
+                    f.seek(offset)
+                    blocks.append((count, first, last, f.read(size)))
+
+            # Runs of consecutive small blocks that together fit in one block
+            runs, run, run_count = [], [], 0
+            for block in blocks:
+                if block[0] >= self.block_size or run_count + block[0] > self.block_size:
+                    if run:
+                        runs.append(run)
+                    run, run_count = [], 0
+                run.append(block)
+                run_count += block[0]
+            if run:
+                runs.append(run)
+            if len(runs) == len(blocks):
+                self._compacted(segment)
+                return 0
+
+            temporary = segment + '.compacting'
+            with open(temporary, 'wb') as f:
+                for run in runs:
+                    if len(run) == 1:
+                        count, first, last, payload = run[0]
+                        f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, FORMAT_VERSION, count, first, last, len(payload)))
+                        f.write(payload)
+                        continue
+                    decoded = [_decode_block(count, first, payload) for count, first, _, payload in run]
+                    header = decoded[0][0]
+                    columns = {name: np.concatenate([part[name] for _, part in decoded])
+                               for name in ('timestamp',) + ARCHIVE_FIELDS}
+                    crops = sorted({crop for crop in columns['crop'] if crop is not None})
+                    codes = {crop: code for code, crop in enumerate(crops)}
+                    columns['crop'] = np.array([np.nan if crop is None else codes[crop] for crop in columns['crop']],
+                                               dtype=np.float64)
+                    columns['crops'] = crops
+                    # Stored timestamps are multiples of their resolution, so re-encoding is lossless
+                    # (unless AGROSMART_ARCHIVE_RESOLUTION_MS changed within the run: the coarsest wins)
+                    resolution = max(part_header['resolution'] for part_header, _ in decoded)
+                    f.write(encode_block(header['device'], columns, resolution))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, segment)
+            self._compacted(segment)
+            return len(blocks) - len(runs)
+
+    def _compacted(self, segment):
+        self._compact_due.discard(segment)
+        self._small_readings.pop(segment, None)
+
+    def devices(self):
+        """Device ids with archived or buffered readings"""
+        names = set()
+        if os.path.isdir(self.root):
+            names.update(device_id_from_directory(name) for name in os.listdir(self.root)
+                         if os.path.isdir(os.path.join(self.root, name)))
+        with self._lock:
+            names.update(self._pending)
+        return sorted(names)
+
+    def query(self, device_id, start=None, end=None, fields=None):
+        """
+        Readings of one device between `start` and `end` (epoch seconds, inclusive),
+        as arrays: {'timestamp': float64 seconds, field: float64, 'crop': object}.
+        Blocks outside the range are skipped by their headers.
+        """
+        start_ms = -2 ** 63 if start is None else int(start * 1000)
+        end_ms = 2 ** 63 - 1 if end is None else int(end * 1000)
+        fields = ARCHIVE_FIELDS if fields is None else tuple(fields)
+        parts = []
+
+        directory = self._device_directory(device_id)
+        segments = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)) \
+            if os.path.isdir(directory) else []
+        for name in segments:
+            filename = os.path.join(directory, name)
+            # One handle for the headers and the payloads: compact() may replace the file meanwhile
+            with open(filename, 'rb') as f:
+                selected = [block for block in _blocks(f) if block[2] >= start_ms and block[1] <= end_ms]
+                for count, first, last, offset, size in selected:
+                    f.seek(offset)
+                    parts.append(decode_block(count, first, f.read(size), fields))
+
+        with self._lock:
+            pending = list(self._pending.get(str(device_id), ()))
+        if pending:
+            columns = self._columns(pending)
+            columns['crop'] = _crop_names(columns['crop'], columns['crops'])
+            parts.append(columns)
+
+        result = {'timestamp': np.empty(0)}
+        result.update({field: np.empty(0, dtype=object if field == 'crop' else np.float64) for field in fields})
+        if not parts:
+            return result
+        timestamps = np.concatenate([part['timestamp'] for part in parts])
+        order = np.argsort(timestamps, kind='stable')
+        selected = order[(timestamps[order] >= start_ms) & (timestamps[order] <= end_ms)]
+        result['timestamp'] = timestamps[selected] / 1000
+        for field in fields:
+            result[field] = np.concatenate([part[field] for part in parts])[selected]
+        return result
+
+    def stats(self):
+        """Bytes on disk, archived block and reading counts, and buffered readings"""
+        size = blocks = readings = 0
+        if os.path.isdir(self.root):
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    if name.endswith(SEGMENT_SUFFIX):
+                        filename = os.path.join(directory, name)
+                        size += os.path.getsize(filename)
+                        for count, *_ in iter_blocks(filename):
+                            blocks += 1
+                            readings += count
+        with self._lock:
+            pending = sum(len(rows) for rows in self._pending.values())
+        return {
+            'bytes': size,
+            'blocks': blocks,
+            'readings': readings,
+            'bytes_per_reading': round(size / readings, 2) if readings else None,
+            'buffered_readings': pending
+        }
+
+
+def resample(result, every):
+    """
+    Means of every numeric field over `every`-second buckets (vectorized), for charts
+    over long ranges; crop is dropped
+    """
+    timestamps = result['timestamp']
+    if len(timestamps) == 0:
+        return {field: values for field, values in result.items() if field != 'crop'}
+    buckets = np.floor(timestamps / every).astype(np.int64)
+    unique, index = np.unique(buckets, return_inverse=True)
+    resampled = {'timestamp': unique * float(every)}
+    for field, values in result.items():
+        if field in ('timestamp', 'crop'):
+            continue
+        valid = ~np.isnan(values)
+        sums = np.bincount(index[valid], weights=values[valid], minlength=len(unique))
+        counts = np.bincount(index[valid], minlength=len(unique))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            resampled[field] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return resampled
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
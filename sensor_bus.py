@@ -0,0 +1,305 @@
+"""
+Shared-Memory Sensor Bus for AgroSmart
+One owner process (the prediction server, which has the serial port and the
+model) publishes every reading with its prediction into a ring of fixed-size
+records in shared memory; any number of local processes (the serial-to-web
+bridge in reader mode, dashboards, exporters) attach to it read-only, without
+opening the serial port or loading the model themselves.
+
+Layout of the shared block (numpy structured arrays over the same buffer):
+    header   magic, layout version, slot count, owner pid, sequence
+    ring     `slots` RECORD_DTYPE records; reading number n lives in slot (n - 1) % slots
+
+The header sequence is the number of readings published so far. Each record
+carries its own sequence number, set to 0 while the owner rewrites the slot
+and to n once it is complete (a per-slot seqlock), so readers never need a
+lock: they check a record's sequence before and after copying it and retry
+(or skip it, if the owner has lapped them) when it changed.
+
+`bus.ring` is a zero-copy numpy view of all records; latest() and since()
+copy out only the records asked for.
+"""
+
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from reading_schema import SENSOR_FIELDS
+
+BUS_NAME = os.getenv('AGROSMART_SENSOR_BUS_NAME', 'agrosmart_sensor_bus')
+DEFAULT_SLOTS = 1024
+MAGIC = 0x41475342  # "AGSB"
+LAYOUT_VERSION = 1
+# Windows process liveness (kernel32)
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+ERROR_ACCESS_DENIED = 5
+
+NUMERIC_FIELDS = tuple(field.name for field in SENSOR_FIELDS)
+HEADER_DTYPE = np.dtype([('magic', '<u4'), ('layout', '<u4'), ('slots', '<u4'), ('owner_pid', '<u4'),
+                         ('sequence', '<u8'), ('reserved', 'V40')])
+RECORD_DTYPE = np.dtype([('sequence', '<u8'), ('timestamp', '<f8')]
+                        + [(field, '<f4') for field in NUMERIC_FIELDS]
+                        + [('confidence', '<f4'), ('pump_on', 'i1'), ('crop', 'S23'), ('device_id', 'S32')])
+CROP_BYTES = RECORD_DTYPE['crop'].itemsize
+DEVICE_ID_BYTES = RECORD_DTYPE['device_id'].itemsize
+
+
+class SensorBus:
+    """
+    Ring of the latest readings in shared memory; create() in the owner, attach() everywhere else
+    """
+
+    def __init__(self, memory, owner):
+        self.memory = memory
+        self.owner = owner
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=memory.buf)
+        if self.header['magic'] != MAGIC or self.header['layout'] != LAYOUT_VERSION:
+            raise ValueError(f"Shared memory block '{memory.name}' is not an AgroSmart sensor bus")
+        self.slots = int(self.header['slots'])
+        self._publish_lock = threading.Lock()  # one writer at a time within the owner
+        self.ring = np.ndarray((self.slots,), dtype=RECORD_DTYPE, buffer=memory.buf, offset=HEADER_DTYPE.itemsize)
+        if not owner:
+            # Readers get a read-only view
+            self.ring.flags.writeable = False
+
+    @classmethod
+    def create(cls, name=BUS_NAME, slots=DEFAULT_SLOTS):
+        """
+        Creates the bus as its owner. A block left behind by an owner that
+        is no longer running is replaced; a live owner raises RuntimeError.
+        """
+        size = HEADER_DTYPE.itemsize + slots * RECORD_DTYPE.itemsize
+        sequence = 0
+        try:
+            memory = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale_header = np.ndarray((), dtype=HEADER_DTYPE, buffer=stale.buf)
+            owner_pid = int(stale_header['owner_pid'])
+            if owner_pid and owner_pid != os.getpid() and _process_alive(owner_pid):
+                del stale_header
+                stale.close()
+                raise RuntimeError(f"Sensor bus '{name}' is already owned by process {owner_pid}")
+            if os.name == 'nt':
+                # Windows keeps a block as long as any reader has it open and cannot
+                # unlink it, so the new owner takes the old block over. Its sequence
+                # carries on, so attached readers keep following it.
+                compatible = (stale_header['magic'] == MAGIC and stale_header['layout'] == LAYOUT_VERSION
+                              and int(stale_header['slots']) == slots and stale.size >= size)
+                sequence = int(stale_header['sequence']) if compatible else 0
+                del stale_header
+                if not compatible:
+                    stale.close()
+                    raise RuntimeError(f"Sensor bus '{name}' of a stopped owner is still open with another "
+                                       "layout; stop its readers and restart")
+                memory = stale
+            else:
+                del stale_header
+                stale.close()
+                stale.unlink()
+                memory = shared_memory.SharedMemory(name, create=True, size=size)
+
+        header = np.ndarray((), dtype=HEADER_DTYPE, buffer=memory.buf)
+        header['slots'] = slots
+        header['owner_pid'] = os.getpid()
+        header['sequence'] = sequence
+        header['layout'] = LAYOUT_VERSION
+        header['magic'] = MAGIC
+        del header  # no exported views may outlive close()
+        bus = cls(memory, owner=True)
+        atexit.register(bus.close)
+        return bus
+
+    @classmethod
+    def attach(cls, name=BUS_NAME):
+        """
+        Attaches to an existing bus as a reader (FileNotFoundError if no owner has created it)
+        """
+        memory = shared_memory.SharedMemory(name)
+        bus = cls(memory, owner=False)
+        # Python < 3.13 registers attached blocks with the resource tracker,
+        # which would unlink the owner's block when this reader exits
+        if int(bus.header['owner_pid']) != os.getpid():
+            try:
+                resource_tracker.unregister(memory._name, 'shared_memory')
+            except Exception:
+                pass
+        return bus
+
+    @property
+    def sequence(self):
+        """Number of readings published so far"""
+        return int(self.header['sequence'])
+
+    def owner_alive(self):
+        return _process_alive(int(self.header['owner_pid']))
+
+    def publish(self, readings):
+        """
+        Owner only: appends readings (dicts with the sensor fields and optionally
+        recommended_crop, explanation, pump_command, device_id and trace)
+        """
+        with self._publish_lock:
+            sequence = self.sequence
+            for reading in readings:
+                sequence += 1
+                record = self.ring[(sequence - 1) % self.slots]
+                record['sequence'] = 0  # being rewritten
+                trace = reading.get('trace') or {}
+                record['timestamp'] = trace.get('sampled_at') or trace.get('received_at') or time.time()
+                for field in NUMERIC_FIELDS:
+                    record[field] = _number(reading.get(field))
+                explanation = reading.get('explanation') or {}
+                record['confidence'] = _number(explanation.get('confidence'))
+                pump_command = reading.get('pump_command')
+                record['pump_on'] = -1 if pump_command is None else int(pump_command == 'PUMP_ON')
+                record['crop'] = _utf8(reading.get('recommended_crop'), CROP_BYTES)
+                record['device_id'] = _utf8(reading.get('device_id'), DEVICE_ID_BYTES)
+                record['sequence'] = sequence
+                self.header['sequence'] = sequence
+            return sequence
+
+    def read(self, sequence):
+        """
+        Reading number `sequence` as a dict, or None if it has been overwritten
+        (or is being rewritten) by the owner
+        """
+        if sequence < 1 or sequence > self.sequence or sequence <= self.sequence - self.slots:
+            return None
+        slot = self.ring[(sequence - 1) % self.slots]
+        if slot['sequence'] != sequence:
+            return None
+        record = slot.copy()
+        if slot['sequence'] != sequence:
+            return None
+        return record_to_reading(record)
+
+    def latest(self):
+        """The newest complete reading, or None if nothing has been published"""
+        for _ in range(3):
+            sequence = self.sequence
+            if sequence == 0:
+                return None
+            reading = self.read(sequence)
+            if reading is not None:
+                return reading
+        return None
+
+    def since(self, sequence):
+        """
+        Readings published after `sequence`: returns (readings, new sequence, lost),
+        where `lost` counts readings the owner overwrote before they were read
+        """
+        current = self.sequence
+        first = max(sequence + 1, current - self.slots + 1)
+        readings, lost = [], first - (sequence + 1)
+        for number in range(first, current + 1):
+            reading = self.read(number)
+            if reading is None:
+                lost += 1
+            else:
+                readings.append(reading)
+        return readings, current, lost
+
+    def wait_for(self, sequence, timeout=None, poll_interval=0.01):
+        """
+        Blocks until a reading newer than `sequence` is published (or `timeout`
+        seconds pass); returns the current sequence
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sequence <= sequence:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(poll_interval)
+        return self.sequence
+
+    def close(self):
+        """Detaches; the owner also removes the block"""
+        if self.memory is None:
+            return
+        memory, self.memory = self.memory, None
+        del self.header, self.ring
+        try:
+            memory.close()
+        except BufferError:
+            pass  # a record view is still in use; the mapping goes away with the process
+        if self.owner:
+            try:
+                memory.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def record_to_reading(record):
+    """
+    A ring record as a reading dict (missing values as None)
+    """
+    reading = {field: _value(record[field]) for field in NUMERIC_FIELDS}
+    reading['sequence'] = int(record['sequence'])
+    reading['timestamp'] = datetime.fromtimestamp(float(record['timestamp'])).isoformat()
+    reading['recommended_crop'] = record['crop'].decode() or None
+    reading['confidence'] = _value(record['confidence'])
+    reading['pump_command'] = {1: 'PUMP_ON', 0: 'PUMP_OFF'}.get(int(record['pump_on']))
+    reading['device_id'] = record['device_id'].decode() or None
+    return reading
+
+
+def _utf8(value, size):
+    """`value` as UTF-8, cut to at most `size` bytes without splitting a character"""
+    encoded = str(value or '').encode()
+    if len(encoded) <= size:
+        return encoded
+    return encoded[:size].decode('utf-8', 'ignore').encode()
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _value(number):
+    number = float(number)
+    return None if np.isnan(number) else round(number, 4)
+
+
+def _process_alive(pid):
+    if os.name == 'nt':
+        # os.kill(pid, 0) would terminate the process on Windows
+        return _windows_process_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _windows_process_alive(pid):
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # Access denied: the process exists but belongs to another user
+        return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True
+        return exit_code.value == STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
@@ -0,0 +1,268 @@
+"""
+Serial Connection Supervisor for AgroSmart
+Owns the ESP32's serial port for its whole lifecycle on a thread of its own,
+so the reader loop and the command writers never open, close or reconnect
+the port themselves:
+
+- Readers take the open port object with wait_connected(), writers with
+  current(). Whoever hits an I/O error calls report_failure(port, error) and
+  carries on; the supervisor closes that port (only if it is still the
+  current one, so a late report about an old port is ignored) and reconnects
+  in the background. A port object is never swapped under a caller: a new
+  connection is a new object, handed out from then on.
+- Reconnect attempts back off exponentially from RECONNECT_MIN to
+  RECONNECT_MAX seconds, with jitter so several processes do not retry in
+  lockstep.
+- Hot-plug: the list of serial ports is polled every HOTPLUG_INTERVAL seconds
+  (the portable equivalent of udev add/remove events). Unplugging the board
+  drops the connection at once, even while a reader is blocked on it, and a
+  newly plugged-in device triggers an attempt without waiting out the backoff.
+- find_port() (which may probe other serial devices, and opening a port can
+  reset them) is not asked again on every retry: its answer is reused until
+  the port list changes or REPROBE_INTERVAL seconds have passed.
+
+status() reports the connection, reconnect counts and the time spent
+disconnected (total and the current outage).
+"""
+
+import logging
+import random
+import threading
+import time
+
+import serial
+import serial.tools.list_ports
+
+from metrics import Counter, Gauge
+
+BAUD_RATE = 115200
+RECONNECT_MIN = 1.0  # seconds before the first retry
+RECONNECT_MAX = 60.0
+HOTPLUG_INTERVAL = 1.0  # seconds between port list scans
+REPROBE_INTERVAL = 60.0  # seconds before find_port() is asked again while the port list is unchanged
+
+SERIAL_RECONNECTS = Counter('agrosmart_serial_reconnects_total', 'ESP32 serial reconnect attempts', ['result'])
+SERIAL_DISCONNECTED_SECONDS = Gauge('agrosmart_serial_disconnected_seconds',
+                                    'Total time the ESP32 serial connection has been down')
+SERIAL_LINK_UP = Gauge('agrosmart_serial_link_up', '1 while the ESP32 serial port is open')
+
+logger = logging.getLogger('agrosmart.serial')
+
+
+def backoff_delay(attempts, minimum=RECONNECT_MIN, maximum=RECONNECT_MAX):
+    """
+    Delay before retry number `attempts` (1, 2, ...): doubles every attempt up
+    to `maximum`, randomized between half and the full value
+    """
+    delay = min(maximum, minimum * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def open_serial_port(device):
+    return serial.Serial(device, BAUD_RATE, timeout=1)
+
+
+class SerialSupervisor:
+    """
+    Keeps one serial device connected and hands the open port to readers and writers
+    """
+
+    def __init__(self, find_port, open_port=open_serial_port, on_connect=None, name='ESP32', on_plugged=None):
+        """
+        find_port() returns the device to open (or None if there is none);
+        open_port(device) opens it; on_connect(port) runs after every (re)connection;
+        on_plugged(devices) runs when serial devices appear, before the attempt
+        they trigger (e.g. to forget cached probe results for them).
+        """
+        self.find_port = find_port
+        self.open_port = open_port
+        self.on_connect = on_connect
+        self.on_plugged = on_plugged
+        self.name = name
+        self._port = None
+        self._device = None
+        self._device_listed = False
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._attempts = 0
+        self._next_attempt = 0.0
+        self._known_devices = None
+        self._found = None  # (device, port list, time.monotonic()) of the last find_port()
+        self._down_since = time.monotonic()
+        self._down_total = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.last_error = None
+        SERIAL_DISCONNECTED_SECONDS.set_function(lambda: round(self.disconnected_seconds(), 3))
+        SERIAL_LINK_UP.set_function(lambda: 1 if self._port is not None else 0)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='serial-supervisor', daemon=True)
+        self._thread.start()
+        return self
+
+    def current(self):
+        """The open port, or None while disconnected"""
+        return self._port
+
+    def wait_connected(self, timeout=None):
+        """Blocks until a port is open (or `timeout` seconds pass); returns it or None"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._port is not None or self._stopped, timeout)
+            return self._port
+
+    def report_failure(self, port, error):
+        """
+        A reader or writer hit an error on `port`: close it and reconnect in the background
+        """
+        with self._cond:
+            if port is None or port is not self._port:
+                return
+            self._disconnect(error)
+            self._cond.notify_all()
+
+    def _disconnect(self, error):
+        """Closes the current port (called with the condition held)"""
+        port, self._port = self._port, None
+        self.last_error = str(error)
+        self._down_since = time.monotonic()
+        self._attempts = 0
+        self._next_attempt = time.monotonic() + backoff_delay(1)
+        logger.warning("%s disconnected from %s: %s", self.name, self._device, error)
+        try:
+            port.close()
+        except Exception:
+            pass
+
+    def disconnected_seconds(self):
+        """Total time without an open port, including the current outage"""
+        down_since = self._down_since
+        return self._down_total + (time.monotonic() - down_since if down_since is not None else 0.0)
+
+    def status(self):
+        now = time.monotonic()
+        with self._cond:
+            down_since = self._down_since
+            return {
+                'connected': self._port is not None,
+                'port': self._device if self._port is not None else None,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'failed_attempts': self.failed_attempts,
+                'last_error': self.last_error,
+                'disconnected_seconds': round(self.disconnected_seconds(), 1),
+                'current_outage_seconds': round(now - down_since, 1) if down_since is not None else 0.0,
+                'next_attempt_in': round(max(0.0, self._next_attempt - now), 1) if self._port is None else None
+            }
+
+    def close(self):
+        """Stops supervising and closes the port"""
+        with self._cond:
+            self._stopped = True
+            if self._port is not None:
+                self._disconnect("closed")
+            self._cond.notify_all()
+
+    def _list_devices(self):
+        try:
+            return {port.device for port in serial.tools.list_ports.comports()}
+        except Exception:
+            return set()
+
+    def _run(self):
+        while True:
+            devices = self._list_devices()
+            added = devices - self._known_devices if self._known_devices is not None else set()
+            self._known_devices = devices
+
+            with self._cond:
+                if self._stopped:
+                    return
+                port = self._port
+                if port is not None and self._device_listed and self._device not in devices:
+                    self._disconnect("device unplugged")
+                    self._cond.notify_all()
+                    port = None
+                if port is None and added:
+                    logger.info("Serial device plugged in: %s", ", ".join(sorted(added)))
+                    self._next_attempt = 0.0
+                due = port is None and time.monotonic() >= self._next_attempt
+
+            if due:
+                if added and self.on_plugged is not None:
+                    try:
+                        self.on_plugged(added)
+                    except Exception as e:
+                        logger.error("Error handling new serial devices: %s", e)
+                self._try_connect(devices)
+
+            with self._cond:
+                if self._stopped:
+                    return
+                wait = HOTPLUG_INTERVAL
+                if self._port is None:
+                    wait = min(wait, max(0.05, self._next_attempt - time.monotonic()))
+                self._cond.wait(wait)
+
+    def _find(self, devices):
+        """
+        find_port()'s answer, asked again only when the port list changed or
+        REPROBE_INTERVAL passed since it was last asked
+        """
+        found = self._found
+        if found is not None and found[1] == devices and time.monotonic() - found[2] < REPROBE_INTERVAL:
+            return found[0]
+        device = self.find_port()
+        self._found = (device, devices, time.monotonic())
+        return device
+
+    def _try_connect(self, devices):
+        counted = self.connects > 0 or self._attempts > 0  # the very first attempt is not a reconnect
+        error = None
+        device = None
+        port = None
+        try:
+            device = self._find(devices)
+            if device is None:
+                error = f"{self.name} not found"
+            else:
+                port = self.open_port(device)
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            if port is None or self._stopped:
+                if port is not None:
+                    port.close()
+                self._attempts += 1
+                self.failed_attempts += 1
+                self.last_error = str(error)
+                delay = backoff_delay(self._attempts)
+                self._next_attempt = time.monotonic() + delay
+                if counted:
+                    SERIAL_RECONNECTS.inc(result='failure')
+                logger.warning("Could not connect to %s (%s); retrying in %.1f s", self.name, error, delay)
+                return
+
+            self._port = port
+            self._device = device
+            self._device_listed = device in devices
+            if self._down_since is not None:
+                self._down_total += time.monotonic() - self._down_since
+                self._down_since = None
+            if self.connects:
+                self.reconnects += 1
+            if counted:
+                SERIAL_RECONNECTS.inc(result='success')
+            self.connects += 1
+            self._attempts = 0
+            self._cond.notify_all()
+        logger.info("Connected to %s on %s", self.name, device)
+
+        if self.on_connect is not None:
+            try:
+                self.on_connect(port)
+            except Exception as e:
+                logger.error("Error after connecting to %s: %s", self.name, e)
@@ -0,0 +1,136 @@
+"""
+Startup Profile for AgroSmart
+Reports where cold-start time goes:
+- import-time profile (python -X importtime) of prediction_server.py and
+  serial_to_web_bridge.py: the slowest packages each one imports at load
+- time until prediction_server.py accepts connections and until /api/ready
+  reports the model loaded, with AGROSMART_FAST_START on and off
+
+    python startup_profile.py
+    python startup_profile.py --output startup_profile.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ENTRY_POINTS = {
+    'prediction_server': (ROOT_DIR, 'import prediction_server'),
+    'serial_to_web_bridge': (os.path.join(ROOT_DIR, 'esp32_firmware'), 'import serial_to_web_bridge')
+}
+
+
+def import_profile(directory, statement):
+    """
+    Runs `statement` under -X importtime and returns (total_ms, [(package, cumulative_ms), ...]):
+    the entry module's import time and what its direct imports cost, slowest first.
+    """
+    module = statement.split()[-1]
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=directory,
+                            capture_output=True, text=True, env=dict(os.environ, AGROSMART_LOG_LEVEL='ERROR'))
+    packages = {}
+    children = {}
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            # -X importtime lists a module's imports before the module itself
+            package = name.split('.')[0]
+            children[package] = children.get(package, 0) + int(cumulative_us)
+        elif depth == 0:
+            if name == module:
+                total_us = int(cumulative_us)
+                packages = children
+            children = {}
+    ranked = sorted(((package, round(us / 1000, 1)) for package, us in packages.items()),
+                    key=lambda item: item[1], reverse=True)
+    return round(total_us / 1000, 1), ranked
+
+
+def wait_for_port(port, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline and process.poll() is None:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
+
+def wait_for_ready(port, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline and process.poll() is None:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/ready", timeout=1) as response:
+                return json.load(response)
+        except OSError:
+            time.sleep(0.05)
+    return None
+
+
+def server_startup(port, fast_start):
+    """
+    Starts prediction_server.py and measures seconds until the port accepts
+    connections and until /api/ready returns 200
+    """
+    env = dict(os.environ, AGROSMART_PORT=str(port), AGROSMART_FAST_START='1' if fast_start else '0',
+               AGROSMART_RETRAIN='0', AGROSMART_LOG_LEVEL='ERROR')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'prediction_server.py'], cwd=ROOT_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        bound = wait_for_port(port, process)
+        bind_seconds = time.perf_counter() - start
+        status = wait_for_ready(port, process) if bound else None
+        ready_seconds = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    return {
+        'fast_start': fast_start,
+        'port_bound_seconds': round(bind_seconds, 2) if bound else None,
+        'ready_seconds': round(ready_seconds, 2) if status else None,
+        'warmup_steps_ms': status.get('steps_ms') if status else None
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Profile AgroSmart cold-start time.")
+    parser.add_argument('--port', type=int, default=5056, help="Port for the test server (default: %(default)s)")
+    parser.add_argument('--top', type=int, default=10, help="Packages to list per entry point (default: %(default)s)")
+    parser.add_argument('--output', help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = {'imports': {}, 'server_startup': []}
+    for name, (directory, statement) in ENTRY_POINTS.items():
+        total_ms, ranked = import_profile(directory, statement)
+        report['imports'][name] = {'total_ms': total_ms, 'packages_ms': dict(ranked)}
+        print(f"\n{name}: {total_ms:.0f} ms to import")
+        for package, ms in ranked[:args.top]:
+            print(f"  {package:<28} {ms:>8.1f} ms")
+
+    print("\nprediction_server.py startup:")
+    for fast_start in (True, False):
+        result = server_startup(args.port, fast_start)
+        report['server_startup'].append(result)
+        print(f"  FAST_START={int(fast_start)}: port bound after {result['port_bound_seconds']} s, "
+              f"ready after {result['ready_seconds']} s")
+        if result['warmup_steps_ms']:
+            print("    warm-up: " + ", ".join(f"{step}={ms:.0f} ms" for step, ms in result['warmup_steps_ms'].items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to '{args.output}'")
@@ -0,0 +1,163 @@
+"""
+Versioned Sensor State for AgroSmart
+Copy-on-write store for the latest reading and the reading history, shared by
+the serial reader thread, /predict and the Flask request threads.
+
+- Writers build a new immutable snapshot and publish it with one reference
+  assignment; readers take `store.snapshot` once per request and never lock
+  or see half-updated data.
+- Published readings are FrozenReading dicts: still JSON-serializable, but
+  any attempt to modify them raises (copy with dict(reading) instead).
+- Watchers can block until a newer version is published with
+  wait_for_version() (used for long-polling /api/sensors/current).
+
+History is an append-only list shared between snapshots: each snapshot only
+sees the slice it was published with, and the list is compacted to a new one
+when it grows past twice the limit, so appends stay O(1) amortized.
+"""
+
+import threading
+from collections import namedtuple
+from collections.abc import Sequence
+
+
+class FrozenReading(dict):
+    """
+    A dict that refuses changes once published
+    """
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Published readings are immutable; publish a new reading instead")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenReading, (dict(self),))
+
+
+def freeze(reading):
+    """
+    Returns an immutable copy of a reading (nested dicts such as 'trace' included)
+    """
+    if isinstance(reading, FrozenReading):
+        return reading
+    return FrozenReading({key: freeze(value) if isinstance(value, dict) else value
+                          for key, value in reading.items()})
+
+
+class HistoryView(Sequence):
+    """
+    Read-only window [start, end) over the shared append-only history list
+    """
+    __slots__ = ('_items', '_start', '_end')
+
+    def __init__(self, items, start, end):
+        self._items = items
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return self._items[self._start + start:self._start + stop:step]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self._items[self._start + index]
+
+    def __iter__(self):
+        for index in range(self._start, self._end):
+            yield self._items[index]
+
+
+Snapshot = namedtuple('Snapshot', ['version', 'latest', 'history'])
+
+
+class VersionedStore:
+    """
+    Latest reading + bounded history, published as immutable versioned snapshots
+    """
+
+    def __init__(self, initial, history_limit=100):
+        self.history_limit = history_limit
+        self._items = []
+        self._write_lock = threading.Lock()           # serializes writers only
+        self._published = threading.Condition(threading.Lock())
+        self._snapshot = Snapshot(0, freeze(initial), HistoryView(self._items, 0, 0))
+
+    @property
+    def snapshot(self):
+        """The current snapshot (a single attribute read; never blocks)"""
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def publish(self, reading, add_to_history=True):
+        """
+        Publishes `reading` as the latest reading (and appends it to the history).
+        Returns the new snapshot.
+        """
+        return self.publish_many([reading], add_to_history)
+
+    def publish_many(self, readings, add_to_history=True):
+        """
+        Publishes a batch of readings with a single snapshot swap: all of them
+        are appended to the history and the last one becomes the latest reading.
+        Returns the new snapshot (the current one if `readings` is empty).
+        """
+        frozen = [freeze(reading) for reading in readings]
+        if not frozen:
+            return self._snapshot
+        with self._write_lock:
+            current = self._snapshot
+            history = current.history
+            if add_to_history and self.history_limit > 0:
+                items, start, end = self._items, history._start, history._end
+                if end + len(frozen) > 2 * self.history_limit:
+                    # Compact: copy the newest readings into a new list; older
+                    # snapshots keep the old list untouched
+                    items = items[max(start, end + len(frozen) - self.history_limit):end]
+                    start, end = 0, len(items)
+                items.extend(frozen[-self.history_limit:])
+                end = len(items)
+                start = max(start, end - self.history_limit)
+                self._items = items
+                history = HistoryView(items, start, end)
+
+            snapshot = Snapshot(current.version + 1, frozen[-1], history)
+            self._snapshot = snapshot  # the single reference swap readers see
+
+        with self._published:
+            self._published.notify_all()
+        return snapshot
+
+    def reset(self, initial, history=()):
+        """
+        Replaces the whole state (e.g. to preload history); bumps the version
+        """
+        with self._write_lock:
+            items = [freeze(reading) for reading in history][-self.history_limit:] if self.history_limit else []
+            self._items = items
+            self._snapshot = Snapshot(self._snapshot.version + 1, freeze(initial),
+                                      HistoryView(items, 0, len(items)))
+        with self._published:
+            self._published.notify_all()
+
+    def wait_for_version(self, after_version, timeout=None):
+        """
+        Blocks until a snapshot newer than `after_version` is published (or the
+        timeout expires) and returns the current snapshot.
+        """
+        if self._snapshot.version > after_version:
+            return self._snapshot
+        with self._published:
+            self._published.wait_for(lambda: self._snapshot.version > after_version, timeout)
+        return self._snapshot